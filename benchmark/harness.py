@@ -0,0 +1,101 @@
+
+
+"""
+    Shared pieces of the benchmark suite.
+    Each benchmark runs in its own process against a throwaway configuration and datastore, the subsystems are
+    singletons so this is the only way to measure a cold start and to keep one benchmark from warming another.
+"""
+
+
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+def setup_environment(base: str, **configuration):
+    """ Write a configuration for a throwaway server rooted at base and point the Configuration subsystem at it.
+        Any keyword arguments override values of the ServerConfiguration.
+    """
+    from worldgpt.shared.util import about
+    os.makedirs(base, exist_ok=True)
+    path = os.path.join(base, 'configuration.json')
+    data = {'persistence_base': base,
+            'datastore': os.path.join(base, 'datastore.db'),
+            'configuration': path,
+            'llm_backend': 'fake',
+            'fake_llm_seed': 0}
+    data.update(configuration)
+    with open(path, 'w') as conffd:
+        json.dump(data, conffd)
+    os.environ[f'{about.__TITLE__}_CONFPATH'] = path
+
+
+def bootstrap(database: bool = True):
+    """ Bootstrap the subsystems a benchmark needs, returns the seconds taken by each. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.server.subsystem.database import Database
+    timings = {}
+    started = time.perf_counter()
+    Configuration().bootstrap()
+    timings['configuration'] = time.perf_counter() - started
+    if database:
+        started = time.perf_counter()
+        Database().bootstrap()
+        timings['database'] = time.perf_counter() - started
+    return timings
+
+
+def wait_for_writes(timeout: float = 600.0):
+    """ Block until the Database worker has written everything queued so far, returns the seconds waited. """
+    from worldgpt.server.subsystem.database import Database
+    started = time.perf_counter()
+    while Database().dirty or not Database().queue.empty():
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError('Database worker did not finish writing in time.')
+        time.sleep(0.001)
+    return time.perf_counter() - started
+
+
+def percentiles(samples: list, points=(50, 95, 99)):
+    """ Nearest rank percentiles of samples, keyed as p50, p95 ... """
+    if not samples:
+        return {f'p{x}': None for x in points}
+    ordered = sorted(samples)
+    return {f'p{x}': ordered[max(0, min(len(ordered) - 1, round(x / 100 * len(ordered)) - 1))] for x in points}
+
+
+def summarise(samples: list):
+    """ Count, mean, min, max and percentiles of samples. """
+    if not samples:
+        return {'count': 0}
+    return dict({'count': len(samples),
+                 'mean': sum(samples) / len(samples),
+                 'min': min(samples),
+                 'max': max(samples)},
+                **percentiles(samples))
+
+
+def rss_bytes():
+    """ Resident set size of this process, None where it can't be read. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # peak rather than current, in kilobytes on linux and bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+
+def memory_snapshot():
+    """ Python heap in use as tracked by tracemalloc, if it's tracing, and the resident set size. """
+    gc.collect()
+    return {'traced_bytes': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+            'rss_bytes': rss_bytes()}
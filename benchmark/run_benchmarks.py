@@ -0,0 +1,126 @@
+
+
+"""
+    Benchmark suite
+    ===============
+
+    Measures the server end to end against the fake LLM backend, so results depend on the server alone and cost nothing.
+    Results are written as JSON so runs of different versions can be compared.
+
+    Run from the root of the repository:
+        python -m benchmark.run_benchmarks --output bench.json
+        python -m benchmark.run_benchmarks --suite boot --boot-sizes 1000 10000
+        python -m benchmark.run_benchmarks --quick
+
+    Each benchmark runs in its own process with a throwaway configuration and datastore, see `suites.py` for what each
+    measures. The tokenizer used by the server must be available, tiktoken downloads it on first use.
+"""
+
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+FORMAT_VERSION = 1  # bumped whenever the layout of the output changes in a way that breaks comparisons.
+
+quick_parameters = {'completion': {'requests': 200, 'concurrency': 8, 'characters': 8, 'warmup': 20},
+                    'writes': {'characters': 100, 'updates': 2000},
+                    'memory': {'characters': 20, 'checkpoints': [0, 50, 100]},
+                    'voice': {'requests': 4, 'concurrency': 2},
+                    'recall': {'messages': [1000, 10000], 'queries': 20},
+                    'lore': {'entries': [100, 1000], 'turns': 20}}
+
+
+def run_child(suite: str, parameters: dict):
+    """ Run one benchmark in a new process, returns its results or the error that stopped it. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory(prefix='worldgpt-benchmark-') as base:
+        started = time.perf_counter()
+        process = subprocess.run([sys.executable, '-m', 'benchmark.run_benchmarks', '--child', suite,
+                                  '--parameters', json.dumps(parameters), '--base', base],
+                                 cwd=root, capture_output=True, text=True)
+        elapsed = time.perf_counter() - started
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    return {'parameters': parameters,
+            'error': f'exited with {process.returncode} after {elapsed:.1f}s',
+            'stderr': process.stderr[-4000:]}
+
+
+def child(suite: str, parameters: dict, base: str):
+    """ Entry point of the benchmark process. The subsystems' workers don't stop on their own, so exit directly. """
+    from benchmark.harness import setup_environment
+    from benchmark.suites import suites
+    setup_environment(base)
+    try:
+        result = suites[suite](**parameters)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        result = {'parameters': parameters, 'error': f'{e.__class__.__name__}: {e}'}
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+
+def describe_environment():
+    from worldgpt.shared.util import about
+    return {'format_version': FORMAT_VERSION,
+            'version': about.__VERSION__,
+            'started': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the WorldGPT server benchmarks, writing the results as JSON.')
+    parser.add_argument('--suite', action='append',
+                        choices=['completion', 'boot', 'writes', 'memory', 'voice', 'startup', 'recall', 'lore'],
+                        help='A benchmark to run, may be given more than once. Defaults to all of them.')
+    parser.add_argument('--boot-sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of characters to measure the cold boot at.')
+    parser.add_argument('--quick', action='store_true', help='Smaller parameters, to check the suite runs.')
+    parser.add_argument('--output', help='File to write the results to, otherwise they are printed.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--parameters', default='{}', help=argparse.SUPPRESS)
+    parser.add_argument('--base', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, json.loads(args.parameters), args.base)
+        return
+
+    suites = args.suite or ['completion', 'boot', 'writes', 'memory', 'voice', 'startup', 'recall', 'lore']
+    report = dict(describe_environment(), results={})
+    for suite in suites:
+        parameters = quick_parameters.get(suite, {}) if args.quick else {}
+        print(f'Running {suite}...', file=sys.stderr)
+        if suite == 'boot':
+            sizes = sorted({min(x, 1000) for x in args.boot_sizes}) if args.quick else args.boot_sizes
+            report['results'][suite] = [run_child(suite, dict(parameters, characters=x)) for x in sizes]
+        else:
+            report['results'][suite] = run_child(suite, parameters)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as outfd:
+            outfd.write(output)
+        print(f'Wrote {args.output}', file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
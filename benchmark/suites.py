@@ -0,0 +1,473 @@
+
+
+"""
+    The benchmarks themselves, each is a function taking its parameters and returning a dict of results.
+    They expect a fresh process, see `run_benchmarks.py`.
+
+    completion  requests per second and latency of `/generate/openai/llm_completion` over the ASGI application.
+    boot        how long the Database takes to bootstrap over an existing datastore of a given number of characters.
+    writes      throughput of the Database worker writing queued characters.
+    memory      memory held by the server as character histories lengthen.
+    voice       time to the first audio and to the last of the voice pipeline, see `worldgpt/server/util/voice.py`.
+    startup     time to import the server and bootstrap each of its subsystems, see `worldgpt/server/util/bootstrap.py`.
+    recall      memory and latency of recalling relevant past messages over long histories, see `memory.py`.
+    lore        latency of finding the lore mentioned in a conversation as the number of entries grows, see `LoreBook`.
+"""
+
+
+import asyncio
+import random
+import sqlite3
+import time
+import tracemalloc
+from benchmark.harness import bootstrap, memory_snapshot, summarise, wait_for_writes
+
+
+def make_character(index: int):
+    from worldgpt.shared.model.character import Character
+    return Character(name=f'character-{index:07d}',
+                     description='A weathered innkeeper with a scar across one cheek.',
+                     occupation='Innkeeper',
+                     age=42,
+                     gender=('Male', 'Female', 'Non-Binary')[index % 3],
+                     mood='Wary',
+                     attributes=['observant', 'gruff'],
+                     inventory=['ledger', 'cleaver'])
+
+
+def make_message(index: int, length: int = 120):
+    from worldgpt.shared.model.message import Message
+    content = f'Message {index}: ' + 'have you heard the rumours of wolves in the northern hills? ' * (length // 60 + 1)
+    return Message(role='user' if index % 2 == 0 else 'assistant', content=content[:length], timestamp=time.time())
+
+
+def completion(requests: int = 2000, concurrency: int = 32, characters: int = 64, warmup: int = 100,
+               latency: float = 0.0, tokens_per_second: float = 1e6, max_tokens: int = 128):
+    """ Drive the completion endpoint with `concurrency` clients spread over `characters` characters.
+        The fake backend's latency defaults to nothing so the results are the overhead of the server itself.
+    """
+    import httpx
+    from worldgpt.server.subsystem.api import application
+    from worldgpt.server.subsystem.database import Database
+    from worldgpt.server.util.backend import close_backends
+    from worldgpt.server.subsystem.configuration import Configuration
+    boot = bootstrap()
+    with Configuration().lock.w_locked():
+        Configuration().fake_llm_latency = latency
+        Configuration().fake_llm_tokens_per_second = tokens_per_second
+    names = []
+    for index in range(characters):
+        character = make_character(index)
+        Database().store(character)
+        names.append(character.name)
+    wait_for_writes()
+
+    async def drive():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+            latencies = []
+            errors = 0
+
+            async def client_loop(counter, record: bool):
+                nonlocal errors
+                for index in counter:
+                    body = [{'role': 'user', 'content': f'Good evening, any news from the road? ({index})'}]
+                    started = time.perf_counter()
+                    response = await client.post('/generate/openai/llm_completion',
+                                                 params={'character': names[index % len(names)],
+                                                         'max_tokens': max_tokens},
+                                                 json=body)
+                    elapsed = time.perf_counter() - started
+                    if not record:
+                        continue
+                    if response.status_code != 200 or 'error' in response.json():
+                        errors += 1
+                    latencies.append(elapsed)
+
+            # warm the tokenizer, caches and the backend before measuring.
+            counter = iter(range(warmup))
+            await asyncio.gather(*(client_loop(counter, False) for _ in range(concurrency)))
+            counter = iter(range(warmup, warmup + requests))
+            started = time.perf_counter()
+            await asyncio.gather(*(client_loop(counter, True) for _ in range(concurrency)))
+            duration = time.perf_counter() - started
+            await close_backends()
+            return latencies, errors, duration
+
+    latencies, errors, duration = asyncio.run(drive())
+    wait_for_writes()
+    return {'parameters': {'requests': requests, 'concurrency': concurrency, 'characters': characters,
+                           'warmup': warmup, 'fake_llm_latency': latency,
+                           'fake_llm_tokens_per_second': tokens_per_second, 'max_tokens': max_tokens},
+            'bootstrap_seconds': boot,
+            'duration_seconds': duration,
+            'requests_per_second': len(latencies) / duration if duration else None,
+            'errors': errors,
+            'latency_seconds': summarise(latencies),
+            'database': Database().get_statistics()}
+
+
+def populate(characters: int, messages: int):
+    """ Write characters directly into a new datastore, bypassing the worker so populating isn't what's measured. """
+    from worldgpt.server.subsystem.database import Database
+    from worldgpt.shared.model.message import Message
+    Database().first_run()
+    connection = sqlite3.connect(Database().get_datastore())
+    with connection:
+        for start in range(0, characters, 1000):
+            batch = [make_character(x) for x in range(start, min(characters, start + 1000))]
+            connection.executemany(batch[0].to_sql()[0], [x.to_sql()[1] for x in batch])
+            rows = [make_message(sequence).to_sql(x.name, sequence)[1] for x in batch for sequence in range(messages)]
+            if rows:
+                connection.executemany(Message.sql_insert(), rows)
+    connection.close()
+
+
+def boot(characters: int = 1000, messages: int = 4):
+    """ Bootstrap the Database over a datastore of `characters` characters with `messages` messages each.
+        The datastore was just written, so it's likely in the OS page cache, this measures the server not the disk.
+    """
+    from worldgpt.server.subsystem.database import Database
+    timings = bootstrap(database=False)
+    started = time.perf_counter()
+    populate(characters, messages)
+    populate_duration = time.perf_counter() - started
+
+    database = Database()
+    load_characters = database.load_characters
+    phases = {}
+
+    def timed_load_characters():
+        started = time.perf_counter()
+        load_characters()
+        phases['load_characters'] = time.perf_counter() - started
+    database.load_characters = timed_load_characters
+
+    started = time.perf_counter()
+    database.bootstrap()
+    timings['database'] = time.perf_counter() - started
+    timings.update(phases)
+
+    started = time.perf_counter()
+    database.get_character(make_character(characters // 2).name)
+    timings['first_character'] = time.perf_counter() - started
+    started = time.perf_counter()
+    database.list_characters(limit=100)
+    timings['first_page'] = time.perf_counter() - started
+    return {'parameters': {'characters': characters, 'messages': messages},
+            'populate_seconds': populate_duration,
+            'seconds': timings,
+            'indexed_characters': len(database.names)}
+
+
+def writes(characters: int = 1000, updates: int = 20000, messages: int = 1):
+    """ Queue `updates` updates round robin over `characters` characters, each appending `messages` messages, and time
+        how long the worker takes to write them. Updates to a character still waiting to be written are coalesced, the
+        statistics of the Database show how many were.
+    """
+    from worldgpt.server.subsystem.database import Database
+    boot_timings = bootstrap()
+    database = Database()
+    population = [make_character(x) for x in range(characters)]
+    started = time.perf_counter()
+    for character in population:
+        database.store(character)
+    wait_for_writes()
+    insert_duration = time.perf_counter() - started
+
+    before = dict(database.get_statistics())
+    started = time.perf_counter()
+    for index in range(updates):
+        character = population[index % characters]
+        with database.character_locks(character.name):
+            for offset in range(messages):
+                character.messages.append(make_message(index + offset))
+        database.store(character)
+    enqueue_duration = time.perf_counter() - started
+    wait_for_writes()
+    duration = time.perf_counter() - started
+    after = database.get_statistics()
+
+    flushes = after['flushes'] - before['flushes']
+    written = after['flushed_characters'] - before['flushed_characters']
+    return {'parameters': {'characters': characters, 'updates': updates, 'messages': messages},
+            'bootstrap_seconds': boot_timings,
+            'insert_seconds': insert_duration,
+            'inserts_per_second': characters / insert_duration if insert_duration else None,
+            'enqueue_seconds': enqueue_duration,
+            'duration_seconds': duration,
+            'updates_per_second': updates / duration if duration else None,
+            'messages_per_second': updates * messages / duration if duration else None,
+            'flushes': flushes,
+            'characters_written': written,
+            'coalesced_updates': after['coalesced_updates'] - before['coalesced_updates'],
+            'mean_batch_size': written / flushes if flushes else None,
+            'mean_flush_seconds': (after['total_flush_duration'] - before['total_flush_duration']) / flushes
+            if flushes else None,
+            'max_flush_seconds': after['max_flush_duration']}
+
+
+def memory(characters: int = 100, checkpoints: tuple = (0, 100, 250, 500, 1000), length: int = 120):
+    """ Grow the history of `characters` characters through each checkpoint of messages per character, recording the
+        memory in use once the worker has written them. Tracing allocations slows everything else down, so the
+        timings of this benchmark aren't comparable to the others.
+    """
+    from worldgpt.server.subsystem.database import Database
+    bootstrap()
+    database = Database()
+    tracemalloc.start()
+    baseline = memory_snapshot()
+    population = [make_character(x) for x in range(characters)]
+    for character in population:
+        database.store(character)
+    wait_for_writes()
+
+    samples = []
+    count = 0
+    for checkpoint in sorted(checkpoints):
+        for character in population:
+            with database.character_locks(character.name):
+                for index in range(count, checkpoint):
+                    character.messages.append(make_message(index, length))
+            database.store(character)
+        count = max(count, checkpoint)
+        wait_for_writes()
+        snapshot = memory_snapshot()
+        samples.append(dict(snapshot,
+                            messages_per_character=count,
+                            cache_bytes=database.get_statistics()['cache_bytes']))
+    tracemalloc.stop()
+
+    first, last = samples[0], samples[-1]
+    added = (last['messages_per_character'] - first['messages_per_character']) * characters
+    return {'parameters': {'characters': characters, 'checkpoints': list(checkpoints), 'message_length': length},
+            'baseline': baseline,
+            'checkpoints': samples,
+            'traced_bytes_per_message': (last['traced_bytes'] - first['traced_bytes']) / added if added else None,
+            'rss_bytes_per_message': (last['rss_bytes'] - first['rss_bytes']) / added
+            if added and last['rss_bytes'] is not None else None}
+
+
+def voice(requests: int = 20, concurrency: int = 4, latency: float = 0.3, tokens_per_second: float = 30.0,
+          max_tokens: int = 128):
+    """ Run the voice pipeline over streamed completions from the fake LLM backend and the local synthesizer, both at
+        rates close to the real services, recording when the first audio is ready and when the response has finished.
+        The pipeline is driven directly, the ASGI transport used by `completion` buffers whole responses.
+    """
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.server.subsystem.database import Database
+    from worldgpt.server.util.llm import astream_chat_completion
+    from worldgpt.server.util.voice import synthesize_stream
+    from worldgpt.shared.model.message import Message
+    bootstrap()
+    with Configuration().lock.w_locked():
+        Configuration().fake_llm_latency = latency
+        Configuration().fake_llm_tokens_per_second = tokens_per_second
+        Configuration().tts_backend = 'local'
+    characters = []
+    for index in range(concurrency):
+        character = make_character(index)
+        Database().store(character)
+        characters.append(character)
+    wait_for_writes()
+
+    async def drive():
+        first_audio, finished, sentences = [], [], []
+        counter = iter(range(requests))
+
+        async def client_loop():
+            for index in counter:
+                messages = [Message(role='user', content=f'Tell me about the road north. ({index})')]
+                deltas = astream_chat_completion(characters[index % len(characters)], messages, max_tokens=max_tokens)
+                started = time.perf_counter()
+                first, count = None, 0
+                async for event in synthesize_stream(deltas):
+                    if event[0] == 'audio':
+                        count += 1
+                        first = first or time.perf_counter() - started
+                finished.append(time.perf_counter() - started)
+                sentences.append(count)
+                if first is not None:
+                    first_audio.append(first)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        return first_audio, finished, sentences, time.perf_counter() - started
+
+    first_audio, finished, sentences, duration = asyncio.run(drive())
+    return {'parameters': {'requests': requests, 'concurrency': concurrency, 'fake_llm_latency': latency,
+                           'fake_llm_tokens_per_second': tokens_per_second, 'max_tokens': max_tokens},
+            'duration_seconds': duration,
+            'first_audio_seconds': summarise(first_audio),
+            'finished_seconds': summarise(finished),
+            'sentences_per_response': summarise(sentences)}
+
+
+def startup(timeout: float = 60.0):
+    """ Import the server and bootstrap every subsystem as `run_server.py` does, then count the first prompt.
+        The process is fresh, so the imports are cold, though the files are likely in the OS page cache.
+    """
+    started = time.perf_counter()
+    import worldgpt.server.subsystem.api  # noqa: F401, imported for the time it takes.
+    from worldgpt.server.util import bootstrap as startup_module
+    imports = time.perf_counter() - started
+
+    started = time.perf_counter()
+    startup_module.bootstrap_subsystems()
+    bootstrapped = time.perf_counter() - started
+    from worldgpt.server.util.tokens import count_prompt_tokens
+    started = time.perf_counter()
+    count_prompt_tokens('How much for a room for the night?')
+    first_count = time.perf_counter() - started
+    while 'tokenizer' not in startup_module.background_timings and time.perf_counter() - started < timeout:
+        time.sleep(0.01)
+    return {'parameters': {},
+            'imports_seconds': imports,
+            'bootstrap_seconds': bootstrapped,
+            'first_count_seconds': first_count,
+            'report': startup_module.get_startup_report()}
+
+
+def make_conversation(count: int, seed: int = 0, vocabulary: int = 5000, length: int = 24):
+    """ Messages of `length` words drawn from a vocabulary with the long tail of natural language, the word of rank r
+        being r times less common than the most common. """
+    from worldgpt.shared.model.message import Message
+    generator = random.Random(seed)
+    words = [f'word{x}' for x in range(vocabulary)]
+    weights = [1 / (x + 1) for x in range(vocabulary)]
+    return [Message(role='user' if x % 2 == 0 else 'assistant',
+                    content=' '.join(generator.choices(words, weights, k=length)),
+                    timestamp=float(x))
+            for x in range(count)]
+
+
+def recall(messages: tuple = (1000, 10000, 50000), queries: int = 200, recall_count: int = 8,
+           recall_tokens: int = 512):
+    """ For a character with each number of messages: the memory their index uses, the time to build it from scratch
+        as when they're read from the datastore, to index one more message, to select the messages to recall, and to
+        assemble the prompt with and without recall.
+    """
+    from worldgpt.server.util import memory
+    from worldgpt.server.util.prompt import assemble_prompt
+    from worldgpt.shared.model.message import Message
+    samples = []
+    for count in messages:
+        character = make_character(count)
+        conversation = make_conversation(count + queries)
+        character.messages.extend(conversation[:count])
+        asked = [Message(role='user', content=x.content) for x in conversation[count:]]
+
+        tracemalloc.start()
+        memory.MemoryIndex().update(character.messages)
+        traced = tracemalloc.get_traced_memory()[1]  # at its peak while building, tracing slows building down.
+        tracemalloc.stop()
+        started = time.perf_counter()
+        memory.get_index(character).update(character.messages)
+        built = time.perf_counter() - started
+
+        selecting, indexing = [], []
+        for query in asked:
+            started = time.perf_counter()
+            memory.recall(character, query.content, len(character.messages), recall_count, recall_tokens, 0.1,
+                          'gpt-3.5-turbo')
+            selecting.append(time.perf_counter() - started)
+        for query in asked:
+            character.messages.append(query)
+            started = time.perf_counter()
+            memory.get_index(character).update(character.messages)
+            indexing.append(time.perf_counter() - started)
+        del character.messages[count:]
+
+        assembling = {}
+        for name, settings in (('without_recall', {}),
+                               ('with_recall', {'recall': recall_count, 'recall_tokens': recall_tokens,
+                                                'min_similarity': 0.1})):
+            assemble_prompt(character, asked[:1], 'gpt-3.5-turbo', 128, False, **settings)  # counts every message.
+            timings = []
+            for query in asked:
+                started = time.perf_counter()
+                assemble_prompt(character, [query], 'gpt-3.5-turbo', 128, False, **settings)
+                timings.append(time.perf_counter() - started)
+            assembling[name] = summarise(timings)
+        index = memory.get_index(character)
+        samples.append({'messages': count,
+                        'index_bytes': index.nbytes,
+                        'index_bytes_per_message': index.nbytes / count,
+                        'peak_traced_bytes_building': traced,
+                        'weights_stored': index.size,
+                        'build_seconds': built,
+                        'index_message_seconds': summarise(indexing),
+                        'select_seconds': summarise(selecting),
+                        'assemble_seconds': assembling})
+    return {'parameters': {'messages': list(messages), 'queries': queries, 'recall_count': recall_count,
+                           'recall_tokens': recall_tokens},
+            'characters': samples}
+
+
+def lore(entries: tuple = (100, 1000, 10000, 100000), turns: int = 200, scanned: int = 5, mentioned: int = 3,
+         lore_tokens: int = 512):
+    """ For each number of entries, each with three triggers of one to three words: the time to index them all, to
+        replace one, and per turn to find those mentioned in the last `scanned` messages and select what fits within
+        lore_tokens. Each turn mentions `mentioned` entries. Nothing is written, the entries are indexed in memory only.
+    """
+    from worldgpt.server.subsystem.lore import LoreBook
+    from worldgpt.shared.model.lore import Lore
+    conversation = make_conversation(turns + scanned, seed=1)
+    samples = []
+    for count in entries:
+        generator = random.Random(count)
+        book = LoreBook()
+        book.entries, book.messages = {}, {}
+        book.triggers = type(book.triggers)()
+        population = [Lore(name=f'entry-{x}', content=f'Entry {x} of the lore of the world. ' * 4, priority=x % 3,
+                           triggers=[f'place{x}', f'the house of name{x}', f'order{x} knights'])
+                      for x in range(count)]
+        texts = []
+        for turn in range(turns):
+            words = '\n'.join(x.content for x in conversation[turn:turn + scanned]).split(' ')
+            for entry in generator.sample(population, min(mentioned, count)):
+                words.insert(generator.randrange(len(words)), generator.choice(entry.triggers))
+            texts.append(' '.join(words))
+
+        started = time.perf_counter()
+        with book.lock.w_locked():
+            for entry in population:
+                book.index(entry)
+        built = time.perf_counter() - started
+
+        changing = []
+        for entry in population[:turns]:
+            started = time.perf_counter()
+            with book.lock.w_locked():
+                book.index(entry)
+            changing.append(time.perf_counter() - started)
+
+        matching, selecting, selected = [], [], []
+        for text in texts:
+            book.select(text, lore_tokens, 'gpt-3.5-turbo')  # counts the tokens of the entries mentioned.
+        for text in texts:
+            started = time.perf_counter()
+            book.match(text)
+            matching.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            selected.append(len(book.select(text, lore_tokens, 'gpt-3.5-turbo')[0]))
+            selecting.append(time.perf_counter() - started)
+        samples.append({'entries': count,
+                        'index_seconds': built,
+                        'replace_entry_seconds': summarise(changing),
+                        'match_seconds': summarise(matching),
+                        'select_seconds': summarise(selecting),
+                        'entries_selected': summarise(selected)})
+    return {'parameters': {'entries': list(entries), 'turns': turns, 'scanned_messages': scanned,
+                           'mentioned_per_turn': mentioned, 'lore_tokens': lore_tokens},
+            'lore': samples}
+
+
+suites = {'completion': completion,
+          'boot': boot,
+          'writes': writes,
+          'memory': memory,
+          'voice': voice,
+          'startup': startup,
+          'recall': recall,
+          'lore': lore}
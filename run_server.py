@@ -1,27 +1,19 @@
 
 
 from worldgpt.server.util.logger import init_logging
-from worldgpt.shared.util.subsystem import Subsystem
+from worldgpt.server.util.bootstrap import bootstrap_configuration, bootstrap_subsystems, shutdown_subsystems
 from worldgpt.server.subsystem.configuration import Configuration
-from worldgpt.server.subsystem.database import Database
 from worldgpt.server.subsystem.api import run_in_main_thread
 
 
-def bootstrap_subsystems():
-    """ Instantiates and Bootstraps all subsystems."""
-    Configuration().bootstrap()
-    Database().bootstrap()
-
-
-def shutdown_subsystems():
-    """ Shuts down all subsystems."""
-    for subcls in Subsystem.__subclasses__():
-        subcls().queue.put(None)
-
-
 def main():
     init_logging()
-    bootstrap_subsystems()
+    bootstrap_configuration()
+    with Configuration().lock.r_locked():
+        workers = Configuration().api_workers or 1
+    if workers == 1:
+        bootstrap_subsystems()
+    # otherwise each worker process bootstraps its own subsystems as it starts, this process only supervises them.
     try:
         while True:
             run_in_main_thread()
@@ -0,0 +1,40 @@
+
+
+""" Fixtures shared by the tests, a server configured within a temporary directory. """
+import json
+import os
+import pytest
+from worldgpt.server.util import tokens
+
+
+class WhitespaceEncoder:
+    """ Counts words as tokens, so the tests don't need to download tiktoken's encodings. """
+    def encode(self, text: str):
+        return text.split()
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """ Bootstrap the Configuration and Database subsystems over a fresh datastore, with the fake LLM backend. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.server.subsystem.database import Database
+    base = tmp_path_factory.mktemp('server')
+    configuration = base / 'configuration.json'
+    configuration.write_text(json.dumps({'configuration': str(configuration),
+                                         'persistence_base': str(base),
+                                         'client_certificate': 'client.pem',
+                                         'client_key': 'client.key',
+                                         'datastore': str(base / 'datastore.db'),
+                                         'llm_backend': 'fake',
+                                         'fake_llm_latency': 0.01,
+                                         'fake_llm_latency_sigma': 0,
+                                         'fake_llm_tokens_per_second': 10000}))
+    os.environ['WorldGPT_CONFPATH'] = str(configuration)
+    encoder = tokens.get_encoder
+    tokens.get_encoder = lambda model=None: WhitespaceEncoder()
+    Configuration().bootstrap()
+    Database().bootstrap()
+    yield base
+    Database().stop(10)
+    Configuration().stop(10)
+    tokens.get_encoder = encoder
@@ -0,0 +1,99 @@
+
+
+""" Tests for the Database subsystem's datastore. """
+import json
+import sqlite3
+import threading
+from worldgpt.server.subsystem.configuration import Configuration
+from worldgpt.server.subsystem.database import Database, SCHEMA_VERSION
+from worldgpt.shared.model.message import Message
+
+# the Character table before messages moved into their own table, schema version 0.
+CHARACTER_V0 = """CREATE TABLE Character(
+                    name varchar primary key not null,
+                    description varchar not null,
+                    rank varchar,
+                    title varchar,
+                    occupation varchar,
+                    age float,
+                    birthdate float,
+                    gender varchar not null,
+                    alignment,
+                    mood varchar,
+                    attributes varchar,
+                    health float,
+                    inventory varchar,
+                    messages varchar not null,
+                    summaries varchar not null,
+                    meta varchar not null
+                );"""
+
+
+def create_v0(path, characters: dict):
+    """ Write a version 0 datastore with the histories of `characters`, {name: [content, ...]}. """
+    with sqlite3.connect(path) as connection:
+        connection.execute(CHARACTER_V0)
+        for name, contents in characters.items():
+            messages = [Message(role='user' if i % 2 == 0 else 'assistant', content=x, timestamp=float(i)).dict()
+                        for i, x in enumerate(contents)]
+            connection.execute('INSERT INTO Character( name, description, gender, attributes, inventory, messages, '
+                               'summaries, meta ) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                               [name, f'{name} description', 'Female', '[]', '[]', json.dumps(messages),
+                                json.dumps(['a summary']), '[]'])
+    connection.close()
+
+
+def test_migrate_v0(server, tmp_path, monkeypatch):
+    """ A version 0 datastore migrates to the current schema and its characters read and write back unchanged. """
+    path = str(tmp_path / 'v0.db')
+    create_v0(path, {'Alice': ['hello', 'hi', 'how are you?'], 'Bob': []})
+    monkeypatch.setattr(Configuration(), 'datastore', path)
+    monkeypatch.setattr(Database(), 'readers', threading.local())
+    Database().migrate()
+
+    connection = sqlite3.connect(path)
+    assert connection.execute('PRAGMA user_version;').fetchone()[0] == SCHEMA_VERSION
+    columns = [x[1] for x in connection.execute('PRAGMA table_info(Character);').fetchall()]
+    assert 'messages' not in columns and 'summarized' in columns
+    assert connection.execute('SELECT sequence, role, content FROM Message WHERE character = ? ORDER BY sequence;',
+                              ['Alice']).fetchall() == [(0, 'user', 'hello'), (1, 'assistant', 'hi'),
+                                                        (2, 'user', 'how are you?')]
+    tables = {x[0] for x in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table';").fetchall()}
+    assert {'Character', 'Message', 'ChangeLog', 'Lore'} <= tables
+    assert 'kind' in [x[1] for x in connection.execute('PRAGMA table_info(ChangeLog);').fetchall()]
+
+    alice = Database().read_character('Alice')
+    assert [x.content for x in alice.messages] == ['hello', 'hi', 'how are you?']
+    assert alice.summaries == ['a summary'] and alice.summarized == 0
+    assert Database().read_character('Bob').messages == []
+
+    alice.messages.append(Message(role='assistant', content='well'))
+    alice.summarized = 2
+    with sqlite3.connect(path) as writer:
+        alice._sequences, alice._stored_row = Database().write_character(writer, alice)
+    writer.close()
+    assert connection.execute('SELECT summarized FROM Character WHERE name = ?;', ['Alice']).fetchone()[0] == 2
+    connection.close()
+    alice = Database().read_character('Alice')
+    assert [x.content for x in alice.messages] == ['hello', 'hi', 'how are you?', 'well']
+    assert alice.summarized == 2
+
+
+def test_migrate_summarized_sequence(server, tmp_path, monkeypatch):
+    """ The number of messages summarized becomes the sequence of the first message after them. """
+    path = str(tmp_path / 'v5.db')
+    create_v0(path, {'Alice': ['a', 'b', 'c', 'd']})
+    monkeypatch.setattr(Configuration(), 'datastore', path)
+    with sqlite3.connect(path, isolation_level=None) as connection:
+        for step in (Database.migrate_messages, Database.migrate_summarized, Database.migrate_changelog,
+                     Database.migrate_search, Database.migrate_lore):
+            step(connection)
+        # a gap left by a deleted message, the boundary is after the second remaining message.
+        connection.execute("DELETE FROM Message WHERE character = 'Alice' AND sequence = 1;")
+        connection.execute("UPDATE Character SET summarized = 2 WHERE name = 'Alice';")
+        connection.execute('PRAGMA user_version = 5;')
+    connection.close()
+    Database().migrate()
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT summarized FROM Character WHERE name = 'Alice';").fetchone()[0] == 3
+    connection.close()
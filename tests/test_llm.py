@@ -0,0 +1,44 @@
+
+
+""" Tests for completions, as they're applied to a character's history. """
+import asyncio
+import threading
+import time
+from worldgpt.server.subsystem.database import Database
+from worldgpt.server.util import llm
+from worldgpt.shared.model.character import Character
+from worldgpt.shared.model.message import Message
+
+
+def test_concurrent_completions(server):
+    """ Completions of the same character, from both the event loop and threads, take turns so each user message is
+        followed by its reply.
+    """
+    Database().store(Character(name='Concurrent', description='A busy character.', gender='Male'))
+    character = Database().get_character('Concurrent')
+
+    def complete(i):
+        llm.generate_chat_completion(character, [Message(role='user', content=f'thread {i}')])
+
+    async def main():
+        threads = [threading.Thread(target=complete, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        await asyncio.gather(*[llm.agenerate_chat_completion(character, [Message(role='user', content=f'task {i}')])
+                               for i in range(4)])
+        for thread in threads:
+            thread.join()
+
+    asyncio.run(main())
+    messages = character.messages
+    assert len(messages) == 16
+    for user, assistant in zip(messages[::2], messages[1::2]):
+        assert user.role == 'user' and assistant.role == 'assistant'
+    assert sorted(x.content for x in messages[::2]) == sorted([f'thread {i}' for i in range(4)] +
+                                                              [f'task {i}' for i in range(4)])
+
+    deadline = time.monotonic() + 5
+    while Database().dirty and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stored = Database().read_character('Concurrent')
+    assert [x.content for x in stored.messages] == [x.content for x in messages]
@@ -0,0 +1,13 @@
+
+
+""" Tests for the Message model. """
+import time
+from worldgpt.shared.model.message import Message
+
+
+def test_timestamp_default():
+    """ A message is timestamped when it's made, rather than when the module was imported. """
+    before = time.time()
+    message = Message(role='user', content='hello')
+    assert before <= message.timestamp <= time.time()
+    assert Message(role='user', content='hello', timestamp=1.0).timestamp == 1.0
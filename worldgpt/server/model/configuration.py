@@ -2,8 +2,9 @@
 
 
 import os
+from typing import Dict, Literal, Optional
 from pydantic.types import Path
-from pydantic import conint
+from pydantic import conint, confloat
 from worldgpt.shared.model.configuration import Configuration
 from pydantic.networks import IPvAnyAddress
 
@@ -23,6 +24,65 @@ class ServerConfiguration(Configuration):
 
     api_listen_host: str | IPvAnyAddress = "localhost"
     api_listen_port: conint(gt=0, le=65535) = 8001
+    api_workers: conint(gt=0) = 1  # processes serving the API, see worldgpt/server/util/bootstrap.py
 
+    # per Subsystem by class name, ex: {"Summarizer": 2}, see worldgpt/shared/util/task_queue.py for the policies.
+    subsystem_workers: Dict[str, conint(gt=0)] = {}  # threads consuming the queue, some subsystems allow only one
+    subsystem_queue_sizes: Dict[str, conint(ge=0)] = {}  # most tasks queued, 0 for no bound
+    subsystem_overflow: Dict[str, Literal['block', 'drop_oldest', 'reject']] = {}  # what happens once a queue is full
+    subsystem_stop_timeout: confloat(gt=0) = 30.0  # seconds each subsystem is given to finish its work when stopping
+
+    database_batch_size: conint(gt=0) = 64  # most characters written per transaction by the Database worker
+    database_flush_interval: confloat(gt=0) = 0.05  # seconds a write may wait for a batch to fill before flushing
+    database_cache_size: conint(gt=0) = 1024  # most characters kept in memory, others are read when needed
+    database_cache_bytes: conint(ge=0) = 0  # most estimated bytes of characters kept in memory, 0 for no limit
+    database_change_poll_interval: confloat(gt=0) = 0.25  # seconds between checks for other processes' writes
+    database_changelog_retention: confloat(gt=0) = 300.0  # seconds writes are kept in the ChangeLog for other processes
+    database_import_batch_size: conint(gt=0) = 500  # characters written per transaction by a bulk import
+    database_export_page_size: conint(gt=0) = 500  # characters read per page by a bulk export
+
+    llm_backend: str = 'openai'  # see worldgpt/server/util/backend.py, 'fake' for load testing without a real LM
+    llm_max_concurrency: conint(gt=0) = 64  # upstream LLM requests in flight across all models
+    llm_model_concurrency: Dict[str, conint(gt=0)] = {}  # optional tighter limit per model, ex: {"gpt-4": 8}
+
+    fake_llm_latency: confloat(ge=0) = 0.5  # median seconds before the fake LM's first token
+    fake_llm_latency_sigma: confloat(ge=0) = 0.5  # spread of the lognormal latency, 0 for a fixed latency
+    fake_llm_tokens_per_second: confloat(gt=0) = 50.0
+    fake_llm_failure_rate: confloat(ge=0, le=1) = 0.0  # chance a fake request fails
+    fake_llm_seed: Optional[int] = None  # seed for fake latency and failures, the responses are always deterministic
+
+    completion_cache_enabled: bool = False  # answer repeated prompts from the completion cache
+    completion_cache_ttl: confloat(gt=0) = 3600.0  # seconds a cached response is used for
+    completion_cache_size: conint(gt=0) = 4096  # most responses kept in memory
+    completion_cache_bytes: conint(ge=0) = 0  # most bytes of responses kept in memory, 0 for no limit
+    completion_cache_datastore: str = ''  # SQLite datastore that keeps responses between runs, empty for memory only
+    completion_cache_persistent_size: conint(gt=0) = 100000  # most responses kept in the datastore
+
+    memory_recall: conint(ge=0) = 0  # most past messages recalled into a prompt by relevance to the player, 0 for none
+    memory_max_tokens: conint(ge=0) = 512  # most tokens recalled messages may use
+    memory_min_similarity: confloat(ge=0, le=1) = 0.1  # least similarity to the player's input a recalled message has
+
+    lore_max_tokens: conint(ge=0) = 512  # most tokens of world lore sent with a prompt, 0 for none
+    lore_scan_messages: conint(ge=0) = 4  # recent messages of the history searched for lore, besides the new ones
+
+    summarizer_model: str = 'gpt-3.5-turbo'
+    summarizer_threshold_tokens: conint(gt=0) = 2048  # summarize once a character's unsummarized history exceeds this
+    summarizer_keep_tokens: conint(ge=0) = 512  # the most recent history that is kept verbatim when summarizing
+    summarizer_max_tokens: conint(gt=0) = 256  # the longest a summary may be
+    summarizer_max_deferral: confloat(ge=0) = 30.0  # seconds summarizing waits for player completions to finish
+
+    tts_backend: str = 'local'  # see worldgpt/server/util/tts.py, 'elevenlabs' for ElevenLabs
+    tts_voice: str = ''  # the voice used when a request doesn't name one, for elevenlabs the voice id
+    tts_voice_settings: Dict[str, float] = {}  # passed to the backend, ex: {"stability": 0.5, "similarity_boost": 0.75}
+    tts_max_concurrency: conint(gt=0) = 4  # sentences of one response synthesized at once
+    tts_min_sentence_chars: conint(ge=0) = 24  # shorter sentences are joined to the next before synthesis
+    tts_local_latency: confloat(ge=0) = 0.2  # seconds before the local stand-in synthesizer returns audio
+    tts_local_seconds_per_char: confloat(ge=0) = 0.002  # seconds the local synthesizer adds per character
+
+    voice_cache_enabled: bool = True  # keep synthesized audio in persistence/voice/cache to reuse it
+    voice_cache_bytes: conint(gt=0) = 512 * 1024 * 1024  # most bytes of audio kept, least recently used are removed
+    voice_cache_rescan_interval: confloat(gt=0) = 60.0  # seconds between indexing a cache shared between processes
+
+    elevenlabs_model: str = 'eleven_monolingual_v1'
     elevenlabs_api_key: str = ""
     openai_api_key: str = ""
\ No newline at end of file
@@ -13,15 +13,24 @@
 """
 
 
+import json
+import logging
 import os
+import sqlite3
+from collections import Counter
 from typing import Literal, List
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import conint
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from worldgpt.shared.model.character import Character
+from worldgpt.shared.model.lore import Lore
 from worldgpt.shared.model.message import Message
 from worldgpt.shared.util import about
+from worldgpt.shared.util.task_queue import Overloaded
 
 
 application = FastAPI()
@@ -42,6 +51,25 @@ application.add_middleware(
 )
 
 
+@application.exception_handler(Overloaded)
+def overloaded(request: Request, error: Overloaded):
+    """ A subsystem's queue is full and set to reject more work, the client should try again shortly. """
+    return JSONResponse({'error': str(error)}, status_code=503, headers={'Retry-After': '1'})
+
+
+def conditional_response(request: Request, version: str, build):
+    """ Respond with 304 Not Modified if the client already has this version, otherwise build the content.
+        The version is sent as a weak ETag, clients send it back with If-None-Match.
+    """
+    etag = f'W/"{version}"'
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        tags = [x.strip() for x in if_none_match.split(',')]
+        if '*' in tags or etag in tags or etag[2:] in tags:
+            return Response(status_code=304, headers={'ETag': etag})
+    return JSONResponse(jsonable_encoder(build()), headers={'ETag': etag})
+
+
 @application.get("/")
 def root():
     return {"title": about.__TITLE__,
@@ -50,84 +78,423 @@ def root():
             "author": about.__AUTHOR__}
 
 
+@application.get("/status/database")
+def get_database_status():
+    """ Returns the Database worker's queue depth and flush timings."""
+    from worldgpt.server.subsystem.database import Database
+    return Database().get_statistics()
+
+
+@application.get("/metrics")
+def get_metrics():
+    """ Returns the server's metrics in the Prometheus text format."""
+    from worldgpt.shared.util.metrics import render
+    import worldgpt.server.util.llm  # noqa: F401, the completion metrics are made when it's imported.
+    return Response(render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@application.get("/status/startup")
+def get_startup_status():
+    """ Returns the time each subsystem took to bootstrap."""
+    from worldgpt.server.util.bootstrap import get_startup_report
+    return get_startup_report()
+
+
+@application.get("/status/audio_cache")
+def get_audio_cache_status():
+    """ Returns the audio cache's hit rate and size on disk."""
+    from worldgpt.server.subsystem.audio_cache import AudioCache
+    return AudioCache().get_statistics()
+
+
+@application.get("/status/completion_cache")
+def get_completion_cache_status():
+    """ Returns the completion cache's hit rate and size."""
+    from worldgpt.server.subsystem.completion_cache import CompletionCache
+    return CompletionCache().get_statistics()
+
+
 @application.get("/characters")
-def get_characters():
-    """ Returns a list of all characters."""
+def get_characters(request: Request,
+                   cursor: str | None = None,
+                   limit: conint(gt=0, le=500) = 100,
+                   fields: str | None = None,
+                   messages: conint(ge=0) | None = None):
+    """ Returns a page of characters ordered by name.
+        cursor: the `next_cursor` of the previous page, omit for the first page.
+        fields: comma separated fields to include, ex: "name,occupation". defaults to every field but messages.
+        messages: include the most recent messages of each character, history is omitted unless requested.
+        Supports If-None-Match, the ETag changes whenever any character is written.
+    """
     from worldgpt.server.subsystem.database import Database
-    output = {}
-    with Database().lock.r_locked():
-        characters = dict(Database().characters)
-    for character in characters:
-        output[character] = characters[character].dict()
-    return output
+    if fields is not None:
+        fields = [x.strip() for x in fields.split(',') if x.strip()]
+        unknown = [x for x in fields if x not in Character.__fields__]
+        if unknown:
+            return {'error': f'Unknown fields: {", ".join(unknown)}'}
+        if 'messages' in fields and messages is None:
+            return {'error': 'Use the messages parameter to include messages.'}
+
+    def build():
+        characters, next_cursor = Database().list_characters(cursor, limit, fields, messages)
+        return {'characters': characters, 'next_cursor': next_cursor}
+    return conditional_response(request, Database().get_version(), build)
 
 
 @application.post('/characters/new')
 def create_character(character: Character):
     """ Creates a new character."""
     from worldgpt.server.subsystem.database import Database
-    with Database().lock.r_locked():
-        characters = dict(Database().characters)
-    if character.name in characters:
+    if character.name in Database().names:
         return {'error': 'Character already exists.'}
-    Database().queue.put(character)
+    Database().store(character)
     return {'success': 'Character created.'}
 
 
+@application.post('/characters/import')
+async def import_characters(request: Request, replace: bool = False):
+    """ Imports characters from NDJSON, one character per line as /characters/new accepts them.
+        The body is read and written as it arrives, so imports of any size are fine.
+        replace: replace characters that already exist, otherwise they're reported as errors.
+        Returns how many were imported and the line, name and reason of each that failed.
+    """
+    from worldgpt.server.util.bulk import import_characters
+    return await import_characters(request.stream(), replace)
+
+
+@application.get('/characters/export')
+def export_characters(messages: bool = True):
+    """ Exports every character as NDJSON ordered by name, in the form /characters/import accepts.
+        messages: include each character's messages.
+    """
+    from worldgpt.server.util.bulk import export_characters
+    return StreamingResponse(export_characters(messages), media_type='application/x-ndjson')
+
+
 @application.delete('/characters/{name}')
 def delete_character(name: str):
     """ Deletes a character."""
     from worldgpt.server.subsystem.database import Database
-    with Database().lock.r_locked():
-        characters = dict(Database().characters)
-    if name not in characters:
+    if name not in Database().names:
         return {'error': 'Character does not exist.'}
     # todo deletion request to queue. return {'success': 'Character deleted.'}
     return {'error': 'Not implemented.'}
 
 
 @application.get('/characters/prompts/{name}')
-def get_character_prompts(name: str):
-    """ Returns a list of all prompts for a character."""
+def get_character_prompts(request: Request, name: str, model: Literal['gpt-3.5-turbo'] = 'gpt-3.5-turbo'):
+    """ Returns the prompt that would be sent to the LM for a character, without any messages from the player: the
+        character information, lore, summaries and as much of the recent history as fits the model.
+        Supports If-None-Match, the ETag changes whenever the character or the lore is written.
+    """
     from worldgpt.server.subsystem.database import Database
-    with Database().lock.r_locked():
-        characters = dict(Database().characters)
-    if name not in characters:
+    from worldgpt.server.subsystem.lore import LoreBook
+    from worldgpt.server.util.llm import get_prompt_settings
+    from worldgpt.server.util.prompt import PromptTooLarge, assemble_messages
+    if name not in Database().names:
         return {'error': 'Character does not exist.'}
-    messages = characters[name].to_prompt_messages()
-    output = []
-    for message in messages:
-        output.append(message.json())
-    return output
+
+    def build():
+        character = Database().get_character(name)
+        try:
+            messages, _ = assemble_messages(character, [], model, **get_prompt_settings())
+        except PromptTooLarge:
+            return {'error': 'Prompt exceeds the token limit of the model.'}
+        output = []
+        for message in messages:
+            output.append(message.json())
+        return output
+    return conditional_response(request, f'{Database().get_version(name)}.{LoreBook().version}.{model}', build)
+
+
+@application.get('/lore')
+def get_lore(cursor: str | None = None, limit: conint(gt=0, le=500) = 100):
+    """ Returns a page of the world's lore ordered by name.
+        cursor: the `next_cursor` of the previous page, omit for the first page.
+    """
+    from worldgpt.server.subsystem.lore import LoreBook
+    entries, next_cursor = LoreBook().list_entries(cursor, limit)
+    return {'lore': entries, 'next_cursor': next_cursor}
+
+
+@application.post('/lore')
+def store_lore(entries: List[Lore]):
+    """ Adds entries of lore, or replaces those of the same name. Any number may be sent at once. """
+    from worldgpt.server.subsystem.lore import LoreBook
+    duplicates = sorted(name for name, count in Counter(x.name for x in entries).items() if count > 1)
+    if duplicates:
+        return {'error': f'Entries with the same name: {", ".join(duplicates)}'}
+    LoreBook().store(entries)
+    return {'success': f'{len(entries)} entries of lore stored.'}
+
+
+@application.get('/lore/match')
+def match_lore(text: str):
+    """ Returns the names of the entries of lore the text mentions, in the order they would be sent to the LM. """
+    from worldgpt.server.subsystem.lore import LoreBook
+    return {'lore': LoreBook().match(text)}
+
+
+@application.get('/lore/{name}')
+def get_lore_entry(name: str):
+    """ Returns an entry of lore. """
+    from worldgpt.server.subsystem.lore import LoreBook
+    entry = LoreBook().get(name)
+    if entry is None:
+        return {'error': 'Lore does not exist.'}
+    return entry
+
+
+@application.delete('/lore/{name}')
+def delete_lore(name: str):
+    """ Deletes an entry of lore. """
+    from worldgpt.server.subsystem.lore import LoreBook
+    if not LoreBook().delete(name):
+        return {'error': 'Lore does not exist.'}
+    return {'success': 'Lore deleted.'}
+
+
+@application.get('/messages/search')
+def search_messages(q: str,
+                    character: str | None = None,
+                    role: Literal['user', 'system', 'assistant'] | None = None,
+                    since: float | None = None,
+                    until: float | None = None,
+                    limit: conint(gt=0, le=100) = 20,
+                    offset: conint(ge=0) = 0,
+                    syntax: bool = False):
+    """ Search the content of every character's messages, best match first.
+        q: the words to find, each must appear. with syntax, an FTS5 query instead, ex: "dragon NEAR/5 gold" OR sword*
+        character, role: only messages of this character, or this role.
+        since, until: only messages from this timestamp, or before this timestamp.
+        offset: the `next_offset` of the previous page, omit for the first page.
+        Each result has a snippet of the content with the matches in [brackets].
+    """
+    from worldgpt.server.subsystem.database import Database
+    if not Database().searchable:
+        return {'error': 'Search is unavailable, SQLite was built without FTS5.'}
+    if not syntax:
+        q = ' '.join('"' + x.replace('"', '""') + '"' for x in q.split())
+    if not q:
+        return {'error': 'Nothing to search for.'}
+    try:
+        results, next_offset = Database().search_messages(q, character, role, since, until, limit, offset)
+    except sqlite3.OperationalError as e:
+        return {'error': f'Invalid search: {e}'}
+    return {'results': results, 'next_offset': next_offset}
 
 
 @application.post('/generate/openai/llm_completion')
-def generate_llm_completion(character: str,
+async def generate_llm_completion(character: str,
                             messages: List[Message],
-                            model: Literal['gpt-3.5-turbo'] = 'gpt-3.5-turbo'):
-    """ Generates a completion from a message using the LLM model."""
+                            model: Literal['gpt-3.5-turbo'] = 'gpt-3.5-turbo',
+                            max_tokens: conint(gt=0) = 128,
+                            dynamic_max_tokens: bool = False,
+                            cache: bool = True):
+    """ Generates a completion from a message using the LLM model.
+        With dynamic_max_tokens the response may use whatever the prompt leaves of the model's token limit.
+        With cache false the response always comes from the LM, even if the completion cache is enabled.
+    """
     from worldgpt.server.subsystem.database import Database
-    with Database().lock.r_locked():
-        characters = dict(Database().characters)
-    if character not in characters:
+    name, character = character, await Database().aget_character(character)
+    if character is None:
         return {'error': 'Character does not exist.'}
     for message in messages:
         if message.content == '':
             return {'error': 'Message is empty.'}
         if len(message.content) > 2048:
             return {'error': 'Message is too long.'}
-    from worldgpt.server.util.llm import generate_chat_completion
-    resp = generate_chat_completion(characters[character], external_messages=messages, model=model)
+    from worldgpt.server.util.llm import agenerate_chat_completion
+    from worldgpt.server.util.backend import BackendError
+    from worldgpt.server.util.prompt import PromptTooLarge
+    try:
+        resp = await agenerate_chat_completion(character, external_messages=messages, model=model,
+                                               max_tokens=max_tokens, dynamic_max_tokens=dynamic_max_tokens,
+                                               cache=cache)
+    except PromptTooLarge:
+        return {'error': 'Prompt exceeds the token limit of the model.'}
+    except BackendError as e:
+        logging.error(f'Error generating completion for {name}: {e}')
+        return {'error': 'Completion failed.'}
     return {'completion': resp.json()}
 
 
+@application.post('/generate/openai/llm_completion/stream')
+async def stream_llm_completion(character: str,
+                                messages: List[Message],
+                                model: Literal['gpt-3.5-turbo'] = 'gpt-3.5-turbo',
+                                max_tokens: conint(gt=0) = 128,
+                                dynamic_max_tokens: bool = False,
+                                cache: bool = True):
+    """ Generates a completion from a message using the LLM model, streamed back as Server-Sent Events.
+        Each piece of content is sent as it arrives in a `message` event: {"content": "..."}
+        The stream ends with a `done` event containing the full completion, or an `error` event.
+    """
+    from worldgpt.server.subsystem.database import Database
+    name, character = character, await Database().aget_character(character)
+    if character is None:
+        return {'error': 'Character does not exist.'}
+    for message in messages:
+        if message.content == '':
+            return {'error': 'Message is empty.'}
+        if len(message.content) > 2048:
+            return {'error': 'Message is too long.'}
+    from worldgpt.server.util.llm import astream_chat_completion
+    from worldgpt.server.util.prompt import PromptTooLarge
+
+    async def events():
+        content = []
+        try:
+            async for delta in astream_chat_completion(character, external_messages=messages, model=model,
+                                                       max_tokens=max_tokens, dynamic_max_tokens=dynamic_max_tokens,
+                                                       cache=cache):
+                content.append(delta)
+                yield f"data: {json.dumps({'content': delta})}\n\n"
+        except PromptTooLarge:
+            yield f"event: error\ndata: {json.dumps({'error': 'Prompt exceeds the token limit of the model.'})}\n\n"
+            return
+        except Exception as e:
+            logging.error(f'Error streaming completion for {name}: {e}')
+            yield f"event: error\ndata: {json.dumps({'error': 'Completion failed.'})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'completion': ''.join(content)})}\n\n"
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@application.post('/generate/openai/llm_completion/voice')
+async def voice_llm_completion(character: str,
+                               messages: List[Message],
+                               voice: str | None = None,
+                               model: Literal['gpt-3.5-turbo'] = 'gpt-3.5-turbo',
+                               max_tokens: conint(gt=0) = 128,
+                               dynamic_max_tokens: bool = False,
+                               cache: bool = True,
+                               inline_audio: bool = True):
+    """ Generates a completion from a message using the LLM model and speaks it, streamed back as Server-Sent Events.
+        Synthesis of each sentence starts as soon as the LM has finished it, rather than once the completion has.
+        Each piece of content is sent as it arrives in a `message` event: {"content": "..."}
+        The audio of each sentence is sent in order in an `audio` event:
+            {"index": 0, "text": "...", "media_type": "audio/mpeg", "audio": "<base64>", "clip": "/voice/clips/..."}
+        The stream ends with a `done` event containing the full completion, or an `error` event.
+        voice defaults to the configured `tts_voice`.
+        clip is where the audio can be fetched from while it's in the audio cache, null if the cache is disabled.
+        With inline_audio false, audio is left out of events that have a clip and is fetched from there instead.
+    """
+    from worldgpt.server.subsystem.database import Database
+    name, character = character, await Database().aget_character(character)
+    if character is None:
+        return {'error': 'Character does not exist.'}
+    for message in messages:
+        if message.content == '':
+            return {'error': 'Message is empty.'}
+        if len(message.content) > 2048:
+            return {'error': 'Message is too long.'}
+    import base64
+    from worldgpt.server.util.llm import astream_chat_completion
+    from worldgpt.server.util.prompt import PromptTooLarge
+    from worldgpt.server.util.tts import TTSError, get_tts_backend
+    from worldgpt.server.util.voice import synthesize_stream
+    backend = get_tts_backend()
+
+    async def events():
+        deltas = astream_chat_completion(character, external_messages=messages, model=model, max_tokens=max_tokens,
+                                         dynamic_max_tokens=dynamic_max_tokens, cache=cache)
+        try:
+            async for event in synthesize_stream(deltas, voice=voice, backend=backend, load=inline_audio):
+                if event[0] == 'content':
+                    yield f"data: {json.dumps({'content': event[1]})}\n\n"
+                elif event[0] == 'audio':
+                    _, index, text, audio, key = event
+                    data = {'index': index, 'text': text, 'media_type': backend.media_type,
+                            'clip': f'/voice/clips/{key}' if key else None}
+                    if inline_audio or not key:
+                        data['audio'] = base64.b64encode(audio).decode()
+                    yield f"event: audio\ndata: {json.dumps(data)}\n\n"
+                elif event[0] == 'done':
+                    yield f"event: done\ndata: {json.dumps({'completion': event[1]})}\n\n"
+        except PromptTooLarge:
+            yield f"event: error\ndata: {json.dumps({'error': 'Prompt exceeds the token limit of the model.'})}\n\n"
+        except TTSError as e:
+            logging.error(f'Error synthesizing completion for {name}: {e}')
+            yield f"event: error\ndata: {json.dumps({'error': 'Voice synthesis failed.'})}\n\n"
+        except Exception as e:
+            logging.error(f'Error streaming completion for {name}: {e}')
+            yield f"event: error\ndata: {json.dumps({'error': 'Completion failed.'})}\n\n"
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@application.get('/voice/clips/{key}')
+def get_voice_clip(request: Request, key: str):
+    """ Serve a clip from the audio cache, supporting byte ranges. Clips never change, so they may be cached forever.
+    """
+    import mimetypes
+    from worldgpt.server.subsystem.audio_cache import AudioCache
+    from worldgpt.server.util.file_response import file_response
+    path = AudioCache().locate(key)
+    if path is None or not os.path.isfile(path):
+        return JSONResponse({'error': 'Clip does not exist.'}, status_code=404)
+    return file_response(request, path, mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                         headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+@application.get('/voice/fillers/{path:path}')
+def get_voice_filler(request: Request, path: str):
+    """ Serve a filler message from `persistence/voice/fillers`, supporting byte ranges.
+        Filler messages are streamed to the client while a response is still being generated.
+    """
+    import mimetypes
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.server.util.file_response import file_response, resolve_within
+    with Configuration().lock.r_locked():
+        directory = os.path.join(Configuration().persistence_base, 'voice', 'fillers')
+    resolved = resolve_within(directory, path)
+    if resolved is None:
+        return JSONResponse({'error': 'Filler does not exist.'}, status_code=404)
+    return file_response(request, resolved, mimetypes.guess_type(resolved)[0] or 'application/octet-stream',
+                         headers={'Cache-Control': 'public, max-age=3600'})
+
+
+@application.on_event('startup')
+def bootstrap_worker():
+    """ Bootstrap the subsystems of a worker process, when serving with several. """
+    from worldgpt.server.util.bootstrap import bootstrap_subsystems, bootstrapped
+    if not bootstrapped():
+        from worldgpt.server.util.logger import init_logging
+        init_logging()
+        bootstrap_subsystems()
+        application.state.owns_subsystems = True
+
+
+@application.on_event('shutdown')
+def shutdown_worker():
+    """ Stop the subsystems of a worker process once they've finished their work, the process exits after. """
+    if getattr(application.state, 'owns_subsystems', False):
+        from worldgpt.server.util.bootstrap import shutdown_subsystems
+        shutdown_subsystems()
+
+
+@application.on_event('shutdown')
+async def close_llm_backends():
+    """ Close the pooled upstream sessions when the server stops. """
+    from worldgpt.server.util.backend import close_backends
+    from worldgpt.server.util.tts import close_tts_backends
+    await close_backends()
+    await close_tts_backends()
+
+
 def run_in_main_thread():
     import uvicorn
     from worldgpt.server.subsystem.configuration import Configuration
     with Configuration().lock.r_locked():
         api_listen_host = Configuration().api_listen_host or "127.0.0.1"
         api_listen_port = Configuration().api_listen_port or 8000
+        api_workers = Configuration().api_workers or 1
     uvicorn.run('worldgpt.server.subsystem.api:application',
                 host=os.environ.get('wgpt_listen_address', api_listen_host),
                 port=os.environ.get('wgpt_listen_port', api_listen_port),
+                workers=api_workers,
                 )
@@ -0,0 +1,206 @@
+
+
+"""
+    Audio Cache
+    ===========
+
+    Synthesized audio is kept on disk under `persistence/voice/cache`, named by a hash of everything that decides it:
+    the backend, the voice, the text and the voice settings. A line a character has spoken before is then served from
+    disk rather than synthesized again, which costs both money and latency.
+
+    The cache holds at most `voice_cache_bytes` of audio, the least recently used clips are removed by the worker once
+    it's over. Recency is kept in memory and in the modification time of each clip, so it survives a restart.
+
+    When several processes share the cache, each finds the clips the others have written on disk, while only the leader
+    removes clips, indexing the whole cache again every `voice_cache_rescan_interval` seconds to see all of them.
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from worldgpt.shared.util.singleton import Singleton
+from worldgpt.shared.util.subsystem import Subsystem
+from worldgpt.shared.util.task_queue import LOW
+
+
+key_pattern = re.compile(r'^[0-9a-f]{64}$')
+
+
+class AudioCache(Subsystem, metaclass=Singleton):
+
+    queue_size = 10000
+    overflow = 'drop_oldest'  # touching a clip only keeps it from eviction a while longer.
+
+    def __init__(self):
+        super().__init__()
+        self.directory: str | None = None
+        self.clips: OrderedDict = OrderedDict()  # key: (path, size), least recently used first.
+        self.clips_bytes = 0
+        self.clips_lock = threading.Lock()
+        self.statistics = {'hits': 0, 'misses': 0, 'stored': 0, 'evictions': 0}
+        self.shared = False  # whether other processes use the cache.
+        self.leader = True  # only the leader removes clips.
+
+    def get_settings(self):
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return {'enabled': bool(Configuration().voice_cache_enabled),
+                    'bytes': Configuration().voice_cache_bytes or 512 * 1024 * 1024,
+                    'directory': os.path.join(Configuration().persistence_base, 'voice', 'cache'),
+                    'rescan_interval': Configuration().voice_cache_rescan_interval or 60.0}
+
+    def bootstrap(self):
+        logging.info('bootstrapping AudioCache')
+        self.directory = self.get_settings()['directory']
+        os.makedirs(self.directory, exist_ok=True)
+        self.load_clips()
+        self.active = True
+        self.start_workers()
+        self.queue.put('evict')
+
+    def load_clips(self):
+        """ Index the clips on disk, oldest first. Partly written clips left by a crash are removed. """
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.join(root, file)
+                key = file.split('.', 1)[0]
+                if file.endswith('.tmp') or not key_pattern.match(key):
+                    if file.endswith('.tmp') and not self.shared:
+                        os.remove(path)
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # removed since it was listed.
+                found.append((stat.st_mtime, key, path, stat.st_size))
+        with self.clips_lock:
+            self.clips.clear()
+            self.clips_bytes = 0
+            for _, key, path, size in sorted(found):
+                self.clips[key] = (path, size)
+                self.clips_bytes += size
+        logging.info(f'Indexed {len(found)} cached clips, {self.clips_bytes} bytes')
+
+    def enabled(self):
+        return self.active and self.get_settings()['enabled']
+
+    @staticmethod
+    def make_key(backend: str, voice: str, text: str, settings: dict):
+        """ A canonical hash of everything that decides the audio of a clip. """
+        request = json.dumps({'backend': backend, 'voice': voice, 'text': text, 'settings': settings},
+                             sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def clip_path(self, key: str, extension: str):
+        return os.path.join(self.directory, key[:2], f'{key}.{extension}')
+
+    def get(self, key: str, extension: str):
+        """ Returns the path of a cached clip, or None. """
+        if self.shared:
+            self.refresh(key, extension)
+        with self.clips_lock:
+            clip = self.clips.get(key)
+            if clip is None:
+                self.statistics['misses'] += 1
+                return None
+            self.clips.move_to_end(key)
+            self.statistics['hits'] += 1
+        self.queue.put(('touch', clip[0]), priority=LOW)
+        return clip[0]
+
+    def refresh(self, key: str, extension: str):
+        """ Bring the index of a clip up to date with the disk, another process may have written or removed it. """
+        path = self.clip_path(key, extension)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = None
+        with self.clips_lock:
+            if key in self.clips and size is None:
+                self.clips_bytes -= self.clips.pop(key)[1]
+            elif key not in self.clips and size is not None:
+                self.clips[key] = (path, size)
+                self.clips_bytes += size
+
+    def locate(self, key: str):
+        """ Returns the path of a cached clip to serve, or None, without counting it as a use by the pipeline. """
+        if not key_pattern.match(key):
+            return None
+        with self.clips_lock:
+            clip = self.clips.get(key)
+        return clip[0] if clip is not None else None
+
+    def store(self, key: str, audio: bytes, extension: str):
+        """ Write a clip to the cache, returns its path. This blocks on the disk, call it from a thread.
+            The clip is written to a temporary file and moved into place, so a clip that exists is always complete.
+        """
+        path = self.clip_path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as clipfd:
+            clipfd.write(audio)
+        os.replace(temporary, path)
+        with self.clips_lock:
+            if key in self.clips:
+                self.clips_bytes -= self.clips.pop(key)[1]
+            self.clips[key] = (path, len(audio))
+            self.clips_bytes += len(audio)
+            self.statistics['stored'] += 1
+        self.queue.put('evict')
+        return path
+
+    def evict(self):
+        """ Remove the least recently used clips until the cache is within its size. """
+        if not self.leader:
+            return
+        limit = self.get_settings()['bytes']
+        while True:
+            with self.clips_lock:
+                if self.clips_bytes <= limit or len(self.clips) <= 1:
+                    return
+                key, (path, size) = self.clips.popitem(last=False)
+                self.clips_bytes -= size
+                self.statistics['evictions'] += 1
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error(f'Failed to remove cached clip {path}: {e}')
+
+    def get_statistics(self):
+        lookups = self.statistics['hits'] + self.statistics['misses']
+        return dict(self.statistics,
+                    enabled=self.enabled(),
+                    hit_rate=self.statistics['hits'] / lookups if lookups else None,
+                    clips=len(self.clips),
+                    clips_bytes=self.clips_bytes)
+
+    def do_work(self):
+        while self.active:
+            try:
+                # the leader of a shared cache indexes it again now and then, to see what the others have written.
+                task = self.queue.get(timeout=self.get_settings()['rescan_interval']
+                                      if self.shared and self.leader else None)
+            except queue.Empty:
+                self.load_clips()
+                self.evict()
+                continue
+            if task is None:
+                self.shutdown()
+                break
+
+            if task == 'evict':
+                self.evict()
+            elif isinstance(task, tuple) and task[0] == 'touch':
+                now = time.time()
+                try:
+                    os.utime(task[1], (now, now))
+                except OSError:
+                    pass  # evicted since.
@@ -0,0 +1,210 @@
+
+
+"""
+    Completion Cache
+    ================
+
+    Many interactions with a character are near identical, a greeting or a shopkeeper's line asked of the same character
+    in the same state. The completion cache remembers the response to a prompt, so these are answered without a round
+    trip to the LM.
+
+    Responses are keyed on a hash of the backend, the model, the prompt as it's sent to the LM and the sampling
+    parameters, so a prompt is only ever answered from the cache if the LM would have been sent exactly the same
+    request. Entries expire after `completion_cache_ttl` seconds and the least recently used are evicted once the cache
+    holds `completion_cache_size` entries, or `completion_cache_bytes` of responses.
+
+    With `completion_cache_datastore` set, responses are also written to an SQLite datastore by the worker, which
+    outlives the process and holds up to `completion_cache_persistent_size` responses. Lookups that miss in memory
+    are read from there.
+
+    The cache is opt-in, see `completion_cache_enabled`, and may be bypassed per request.
+"""
+
+
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from worldgpt.shared.util.singleton import Singleton
+from worldgpt.shared.util.subsystem import Subsystem
+
+
+class CompletionCache(Subsystem, metaclass=Singleton):
+
+    max_workers = 1  # the worker owns the connection to the persistent tier.
+    queue_size = 10000
+    overflow = 'drop_oldest'  # a response that isn't persisted is only asked for again.
+
+    def __init__(self):
+        super().__init__()
+        self.entries: OrderedDict = OrderedDict()  # key: (expires, response, size), least recently used first.
+        self.entries_bytes = 0
+        self.entries_lock = threading.Lock()
+        self.datastore: str | None = None  # set by bootstrap when the persistent tier is configured.
+        self.connection: sqlite3.Connection | None = None  # owned by the worker.
+        self.readers = threading.local()  # a read connection per thread, see `reader`.
+        self.statistics = {'hits': 0,
+                           'persistent_hits': 0,
+                           'misses': 0,
+                           'bypassed': 0,
+                           'stored': 0,
+                           'expired': 0,
+                           'evictions': 0}
+
+    def get_settings(self):
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return {'enabled': bool(Configuration().completion_cache_enabled),
+                    'ttl': Configuration().completion_cache_ttl or 3600.0,
+                    'size': Configuration().completion_cache_size or 4096,
+                    'bytes': Configuration().completion_cache_bytes or 0,
+                    'datastore': Configuration().completion_cache_datastore or None,
+                    'persistent_size': Configuration().completion_cache_persistent_size or 100000}
+
+    def bootstrap(self):
+        logging.info('bootstrapping CompletionCache')
+        self.datastore = self.get_settings()['datastore']
+        if self.datastore:
+            self.first_run()
+            self.connection = self.connect()
+        self.active = True
+        self.start_workers()
+
+    def first_run(self):
+        with sqlite3.connect(self.datastore) as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS CompletionCache(
+                                    key varchar primary key not null,
+                                    response varchar not null,
+                                    expires real not null);""")
+            connection.execute('CREATE INDEX IF NOT EXISTS completion_cache_expires ON CompletionCache(expires);')
+
+    def connect(self):
+        connection = sqlite3.connect(self.datastore, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL;')
+        connection.execute('PRAGMA synchronous=NORMAL;')
+        return connection
+
+    def reader(self):
+        """ Returns this thread's read connection to the persistent tier. """
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.datastore)
+            self.readers.connection = connection
+        return connection
+
+    def enabled(self, bypass: bool = False):
+        """ Whether a completion should use the cache, a bypassed request is counted as such. """
+        if not self.active or not self.get_settings()['enabled']:
+            return False
+        if bypass:
+            self.statistics['bypassed'] += 1
+            return False
+        return True
+
+    @staticmethod
+    def make_key(backend: str, model: str, messages: list, **parameters):
+        """ A canonical hash of everything that decides the LM's response. """
+        request = json.dumps({'backend': backend, 'model': model, 'messages': messages, 'parameters': parameters},
+                             sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def admit(self, key: str, response: dict, expires: float, settings: dict):
+        """ Add a response to the memory tier, evicting the least recently used. Called with entries_lock held. """
+        size = len(json.dumps(response)) + 256
+        if key in self.entries:
+            self.entries_bytes -= self.entries.pop(key)[2]
+        self.entries[key] = (expires, response, size)
+        self.entries_bytes += size
+        while len(self.entries) > settings['size'] or (settings['bytes'] and self.entries_bytes > settings['bytes']):
+            if len(self.entries) == 1:
+                break
+            self.entries_bytes -= self.entries.popitem(last=False)[1][2]
+            self.statistics['evictions'] += 1
+
+    def get(self, key: str):
+        """ Returns the cached response for a key, or None. """
+        now = time.time()
+        with self.entries_lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.statistics['hits'] += 1
+                    return dict(entry[1])
+                self.entries_bytes -= self.entries.pop(key)[2]
+                self.statistics['expired'] += 1
+
+        if self.datastore:
+            try:
+                row = self.reader().execute('SELECT response, expires FROM CompletionCache WHERE key = ?;',
+                                            [key]).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f'Failed to read from the completion cache: {e}')
+                row = None
+            if row is not None and row[1] > now:
+                response = json.loads(row[0])
+                with self.entries_lock:
+                    self.admit(key, response, row[1], self.get_settings())
+                    self.statistics['persistent_hits'] += 1
+                return dict(response)
+
+        self.statistics['misses'] += 1
+        return None
+
+    def put(self, key: str, response: dict):
+        """ Cache a response, the persistent tier is written by the worker. """
+        settings = self.get_settings()
+        expires = time.time() + settings['ttl']
+        with self.entries_lock:
+            self.admit(key, response, expires, settings)
+            self.statistics['stored'] += 1
+        if self.datastore:
+            self.queue.put((key, json.dumps(response), expires))
+
+    def get_statistics(self):
+        lookups = self.statistics['hits'] + self.statistics['persistent_hits'] + self.statistics['misses']
+        return dict(self.statistics,
+                    enabled=self.active and self.get_settings()['enabled'],
+                    hit_rate=(self.statistics['hits'] + self.statistics['persistent_hits']) / lookups
+                    if lookups else None,
+                    entries=len(self.entries),
+                    entries_bytes=self.entries_bytes,
+                    persistent=bool(self.datastore))
+
+    def flush(self, rows: list):
+        """ Write responses to the persistent tier, then remove expired responses and the oldest beyond its limit. """
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO CompletionCache(key, response, expires) '
+                                            'VALUES (?, ?, ?);', rows)
+                self.connection.execute('DELETE FROM CompletionCache WHERE expires <= ?;', [time.time()])
+                self.connection.execute('DELETE FROM CompletionCache WHERE key IN (SELECT key FROM CompletionCache '
+                                        'ORDER BY expires DESC LIMIT -1 OFFSET ?);',
+                                        [self.get_settings()['persistent_size']])
+        except sqlite3.Error as e:
+            logging.error(f'Failed to write {len(rows)} responses to the completion cache: {e}')
+
+    def do_work(self):
+        while self.active:
+            task = self.queue.get()
+            rows = []
+            while task is not None:
+                rows.append(task)
+                try:
+                    task = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows and self.connection is not None:
+                self.flush(rows)
+            if task is None:
+                self.shutdown()
+                break
+
+    def shutdown(self):
+        super().shutdown()
+        if self.connection is not None:
+            self.connection.close()
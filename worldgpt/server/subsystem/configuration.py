@@ -3,7 +3,8 @@
 import json
 import logging
 import os
-from pydantic import DirectoryPath, FilePath, IPvAnyAddress, conint
+from typing import Dict, Literal, Optional
+from pydantic import DirectoryPath, FilePath, IPvAnyAddress, conint, confloat
 from worldgpt.server.model.configuration import ServerConfiguration
 from worldgpt.shared.util import about
 from worldgpt.shared.util.singleton import Singleton
@@ -26,6 +27,54 @@ class Configuration(Subsystem, metaclass=Singleton):
         self.datastore: str | FilePath | None
         self.api_listen_host: str | IPvAnyAddress | None
         self.api_listen_port: conint(gt=0, le=65535) | None
+        self.api_workers: conint(gt=0) | None
+        self.subsystem_workers: Dict[str, conint(gt=0)] | None
+        self.subsystem_queue_sizes: Dict[str, conint(ge=0)] | None
+        self.subsystem_overflow: Dict[str, Literal['block', 'drop_oldest', 'reject']] | None
+        self.subsystem_stop_timeout: confloat(gt=0) | None
+        self.database_batch_size: conint(gt=0) | None
+        self.database_flush_interval: confloat(gt=0) | None
+        self.database_cache_size: conint(gt=0) | None
+        self.database_cache_bytes: conint(ge=0) | None
+        self.database_change_poll_interval: confloat(gt=0) | None
+        self.database_changelog_retention: confloat(gt=0) | None
+        self.database_import_batch_size: conint(gt=0) | None
+        self.database_export_page_size: conint(gt=0) | None
+        self.llm_backend: str | None
+        self.llm_max_concurrency: conint(gt=0) | None
+        self.llm_model_concurrency: Dict[str, conint(gt=0)] | None
+        self.fake_llm_latency: confloat(ge=0) | None
+        self.fake_llm_latency_sigma: confloat(ge=0) | None
+        self.fake_llm_tokens_per_second: confloat(gt=0) | None
+        self.fake_llm_failure_rate: confloat(ge=0, le=1) | None
+        self.fake_llm_seed: Optional[int]
+        self.completion_cache_enabled: bool | None
+        self.completion_cache_ttl: confloat(gt=0) | None
+        self.completion_cache_size: conint(gt=0) | None
+        self.completion_cache_bytes: conint(ge=0) | None
+        self.completion_cache_datastore: str | None
+        self.completion_cache_persistent_size: conint(gt=0) | None
+        self.memory_recall: conint(ge=0) | None
+        self.memory_max_tokens: conint(ge=0) | None
+        self.memory_min_similarity: confloat(ge=0, le=1) | None
+        self.lore_max_tokens: conint(ge=0) | None
+        self.lore_scan_messages: conint(ge=0) | None
+        self.summarizer_model: str | None
+        self.summarizer_threshold_tokens: conint(gt=0) | None
+        self.summarizer_keep_tokens: conint(ge=0) | None
+        self.summarizer_max_tokens: conint(gt=0) | None
+        self.summarizer_max_deferral: confloat(ge=0) | None
+        self.tts_backend: str | None
+        self.tts_voice: str | None
+        self.tts_voice_settings: Dict[str, float] | None
+        self.tts_max_concurrency: conint(gt=0) | None
+        self.tts_min_sentence_chars: conint(ge=0) | None
+        self.tts_local_latency: confloat(ge=0) | None
+        self.tts_local_seconds_per_char: confloat(ge=0) | None
+        self.voice_cache_enabled: bool | None
+        self.voice_cache_bytes: conint(gt=0) | None
+        self.voice_cache_rescan_interval: confloat(gt=0) | None
+        self.elevenlabs_model: str | None
         self.elevenlabs_api_key: str | None
         self.openai_api_key: str | None
 
@@ -34,7 +83,7 @@ class Configuration(Subsystem, metaclass=Singleton):
         check if a value is returned from `find_configuration_path`, if it isn't, the path doesn't exist.
         we need to call `first_run` so that a valid configuration file exists to load.
         `load_configuration` is called to read in the config and inherit the data to the Subsystem.
-        set the active flag to indicate we are ready from processing and start the worker to process from the queue.
+        set the active flag to indicate we are ready from processing and start the workers to process from the queue.
         """
         if not self.find_configuration_path():
             self.first_run()
@@ -42,7 +91,7 @@ class Configuration(Subsystem, metaclass=Singleton):
             self.first_run()
         self.load_configuration()
         self.active = True
-        self.worker.start()
+        self.start_workers()
 
     def first_run(self):
         """ Called when the configuration data isn't found on disk, implying this is the first run of the subsystem.
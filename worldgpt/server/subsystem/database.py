@@ -1,40 +1,319 @@
 
 
+import asyncio
+import concurrent.futures
+import bisect
+import functools
 import json
 import logging
 import os
+import queue
 import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
 from pydantic import BaseModel
+from worldgpt.shared.util.file_lock import FileLock
+from worldgpt.shared.util.keyed_lock import ShardedLock
+from worldgpt.shared.util.metrics import Counter, Histogram
 from worldgpt.shared.util.singleton import Singleton
 from worldgpt.shared.util.subsystem import Subsystem
+from worldgpt.shared.util.task_queue import Overloaded
 from worldgpt.shared.model.character import Character
+from worldgpt.shared.model.lore import Lore
+from worldgpt.shared.model.message import Message
+
+
+# Schema versions, stored in the datastore with `PRAGMA user_version`.
+#     0: messages are stored as a JSON encoded column on the Character table.
+#     1: messages are stored one row per message in the Message table.
+#     2: Character.summarized records how many messages have been folded into summaries.
+#     3: the ChangeLog table records each write, so other processes sharing the datastore can see what changed.
+#     4: the MessageSearch table indexes the content of messages for full-text search, when SQLite has FTS5.
+#     5: the Lore table holds world information, and the ChangeLog records the kind of what was written.
+#     6: Character.summarized records the sequence of the first message that hasn't been summarized, rather than a count.
+SCHEMA_VERSION = 6
+
+# seconds before a batch that failed to write is tried again, and how many times it's tried before closing.
+RETRY_INTERVAL = 1.0
+SHUTDOWN_RETRIES = 3
+
+flush_seconds = Histogram('worldgpt_database_flush_seconds', 'Seconds taken to write each batch of characters.')
+flushed_characters = Counter('worldgpt_database_flushed_characters_total', 'Characters written by the worker.')
+
+
+def changelog_schema():
+    """ A row for each character or entry of lore written, by the process identified as origin. Rows are removed after
+        `database_changelog_retention` seconds, by then every process has seen them. """
+    return """CREATE TABLE IF NOT EXISTS ChangeLog(
+                id integer primary key autoincrement,
+                name varchar not null,
+                origin varchar not null,
+                timestamp float not null,
+                kind varchar not null default 'character'
+            );
+            CREATE INDEX IF NOT EXISTS changelog_timestamp ON ChangeLog(timestamp);"""
+
+
+def search_schema():
+    """ A full-text index of the content of every message. The text itself is read from the Message table rather than
+        stored twice, so the index is kept in step by the worker as it writes messages, see `index_messages`. """
+    return """CREATE VIRTUAL TABLE IF NOT EXISTS MessageSearch USING fts5(
+                content, content='Message', content_rowid='rowid', tokenize='porter unicode61'
+            );"""
+
+
+@functools.lru_cache(maxsize=None)
+def fts5_available():
+    """ Whether this build of SQLite has FTS5, without it messages aren't indexed and can't be searched. """
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE probe USING fts5(content);')
+        return True
+    except sqlite3.Error:
+        return False
+
+
+class BulkWrite:
+    """ Characters to be written together by the worker, in one transaction, see `Database.write_characters`. """
+
+    def __init__(self, characters: list, replace: bool):
+        self.characters = characters
+        self.replace = replace
+        self.future = concurrent.futures.Future()  # the error of each character not written, by name.
+
+
+class LoreWrite:
+    """ Entries of lore to be written and the names of those to be deleted, in one transaction, see `Lore`. """
+
+    def __init__(self, entries: list, deleted: list):
+        self.entries = entries
+        self.deleted = deleted
 
 
 class Database(Subsystem, metaclass=Singleton):
 
     # todo requires cleanup from hacktime
 
+    max_workers = 1  # the worker owns the write connection, and batches must be written in order.
+    queue_size = 10000  # a full queue holds up whoever is storing, a write is never dropped.
+    overflow_policies = ('block', 'reject')
+
     def __init__(self):
         super().__init__()
-        self.characters = {}
+        # the names of every stored character, replaced as a whole when a name is added so readers need no lock.
+        self.names: frozenset = frozenset()
+        # characters are read from the datastore when first needed and kept in a bounded LRU cache, see `get_character`.
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_sizes = {}  # estimated bytes per cached character, as of when they were last read or stored.
+        self.cache_bytes = 0
+        self.cache_lock = threading.Lock()  # guards changes to the cache, dirty and live, never held while doing I/O.
+        self.touched = deque(maxlen=4096)  # names of recent cache hits, moved to the end of the LRU by `admit`.
+        self.dirty = {}  # characters queued to be written, kept in memory until they have been even if evicted.
+        self.live = weakref.WeakValueDictionary()  # every character object still in use, so a name has one object.
+        self.readers = threading.local()  # a read connection per thread, see `reader`.
+        # bumped by the worker each time a character is written, and each time any character is. versions start again
+        # when the process does, the epoch distinguishes them.
+        self.versions = {}
+        self.registry_version = 0
+        self.epoch = f'{int(time.time()):x}'
+        # when several processes share the datastore each watches the ChangeLog for characters the others have written,
+        # see `watch`. origin identifies this process's writes.
+        self.origin = f'{os.getpid()}.{self.epoch}'
+        self.last_change = 0  # the id of the last ChangeLog row seen.
+        self.stale = set()  # characters another process wrote while we had changes to write, forgotten once written.
+        self.change_listeners = []  # called with the name of each character written by another process.
+        # called with the name of each entry of lore another process wrote, None for any, or if writing ours failed.
+        self.lore_listeners = []
+        self.shared = False  # whether other processes share the datastore, writes are only logged if they do.
+        self.searchable = False  # whether messages are indexed for search, see `prepare_search`.
+        self.leader = True  # the leader trims the ChangeLog, there is one per datastore.
+        self.last_trim = 0.0
+        self.watcher: threading.Thread = threading.Thread(target=self.watch, name='Database_watcher', daemon=True)
+        # held while a character's messages or summaries are changed, or read by the worker. keep critical sections short.
+        self.character_locks = ShardedLock()
+        self.connection: sqlite3.Connection | None = None  # owned by the worker, see `connect`.
+        self.retry = {}  # characters of batches that failed to write, added to the next batch, see `flush`.
+        self.statistics = {'flushes': 0,
+                           'flushed_characters': 0,
+                           'coalesced_updates': 0,
+                           'last_batch_size': 0,
+                           'last_flush_duration': 0.0,
+                           'max_flush_duration': 0.0,
+                           'total_flush_duration': 0.0,
+                           'cache_hits': 0,
+                           'cache_misses': 0,
+                           'cache_evictions': 0}
 
     def get_datastore(self):
         from worldgpt.server.subsystem.configuration import Configuration
         with Configuration().lock.r_locked():
             return Configuration().datastore
 
+    def get_batching(self):
+        """ Returns the batch size and the longest a write may wait before it's flushed, in seconds. """
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return Configuration().database_batch_size or 64, Configuration().database_flush_interval or 0.05
+
+    def get_sharing(self):
+        """ Returns whether other processes share the datastore, how often to check for their changes and how long
+            changes are kept in the ChangeLog, in seconds.
+        """
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return ((Configuration().api_workers or 1) > 1,
+                    Configuration().database_change_poll_interval or 0.25,
+                    Configuration().database_changelog_retention or 300.0)
+
+    def get_cache_limits(self):
+        """ Returns the most characters and the most estimated bytes the cache may hold, 0 bytes for no limit. """
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return Configuration().database_cache_size or 1024, Configuration().database_cache_bytes or 0
+
     def bootstrap(self):
         logging.info('bootstrapping Database')
-        if not os.path.isfile(self.get_datastore()):
-            self.first_run()
+        # processes starting together take turns, so only one creates or migrates the datastore.
+        with FileLock(f'{self.get_datastore()}.lock'):
+            if not os.path.isfile(self.get_datastore()):
+                self.first_run()
+            self.migrate()
+            self.searchable = self.prepare_search()
         self.load_characters()
+        self.connection = self.connect()
+        self.shared = self.get_sharing()[0]
         self.active = True
-        self.worker.start()
+        self.start_workers()
+        if self.shared:
+            self.watcher.start()
 
     def first_run(self):
-        query = Character.sql_schema()
         with sqlite3.connect(self.get_datastore()) as connection:
-            self.execute_query(query)
+            connection.executescript(Character.sql_schema() + Message.sql_schema() + changelog_schema() +
+                                     Lore.sql_schema() + (search_schema() if fts5_available() else ''))
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION};')
+
+    def migrate(self):
+        """ Bring an existing datastore up to SCHEMA_VERSION, each step runs within a single transaction. """
+        steps = {1: self.migrate_messages,
+                 2: self.migrate_summarized,
+                 3: self.migrate_changelog,
+                 4: self.migrate_search,
+                 5: self.migrate_lore,
+                 6: self.migrate_summarized_sequence}
+        connection = sqlite3.connect(self.get_datastore(), isolation_level=None)
+        try:
+            version = connection.execute('PRAGMA user_version;').fetchone()[0]
+            for target in range(version + 1, SCHEMA_VERSION + 1):
+                logging.info(f'Migrating datastore to schema version {target}.')
+                connection.execute('BEGIN IMMEDIATE;')
+                try:
+                    steps[target](connection)
+                    connection.execute(f'PRAGMA user_version = {target};')
+                    connection.execute('COMMIT;')
+                except Exception:
+                    connection.execute('ROLLBACK;')
+                    raise
+        finally:
+            connection.close()
+
+    @staticmethod
+    def migrate_messages(connection):
+        """ Move the JSON encoded `messages` column of the Character table into the Message table.
+            SQLite can't reliably drop a column, so the Character table is rebuilt without it.
+        """
+        for statement in Message.sql_schema().split(';'):
+            if statement.strip():
+                connection.execute(statement)
+        columns = [x[1] for x in connection.execute('PRAGMA table_info(Character);').fetchall()]
+        if 'messages' not in columns:
+            return
+        for name, messages in connection.execute('SELECT name, messages FROM Character;').fetchall():
+            rows = []
+            for sequence, message in enumerate(json.loads(messages or '[]')):
+                rows.append(Message(**message).to_sql(name, sequence)[1])
+            connection.executemany(Message.sql_insert(), rows)
+        connection.execute('ALTER TABLE Character RENAME TO Character_v0;')
+        connection.execute(Character.sql_schema())
+        kept = ', '.join(x for x in columns if x != 'messages')
+        connection.execute(f'INSERT INTO Character( {kept} ) SELECT {kept} FROM Character_v0;')
+        connection.execute('DROP TABLE Character_v0;')
+
+    @staticmethod
+    def migrate_summarized(connection):
+        """ Add the summarized column, a Character table rebuilt by `migrate_messages` will already have it. """
+        columns = [x[1] for x in connection.execute('PRAGMA table_info(Character);').fetchall()]
+        if 'summarized' not in columns:
+            connection.execute('ALTER TABLE Character ADD COLUMN summarized integer not null default 0;')
+
+    @staticmethod
+    def migrate_changelog(connection):
+        for statement in changelog_schema().split(';'):
+            if statement.strip():
+                connection.execute(statement)
+
+    @staticmethod
+    def migrate_search(connection):
+        """ Index the messages written so far, without FTS5 this is left to `prepare_search` once it's available. """
+        if fts5_available():
+            connection.execute(search_schema())
+            connection.execute("INSERT INTO MessageSearch( MessageSearch ) VALUES ('rebuild');")
+
+    @staticmethod
+    def migrate_lore(connection):
+        connection.execute(Lore.sql_schema())
+        columns = [x[1] for x in connection.execute('PRAGMA table_info(ChangeLog);').fetchall()]
+        if 'kind' not in columns:
+            connection.execute("ALTER TABLE ChangeLog ADD COLUMN kind varchar not null default 'character';")
+
+    @staticmethod
+    def migrate_summarized_sequence(connection):
+        """ Convert the number of messages summarized into the sequence of the first message after them, so it still
+            marks the same message once other processes have appended to the history. """
+        rows = connection.execute('SELECT name, summarized FROM Character WHERE summarized > 0;').fetchall()
+        for name, summarized in rows:
+            boundary = connection.execute('SELECT COALESCE((SELECT sequence FROM Message WHERE character = ?1 '
+                                          'ORDER BY sequence LIMIT 1 OFFSET ?2), '
+                                          '(SELECT COALESCE(MAX(sequence), -1) + 1 FROM Message WHERE character = ?1));',
+                                          [name, summarized]).fetchone()[0]
+            connection.execute('UPDATE Character SET summarized = ? WHERE name = ?;', [boundary, name])
+
+    def prepare_search(self):
+        """ Returns whether messages can be searched, indexing them first if the datastore was migrated by a build of
+            SQLite without FTS5.
+        """
+        connection = sqlite3.connect(self.get_datastore(), isolation_level=None)
+        try:
+            indexed = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'MessageSearch';").fetchone()
+            if not fts5_available():
+                if indexed:
+                    logging.error('SQLite lacks FTS5, messages written by this process will be missing from search.')
+                else:
+                    logging.warning('SQLite lacks FTS5, messages can\'t be searched.')
+                return False
+            if not indexed:
+                logging.info('Indexing messages for search.')
+                connection.execute('BEGIN IMMEDIATE;')
+                try:
+                    self.migrate_search(connection)
+                    connection.execute('COMMIT;')
+                except Exception:
+                    connection.execute('ROLLBACK;')
+                    raise
+            return True
+        finally:
+            connection.close()
+
+    def connect(self):
+        """ Open the long-lived connection used by the worker.
+            WAL lets readers continue while a batch is being written, and with WAL `synchronous=NORMAL` only syncs on
+            checkpoints rather than on every commit.
+        """
+        connection = sqlite3.connect(self.get_datastore(), timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL;')
+        connection.execute('PRAGMA synchronous=NORMAL;')
+        return connection
 
     def execute_query(self, query, values=None):
         with sqlite3.connect(self.get_datastore()) as connection:
@@ -45,6 +324,197 @@ class Database(Subsystem, metaclass=Singleton):
                 cursor.execute(query, values)
             connection.commit()
 
+    def reader(self):
+        """ Returns this thread's read connection, WAL allows these to read while the worker is writing. """
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.get_datastore(), timeout=30)
+            connection.row_factory = self.dict_factory
+            self.readers.connection = connection
+        return connection
+
+    @staticmethod
+    def estimate_size(character: Character):
+        """ A rough estimate of the memory a character holds onto, dominated by their history and its memory index. """
+        history = sum(len(x.content) + 128 for x in character.messages) + sum(len(x) for x in character.summaries)
+        return 1024 + history + (character._memory.nbytes if character._memory is not None else 0)
+
+    def admit(self, character: Character, size: int):
+        """ Add or refresh a character in the cache, with their estimated size, and evict the least recently used
+            beyond the limits. Cache hits since the last admission are counted as uses first.
+            Evicting never loses data, characters with unwritten changes are held by `dirty` until they're written.
+            The cache_lock must be held.
+        """
+        max_characters, max_bytes = self.get_cache_limits()
+        while self.touched:
+            name = self.touched.popleft()
+            if name in self.cache:
+                self.cache.move_to_end(name)
+        self.cache[character.name] = character
+        self.cache.move_to_end(character.name)
+        self.cache_bytes += size - self.cache_sizes.get(character.name, 0)
+        self.cache_sizes[character.name] = size
+        while len(self.cache) > 1 and (len(self.cache) > max_characters or (max_bytes and self.cache_bytes > max_bytes)):
+            name, _ = self.cache.popitem(last=False)
+            self.cache_bytes -= self.cache_sizes.pop(name)
+            self.statistics['cache_evictions'] += 1
+
+    def get_character(self, name: str):
+        """ Returns the character, reading them from the datastore if they aren't in memory, or None.
+            A character in the cache is returned without taking a lock or copying anything, the hit is only noted so
+            the LRU order is approximate: it's brought up to date the next time a character is admitted.
+        """
+        character = self.cache.get(name)
+        if character is not None:
+            self.statistics['cache_hits'] += 1  # not locked, may miss the odd hit.
+            self.touched.append(name)
+            return character
+        with self.cache_lock:
+            character = self.dirty.get(name) or self.live.get(name)
+        if character is None and name not in self.names:
+            return None
+
+        if character is None:
+            character = self.read_character(name)
+            if character is None:
+                return None
+            self.statistics['cache_misses'] += 1
+        else:
+            self.statistics['cache_hits'] += 1  # evicted, but still in use or waiting to be written.
+        size = self.estimate_size(character)
+        with self.cache_lock:
+            # another thread may have read or stored them in the meantime, theirs is the one in use.
+            character = self.live.setdefault(name, character)
+            self.admit(character, size)
+        return character
+
+    async def aget_character(self, name: str):
+        """ As `get_character`, for the event loop. A character that isn't cached is looked up in the default executor,
+            as reading them from the datastore would hold up every other request.
+        """
+        if name in self.cache:
+            return self.get_character(name)
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_character, name)
+
+    def read_character(self, name: str):
+        """ Read a character and their history from the datastore. """
+        cursor = self.reader().cursor()
+        entry = cursor.execute('SELECT * FROM Character WHERE name = ?;', [name]).fetchone()
+        if entry is None:
+            return None
+        entry = self.decode_row(entry)
+        cursor.execute('SELECT sequence, role, content, timestamp FROM Message WHERE character = ? ORDER BY sequence;',
+                       [name])
+        rows = cursor.fetchall()
+        entry['messages'] = [Message(role=x['role'], content=x['content'], timestamp=x['timestamp']) for x in rows]
+        sequences = [x['sequence'] for x in rows]
+        boundary = entry['summarized']
+        entry['summarized'] = bisect.bisect_left(sequences, boundary)
+        character = Character(**entry)
+        character._sequences = sequences
+        character._stored_row = dict(zip(Character.sql_columns(), character.to_sql()[1]), summarized=boundary)
+        return character
+
+    @staticmethod
+    def decode_row(entry: dict):
+        """ Decode the JSON encoded columns of a Character row. """
+        for k, v in entry.items():
+            if k == 'name':
+                continue
+            try:
+                entry[k] = json.loads(v)
+            except:
+                pass
+        return entry
+
+    def list_characters(self, after: str | None = None, limit: int = 100, fields: list | None = None,
+                        messages: int | None = None):
+        """ Returns a page of characters ordered by name, starting after the name `after`, and the cursor for the next
+            page or None if this is the last page.
+            Only the fields requested are read, by default every field but messages. With `messages` the most recent
+            messages are included, history is otherwise never read.
+            Characters in memory are projected from memory as they may have changes that haven't been written yet.
+        """
+        columns = [x for x in (fields or Character.sql_columns()) if x in Character.sql_columns()]
+        if 'name' not in columns:
+            columns.insert(0, 'name')
+        # the datastore records the sequence of the first message that hasn't been summarized, see `write_character`.
+        selected = ['(SELECT COUNT(*) FROM Message WHERE Message.character = Character.name AND '
+                    'Message.sequence < Character.summarized) AS summarized' if x == 'summarized' else x for x in columns]
+        rows = self.reader().execute(f'SELECT {", ".join(selected)} FROM Character WHERE name > ? '
+                                     f'ORDER BY name LIMIT ?;', [after or '', limit]).fetchall()
+        page = {x['name']: x for x in rows}
+        with self.cache_lock:
+            in_memory = {x: self.dirty.get(x) or self.cache.get(x) for x in page}
+            # new characters that haven't been written yet aren't in the datastore.
+            for name in self.dirty:
+                if name not in page and name > (after or ''):
+                    in_memory[name] = self.dirty[name]
+        names = sorted(set(page) | set(x for x in in_memory if in_memory[x] is not None))[:limit]
+
+        output = []
+        for name in names:
+            character = in_memory.get(name)
+            if character is not None:
+                with self.character_locks(name):
+                    entry = character.dict(include=set(columns))
+                    if messages is not None:
+                        entry['messages'] = [x.dict() for x in character.messages[-messages:]] if messages else []
+            else:
+                entry = self.decode_row(page[name])
+                if messages is not None:
+                    entry['messages'] = self.read_messages(name, messages) if messages else []
+            output.append(entry)
+        next_cursor = names[-1] if len(names) == limit else None
+        return output, next_cursor
+
+    def read_messages(self, name: str, limit: int):
+        """ Read the most recent messages of a character from the datastore, oldest first. """
+        rows = self.reader().execute('SELECT role, content, timestamp FROM Message WHERE character = ? '
+                                     'ORDER BY sequence DESC LIMIT ?;', [name, limit]).fetchall()
+        return list(reversed(rows))
+
+    def get_version(self, name: str | None = None):
+        """ Returns the version of a character, or of the registry as a whole when name is None, as an opaque string
+            that changes whenever the worker writes them.
+        """
+        if name is None:
+            return f'{self.epoch}.{self.registry_version}'
+        return f'{self.epoch}.{self.versions.get(name, 0)}'
+
+    def store(self, character: Character):
+        """ Queue a character to be written. Until the worker has written them they are kept in memory, so that any
+            reader is given this character rather than the older version in the datastore.
+            A character forgotten since they were read, as another process wrote them, is written and then forgotten
+            again, so they're read with the other process's changes when next needed.
+        """
+        self.queue.check()  # refused before anything changes, if the queue is full and set to reject.
+        size = self.estimate_size(character)
+        with self.cache_lock:
+            queued = character.name in self.dirty
+            new = character.name not in self.names
+            self.dirty[character.name] = character
+            if not new and self.live.get(character.name) is not character:
+                self.stale.add(character.name)
+            else:
+                self.live[character.name] = character
+                self.admit(character, size)
+            if new:
+                self.names = self.names | {character.name}
+        try:
+            self.queue.put(character)
+        except Overloaded:
+            # the queue filled since it was checked, the change stays in memory and is written with the next that's
+            # accepted. a new character that was never queued is dropped.
+            if not queued:
+                with self.cache_lock:
+                    if self.dirty.get(character.name) is character:
+                        del self.dirty[character.name]
+                    if new:
+                        self.names = self.names - {character.name}
+                        self.forget(character.name)
+            raise
+
     @staticmethod
     def dict_factory(cursor, row):
         d = {}
@@ -53,29 +523,407 @@ class Database(Subsystem, metaclass=Singleton):
         return d
 
     def load_characters(self):
-        with sqlite3.connect(self.get_datastore()) as connection:
-            connection.row_factory = self.dict_factory
-            cursor = connection.cursor()
-            cursor.execute('SELECT * FROM Character;')
-            for entry in cursor.fetchall():
-                for k,v in entry.items():
-                    try:
-                        entry[k] = json.loads(v)
-                    except:
-                        pass
-                with self.lock.w_locked():
-                    self.characters[entry['name']] = Character(**entry)
+        """ Load the index of character names, characters themselves are read when they're first needed. """
+        connection = self.reader()
+        self.names = frozenset(x['name'] for x in connection.execute('SELECT name FROM Character;').fetchall())
+        logging.info(f'Indexed {len(self.names)} characters')
+
+    def write_character(self, connection: sqlite3.Connection, character: Character):
+        """ Write what has changed of a character since they were read or last written, so a process sharing the
+            datastore that writes the same character doesn't have its changes undone: the messages added and only the
+            columns of the Character row whose values differ. A new character's row is written whole.
+            Messages are append-only by convention, if the history was shortened the rows of the messages removed are
+            deleted, by the sequences they were written with.
+            Each message takes the next sequence of the character's history in the datastore, rather than its position
+            in this history, so a process that shares the datastore can append to the same history without conflict.
+            summarized is written as the sequence of the first message after those summarized, for the same reason.
+            Returns the sequences of the character's messages and the row written, kept once the transaction commits.
+        """
+        name = character.name
+        with self.character_locks(name):
+            query, values = character.to_sql()
+            messages = list(character.messages)
+            summarized = character.summarized
+        sequences = list(character._sequences)
+        if len(messages) < len(sequences):
+            removed = [[name, x] for x in sequences[len(messages):]]
+            self.index_sequences(connection, removed, remove=True)
+            connection.executemany('DELETE FROM Message WHERE character = ? AND sequence = ?;', removed)
+            del sequences[len(messages):]
+        rows = [x.to_sql_append(name)[1] for x in messages[len(sequences):]]
+        if rows:
+            connection.executemany(Message.sql_append(), rows)
+            # the transaction has held the write lock since the first insert, the newest sequences are the ones taken.
+            added = connection.execute('SELECT sequence FROM Message WHERE character = ? ORDER BY sequence DESC LIMIT ?;',
+                                       [name, len(rows)]).fetchall()
+            sequences.extend(sorted(x[0] for x in added))
+            self.index_sequences(connection, [[name, x] for x in sequences[-len(rows):]])
+
+        row = dict(zip(Character.sql_columns(), values))
+        summarized = min(summarized, len(sequences))
+        row['summarized'] = sequences[summarized - 1] + 1 if summarized else 0
+        stored = character._stored_row
+        if stored is None:
+            connection.execute(query, list(row.values()))
+        else:
+            changed = [x for x in row if row[x] != stored.get(x)]
+            if changed:
+                connection.execute(f'UPDATE Character SET {", ".join(f"{x} = ?" for x in changed)} WHERE name = ?;',
+                                   [row[x] for x in changed] + [name])
+        if self.shared:
+            connection.execute('INSERT INTO ChangeLog( name, origin, timestamp ) VALUES (?, ?, ?);',
+                               [name, self.origin, time.time()])
+        return sequences, row
+
+    def index_messages(self, connection: sqlite3.Connection, newest: list, remove: bool = False):
+        """ Add messages to the search index as they're written, or remove them before they're deleted. newest is
+            [name, count] of the newest messages of each character to index, count -1 for every message.
+        """
+        if not self.searchable:
+            return
+        if remove:
+            connection.executemany("INSERT INTO MessageSearch( MessageSearch, rowid, content ) SELECT 'delete', rowid, "
+                                   "content FROM Message WHERE character = ? ORDER BY sequence DESC LIMIT ?;", newest)
+        else:
+            connection.executemany('INSERT INTO MessageSearch( rowid, content ) SELECT rowid, content FROM Message '
+                                   'WHERE character = ? ORDER BY sequence DESC LIMIT ?;', newest)
+
+    def index_sequences(self, connection: sqlite3.Connection, messages: list, remove: bool = False):
+        """ As `index_messages`, for the messages [name, sequence]. """
+        if not self.searchable:
+            return
+        if remove:
+            connection.executemany("INSERT INTO MessageSearch( MessageSearch, rowid, content ) SELECT 'delete', rowid, "
+                                   "content FROM Message WHERE character = ? AND sequence = ?;", messages)
+        else:
+            connection.executemany('INSERT INTO MessageSearch( rowid, content ) SELECT rowid, content FROM Message '
+                                   'WHERE character = ? AND sequence = ?;', messages)
+
+    def search_messages(self, query: str, character: str | None = None, role: str | None = None,
+                        since: float | None = None, until: float | None = None, limit: int = 20, offset: int = 0):
+        """ Returns a page of the messages matching an FTS5 query, best match first, and the offset of the next page
+            or None if this is the last page. Messages are searchable once the worker has written them.
+            https://www.sqlite.org/fts5.html#full_text_query_syntax
+        """
+        conditions, values = ['MessageSearch MATCH ?'], [query]
+        for condition, value in (('Message.character = ?', character), ('Message.role = ?', role),
+                                 ('Message.timestamp >= ?', since), ('Message.timestamp < ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        rows = self.reader().execute(
+            f"SELECT Message.character, Message.sequence, Message.role, Message.content, Message.timestamp, "
+            f"snippet(MessageSearch, 0, '[', ']', '...', 16) AS snippet, bm25(MessageSearch) AS rank "
+            f"FROM MessageSearch JOIN Message ON Message.rowid = MessageSearch.rowid "
+            f"WHERE {' AND '.join(conditions)} ORDER BY rank LIMIT ? OFFSET ?;", values + [limit + 1, offset]).fetchall()
+        return rows[:limit], offset + limit if len(rows) > limit else None
+
+    def next_batch(self):
+        """ Block for the next task, then keep collecting until the batch is full or the flush interval has passed.
+            Repeated updates to the same character are coalesced, only the latest version is kept.
+            Returns the batch, keyed by name and object as another process's change may leave an older object of a
+            character still in use, whether a shutdown was requested and any other write, such as a bulk write, which
+            ends the batch so that it's written after the changes queued before it.
+            Characters that failed to write start the batch, and are tried again after RETRY_INTERVAL if nothing else
+            is queued.
+        """
+        batch_size, flush_interval = self.get_batching()
+        batch, self.retry = self.retry, {}
+        try:
+            task = self.queue.get(timeout=RETRY_INTERVAL if batch else None)
+        except queue.Empty:
+            return batch, False, None
+        deadline = time.monotonic() + flush_interval
+        while task is not None:
+            if isinstance(task, (BulkWrite, LoreWrite)):
+                return batch, False, task
+            if isinstance(task, Character):
+                if (task.name, id(task)) in batch:
+                    self.statistics['coalesced_updates'] += 1
+                batch[task.name, id(task)] = task
+            if len(batch) >= batch_size:
+                return batch, False, None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return batch, False, None
+            try:
+                task = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                return batch, False, None
+        return batch, True, None
+
+    def flush(self, batch):
+        """ Write a batch of characters in a single transaction, once written they no longer need to be held.
+            If the transaction fails the batch is kept to be tried again with the next, a later version of a character
+            queued since replaces theirs.
+        """
+        started = time.perf_counter()
+        written = []
+        try:
+            with self.connection:
+                for character in batch.values():
+                    written.append((character, self.write_character(self.connection, character)))
+        except sqlite3.Error as e:
+            logging.error(f'Failed to write batch of {len(batch)} characters, retrying: {e}')
+            self.retry.update(batch)
+            return
+        for character, (sequences, row) in written:
+            character._sequences = sequences
+            character._stored_row = row
+        sizes = {name: self.estimate_size(x) for (name, _), x in batch.items() if self.cache.get(name) is x}
+        with self.cache_lock:
+            self.registry_version += 1
+            for (name, _), character in batch.items():
+                self.versions[name] = self.versions.get(name, 0) + 1
+                if self.dirty.get(name) is character:
+                    del self.dirty[name]
+                    if name in self.stale:
+                        self.stale.discard(name)
+                        self.forget(name)
+                        continue
+                if self.cache.get(name) is character and name in sizes:
+                    self.cache_bytes += sizes[name] - self.cache_sizes[name]
+                    self.cache_sizes[name] = sizes[name]
+
+        duration = time.perf_counter() - started
+        flush_seconds.observe(duration)
+        flushed_characters.inc(len(batch))
+        self.statistics['flushes'] += 1
+        self.statistics['flushed_characters'] += len(batch)
+        self.statistics['last_batch_size'] = len(batch)
+        self.statistics['last_flush_duration'] = duration
+        self.statistics['max_flush_duration'] = max(duration, self.statistics['max_flush_duration'])
+        self.statistics['total_flush_duration'] += duration
+        logging.debug(f'Flushed {len(batch)} characters in {duration * 1000:.2f}ms')
+
+    def write_characters(self, characters: list, replace: bool = False):
+        """ Queue characters to be written together in one transaction, rather than one by one as `store` does.
+            Characters that exist are skipped unless replace is set, replacing their history too. The characters
+            aren't kept in memory, a character already in memory is forgotten once replaced, so the next request reads
+            the replacement. Replacing a character while a request is changing it may mix the two histories.
+            Returns a future of the error of each character that wasn't written, by name.
+        """
+        task = BulkWrite(characters, replace)
+        self.queue.put(task)
+        return task.future
+
+    def write_bulk(self, task: BulkWrite):
+        """ Write the characters of a bulk write, each table with a single executemany. Whether a character exists is
+            checked within the write transaction, so one another process has written since is never overwritten.
+        """
+        started = time.perf_counter()
+        errors = {}
+        with self.cache_lock:
+            unwritten = set(self.dirty)
+        candidates = []
+        for character in task.characters:
+            if character.name in unwritten:
+                errors[character.name] = 'Character has changes waiting to be written, try again shortly.'
+            else:
+                candidates.append(character)
+        accepted = []
+        existing = set()
+        try:
+            if candidates:
+                with self.connection:
+                    # taking the write lock up front, no other process can add a character between the check and write.
+                    self.connection.execute('BEGIN IMMEDIATE;')
+                    if not task.replace:
+                        names = [x.name for x in candidates]
+                        for offset in range(0, len(names), 500):
+                            chunk = names[offset:offset + 500]
+                            existing.update(x[0] for x in self.connection.execute(
+                                f'SELECT name FROM Character WHERE name IN ({", ".join("?" * len(chunk))});', chunk))
+                    for character in candidates:
+                        if character.name in existing:
+                            errors[character.name] = 'Character already exists.'
+                        else:
+                            accepted.append(character)
+                    if accepted:
+                        self.insert_characters(accepted, task.replace)
+        except sqlite3.Error as e:
+            logging.error(f'Failed to write {len(accepted)} characters in bulk: {e}')
+            errors.update({x.name: f'Failed to write: {e}' for x in accepted})
+            task.future.set_result(errors)
+            return
+
+        with self.cache_lock:
+            self.names = self.names | {x.name for x in accepted} | existing
+            self.registry_version += 1
+            for character in accepted:
+                self.versions[character.name] = self.versions.get(character.name, 0) + 1
+                if character.name not in self.dirty:
+                    self.forget(character.name)
+        duration = time.perf_counter() - started
+        flush_seconds.observe(duration)
+        flushed_characters.inc(len(accepted))
+        logging.debug(f'Wrote {len(accepted)} characters in bulk in {duration * 1000:.2f}ms')
+        task.future.set_result(errors)
+
+    def insert_characters(self, accepted: list, replace: bool):
+        """ Write the characters accepted by `write_bulk`, within its transaction. """
+        if replace:
+            self.index_messages(self.connection, [[x.name, -1] for x in accepted], remove=True)
+            self.connection.executemany('DELETE FROM Message WHERE character = ?;', [[x.name] for x in accepted])
+        # messages are written with the sequences 0 on, so summarized is the sequence after those summarized.
+        self.connection.executemany(accepted[0].to_sql()[0], [x.to_sql()[1] for x in accepted])
+        self.connection.executemany(Message.sql_insert(), (message.to_sql(x.name, sequence)[1]
+                                                           for x in accepted
+                                                           for sequence, message in enumerate(x.messages)))
+        self.index_messages(self.connection, [[x.name, -1] for x in accepted])
+        if self.shared:
+            self.connection.executemany('INSERT INTO ChangeLog( name, origin, timestamp ) VALUES (?, ?, ?);',
+                                        [[x.name, self.origin, time.time()] for x in accepted])
+
+    def store_lore(self, entries: list, deleted: list | None = None):
+        """ Queue entries of lore to be written, and the names of entries to be deleted. The Lore subsystem keeps
+            what's in use, see `worldgpt/server/subsystem/lore.py`.
+        """
+        self.queue.put(LoreWrite(entries, deleted or []))
+
+    def write_lore(self, task: LoreWrite):
+        """ Write a LoreWrite in one transaction. The LoreBook has already applied it, if it fails the LoreBook reads
+            every entry again so what it serves is what's in the datastore.
+        """
+        try:
+            with self.connection:
+                if task.entries:
+                    self.connection.executemany(task.entries[0].to_sql()[0], [x.to_sql()[1] for x in task.entries])
+                if task.deleted:
+                    self.connection.executemany('DELETE FROM Lore WHERE name = ?;', [[x] for x in task.deleted])
+                if self.shared:
+                    self.connection.executemany('INSERT INTO ChangeLog( name, origin, timestamp, kind ) '
+                                                'VALUES (?, ?, ?, ?);',
+                                                [[x, self.origin, time.time(), 'lore']
+                                                 for x in [x.name for x in task.entries] + task.deleted])
+        except sqlite3.Error as e:
+            logging.error(f'Failed to write {len(task.entries)} and delete {len(task.deleted)} entries of lore: {e}')
+            self.notify(self.lore_listeners, None)
+
+    def read_lore(self, name: str | None = None):
+        """ Returns every entry of lore in the datastore, or only the entry named, if it exists. """
+        if name is None:
+            rows = self.reader().execute('SELECT name, content, triggers, priority FROM Lore;').fetchall()
+        else:
+            rows = self.reader().execute('SELECT name, content, triggers, priority FROM Lore WHERE name = ?;',
+                                         [name]).fetchall()
+        return [Lore.from_row(x) for x in rows]
+
+    def forget(self, name: str):
+        """ Drop a character from memory, so they're read from the datastore when next needed. The cache_lock must be
+            held. A request still using the character finishes with the object it has, their changes are still written.
+        """
+        if name in self.cache:
+            del self.cache[name]
+            self.cache_bytes -= self.cache_sizes.pop(name)
+        self.live.pop(name, None)
+
+    def watch(self):
+        """ Target of the watcher thread, started when other processes share the datastore. """
+        _, interval, _ = self.get_sharing()
+        self.last_change = self.reader().execute('SELECT COALESCE(MAX(id), 0) AS id FROM ChangeLog;').fetchone()['id']
+        while self.active:
+            time.sleep(interval)
+            try:
+                self.poll_changes()
+            except sqlite3.Error as e:
+                logging.error(f'Failed to read the ChangeLog: {e}')
+            except Exception as e:
+                logging.error(f'Failed to apply changes from the ChangeLog: {e}')  # keep watching, or changes go unseen.
+
+    @staticmethod
+    def notify(listeners: list, name: str | None):
+        """ Call each listener with the name of what changed. A listener's queue being full doesn't stop the others. """
+        for listener in listeners:
+            try:
+                listener(name)
+            except Overloaded:
+                logging.warning(f'Dropped the change to {name}, a listener\'s queue is full.')
+
+    def poll_changes(self):
+        """ Forget the characters other processes have written since the last poll, they're read again when next needed.
+            Characters with changes of our own waiting to be written are kept until they have been, ours are written
+            after theirs. Lore is left to the lore listeners.
+        """
+        _, _, retention = self.get_sharing()
+        connection = self.reader()
+        bounds = connection.execute('SELECT MIN(id) AS oldest, COALESCE(MAX(id), 0) AS latest FROM ChangeLog;').fetchone()
+        rows = connection.execute('SELECT name, kind FROM ChangeLog WHERE id > ? AND id <= ? AND origin != ?;',
+                                  [self.last_change, bounds['latest'], self.origin]).fetchall()
+        missed = bounds['oldest'] is not None and bounds['oldest'] > self.last_change + 1
+        changed = {x['name'] for x in rows if x['kind'] == 'character'}
+        lore = {x['name'] for x in rows if x['kind'] == 'lore'}
+        self.last_change = max(bounds['latest'], self.last_change)
+
+        if changed or missed:
+            with self.cache_lock:
+                if missed:
+                    # changes were removed from the ChangeLog before they were seen, anything may have changed.
+                    logging.warning('Missed changes from other processes, dropping every cached character.')
+                    changed |= set(self.cache) | set(self.live.keys())
+                    self.names = self.names | {x['name'] for x in connection.execute('SELECT name FROM Character;')}
+                for name in changed:
+                    self.versions[name] = self.versions.get(name, 0) + 1
+                    if name in self.dirty:
+                        self.stale.add(name)
+                        continue
+                    self.forget(name)
+                self.names = self.names | changed
+                self.registry_version += 1
+            for name in changed:
+                self.notify(self.change_listeners, name)
+        for name in ({None} if missed else lore):
+            self.notify(self.lore_listeners, name)
+
+        if self.leader and time.monotonic() - self.last_trim > retention / 10:
+            self.last_trim = time.monotonic()
+            with connection:
+                connection.execute('DELETE FROM ChangeLog WHERE timestamp < ?;', [time.time() - retention])
+
+    def get_statistics(self):
+        """ Queue depth and flush timings for the worker, and the state of the character cache. """
+        return dict(self.statistics,
+                    queue_depth=self.queue.qsize(),
+                    characters=len(self.names),
+                    cached_characters=len(self.cache),
+                    cache_bytes=self.cache_bytes,
+                    unwritten_characters=len(self.dirty),
+                    searchable=self.searchable)
 
     def do_work(self):
         while self.active:
-            task = self.queue.get()
-            if task is None:
+            batch, stop, other = self.next_batch()
+            if batch:
+                self.flush(batch)
+            del batch  # don't hold the written characters while waiting for the next batch.
+            if isinstance(other, BulkWrite):
+                try:
+                    self.write_bulk(other)
+                except Exception as e:
+                    logging.error(f'Failed bulk write: {e}')
+                    if not other.future.done():
+                        other.future.set_exception(e)
+            elif isinstance(other, LoreWrite):
+                self.write_lore(other)
+            del other
+            if stop:
                 self.shutdown()
                 break
 
-            if isinstance(task, Character):
-                logging.info('Processing character data for %s', task.name)
-                query, values = task.to_sql()
-                self.execute_query(query, values)
-                with self.lock.w_locked():
-                    self.characters[task.name] = task
+    def shutdown(self):
+        """ Once the workers have finished, try again to write the batches that failed before closing the connection.
+        """
+        super().shutdown()
+        if self.connection is None:
+            return
+        for attempt in range(SHUTDOWN_RETRIES):
+            if not self.retry:
+                break
+            if attempt:
+                time.sleep(RETRY_INTERVAL)
+            batch, self.retry = self.retry, {}
+            self.flush(batch)
+        if self.retry:
+            logging.error(f'Closing with {len(self.retry)} characters unwritten.')
+        self.connection.close()
+        self.connection = None
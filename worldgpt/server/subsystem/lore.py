@@ -0,0 +1,178 @@
+
+
+"""
+    LoreBook
+    ========
+
+    The world's lore, entries of information shared by every character, each brought into a prompt when one of its
+    triggers is mentioned in the character's recent conversation, see `Lore` and `assemble_prompt`.
+
+    Every entry is kept in memory with its triggers in a `PhraseTrie`, so finding those mentioned takes one pass over
+    the conversation however many entries there are. Changes apply to memory at once and are written by the Database
+    worker, if writing them fails every entry is read again. A change the Database's queue refuses is undone.
+    The queue accepts the names of entries other processes sharing the datastore have written, which are read again,
+    or RELOAD to read every entry again.
+"""
+
+
+import logging
+from worldgpt.shared.model.lore import Lore
+from worldgpt.shared.util.task_queue import Overloaded
+from worldgpt.shared.util.phrase_trie import PhraseTrie
+from worldgpt.shared.util.singleton import Singleton
+from worldgpt.shared.util.subsystem import Subsystem
+
+
+RELOAD = '*'  # queued for the worker to read every entry again, an entry named '*' is reloaded with the rest.
+
+
+class LoreBook(Subsystem, metaclass=Singleton):
+
+    max_workers = 1  # reloading entries in the order they were changed.
+
+    def __init__(self):
+        super().__init__()
+        self.entries = {}  # name: Lore
+        self.messages = {}  # name: the entry as a Message, kept so its token count is memoized.
+        self.triggers = PhraseTrie()  # trigger: the names of the entries it triggers.
+        self.version = 0  # bumped whenever an entry changes, so prompts built with lore can be told apart.
+
+    def bootstrap(self):
+        logging.info('bootstrapping LoreBook')
+        from worldgpt.server.subsystem.database import Database
+        self.reload(RELOAD)
+        Database().lore_listeners.append(lambda name: self.queue.put(RELOAD if name is None else name))
+        self.active = True
+        self.start_workers()
+
+    def index(self, entry: Lore):
+        """ Keep an entry, replacing any of the same name. The lock must be held for writing. """
+        self.unindex(entry.name)
+        self.version += 1
+        self.entries[entry.name] = entry
+        self.messages[entry.name] = entry.to_message()
+        for trigger in entry.triggers:
+            self.triggers.add(trigger, entry.name)
+
+    def unindex(self, name: str):
+        """ Forget an entry, returns whether there was one. The lock must be held for writing. """
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return False
+        self.version += 1
+        del self.messages[name]
+        for trigger in entry.triggers:
+            self.triggers.remove(trigger, name)
+        return True
+
+    def restore(self, previous: dict, changed: dict):
+        """ Undo a change the Database refused, putting back the previous entries by name, None for none. An entry
+            changed again since is left as it is. The lock must be held for writing.
+        """
+        for name, entry in previous.items():
+            if self.entries.get(name) is not changed.get(name):
+                continue
+            if entry is None:
+                self.unindex(name)
+            else:
+                self.index(entry)
+
+    def store(self, entries: list):
+        """ Add or replace entries, used at once and queued to be written. Raises `Overloaded`, leaving the entries
+            as they were, if the Database is set to reject work while its queue is full.
+        """
+        from worldgpt.server.subsystem.database import Database
+        Database().queue.check()
+        with self.lock.w_locked():
+            previous = {x.name: self.entries.get(x.name) for x in entries}
+            for entry in entries:
+                self.index(entry)
+        try:
+            Database().store_lore(entries)
+        except Overloaded:
+            # the queue filled since it was checked.
+            with self.lock.w_locked():
+                self.restore(previous, {x.name: x for x in entries})
+            raise
+
+    def delete(self, name: str):
+        """ Remove an entry, returns whether there was one. Raises `Overloaded` as `store` does. """
+        from worldgpt.server.subsystem.database import Database
+        Database().queue.check()
+        with self.lock.w_locked():
+            previous = self.entries.get(name)
+            existed = self.unindex(name)
+        if existed:
+            try:
+                Database().store_lore([], [name])
+            except Overloaded:
+                with self.lock.w_locked():
+                    self.restore({name: previous}, {name: None})
+                raise
+        return existed
+
+    def get(self, name: str):
+        with self.lock.r_locked():
+            return self.entries.get(name)
+
+    def list_entries(self, after: str | None = None, limit: int = 100):
+        """ Returns a page of entries ordered by name, starting after the name `after`, and the cursor for the next
+            page or None if this is the last page.
+        """
+        with self.lock.r_locked():
+            names = sorted(x for x in self.entries if x > (after or ''))[:limit]
+            page = [self.entries[x] for x in names]
+        return page, names[-1] if len(names) == limit else None
+
+    def match(self, text: str):
+        """ Returns the names of the entries whose triggers are mentioned in the text, in the order they're sent to
+            the LM: highest priority first, then the most recently mentioned.
+        """
+        with self.lock.r_locked():
+            found = self.triggers.match(text)
+            priorities = {x: self.entries[x].priority for x in found}
+        return sorted(found, key=lambda x: (-priorities[x], -found[x], x))
+
+    def select(self, text: str, budget: int, model: str):
+        """ Returns the entries mentioned in the text as system Messages, and the tokens they use. Entries are taken in
+            the order of `match`, an entry too large for what's left of the budget is passed over for the next.
+        """
+        from worldgpt.server.util.tokens import count_message_tokens
+        chosen, used = [], 0
+        if budget <= 0:
+            return chosen, used
+        names = self.match(text)
+        with self.lock.r_locked():
+            candidates = [self.messages[x] for x in names if x in self.messages]
+        for message in candidates:
+            cost = count_message_tokens(message, model)
+            if used + cost <= budget:
+                chosen.append(message)
+                used += cost
+        return chosen, used
+
+    def reload(self, name: str):
+        """ Read an entry from the datastore again, or every entry with RELOAD. """
+        from worldgpt.server.subsystem.database import Database
+        entries = Database().read_lore(None if name == RELOAD else name)
+        with self.lock.w_locked():
+            if name == RELOAD:
+                self.entries, self.messages, self.triggers = {}, {}, PhraseTrie()
+                self.version += 1
+            else:
+                self.unindex(name)
+            for entry in entries:
+                self.index(entry)
+        if name == RELOAD:
+            logging.info(f'Loaded {len(entries)} entries of lore')
+
+    def do_work(self):
+        while self.active:
+            name = self.queue.get()
+            if name is None:
+                self.shutdown()
+                break
+            try:
+                self.reload(name)
+            except Exception as e:
+                logging.error(f'Failed to reload lore {name}: {e}')
@@ -0,0 +1,123 @@
+
+
+"""
+    Summarizer
+    ==========
+
+    Compacts character history into `Character.summaries` in the background.
+    The queue accepts the names of characters that have had new messages, once the unsummarized history of a character
+    exceeds the configured threshold the oldest messages are summarised by the LM, leaving the most recent history
+    verbatim. Summarized messages are kept in the datastore but are no longer sent to the LM, see `Character.summarized`.
+
+    Summarizing is background work, so it waits for player facing completions to finish before using the LM.
+"""
+
+
+import logging
+import threading
+import time
+from worldgpt.shared.model.character import Character
+from worldgpt.shared.util.singleton import Singleton
+from worldgpt.shared.util.subsystem import Subsystem
+from worldgpt.shared.util.task_queue import LOW, NORMAL, Overloaded
+
+
+class Summarizer(Subsystem, metaclass=Singleton):
+
+    queue_size = 1000
+    overflow = 'drop_oldest'  # a character that's dropped is queued again after their next completion.
+
+    def __init__(self):
+        super().__init__()
+        from worldgpt.server.util.llm import summarize_messages
+        self.summarize = summarize_messages  # (character, messages, model, max_tokens) -> str, replaceable for testing.
+        self.pending = set()  # names waiting in the queue, so a busy character is only queued once.
+        self.pending_lock = threading.Lock()
+
+    def bootstrap(self):
+        logging.info('bootstrapping Summarizer')
+        from worldgpt.server.subsystem.database import Database
+        # characters other processes sharing the datastore have written are summarized here too, after our own.
+        Database().change_listeners.append(lambda name: self.request(name, LOW))
+        self.active = True
+        self.start_workers()
+
+    def get_settings(self):
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return {'model': Configuration().summarizer_model or 'gpt-3.5-turbo',
+                    'threshold': Configuration().summarizer_threshold_tokens or 2048,
+                    'keep': Configuration().summarizer_keep_tokens or 0,
+                    'max_tokens': Configuration().summarizer_max_tokens or 256,
+                    'max_deferral': Configuration().summarizer_max_deferral or 0.0}
+
+    def request(self, name: str, priority: int = NORMAL):
+        """ Queue a character to be checked, this is cheap and safe to call after every completion. """
+        with self.pending_lock:
+            if name in self.pending:
+                return
+            self.pending.add(name)
+        try:
+            self.queue.put(name, priority)
+        except Overloaded:
+            self.dropped(name)
+            raise
+
+    def dropped(self, task):
+        with self.pending_lock:
+            self.pending.discard(task)
+
+    def defer_to_foreground(self, max_deferral: float):
+        """ Wait until no player facing completions are waiting on the LM, or until max_deferral has passed. """
+        from worldgpt.server.util.llm import in_flight
+        deadline = time.monotonic() + max_deferral
+        while in_flight() > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def compact(self, character: Character):
+        """ Summarise the oldest unsummarized messages of a character if their history exceeds the threshold.
+            Returns True if a summary was added.
+        """
+        from worldgpt.server.subsystem.database import Database
+        from worldgpt.server.util.prompt import window_history
+        from worldgpt.server.util.tokens import count_message_tokens
+        settings = self.get_settings()
+        with Database().character_locks(character.name):
+            start = character.summarized
+            history = character.messages[start:]
+        if sum(count_message_tokens(x, settings['model']) for x in history) <= settings['threshold']:
+            return False
+        recent, _ = window_history(history, settings['keep'], settings['model'])
+        end = start + len(history) - len(recent)
+        if end <= start:
+            return False
+
+        self.defer_to_foreground(settings['max_deferral'])
+        summary = self.summarize(character, history[:end - start], settings['model'], settings['max_tokens'])
+        with Database().character_locks(character.name):
+            if character.summarized != start:
+                return False
+            character.summaries.append(summary)
+            character.summarized = end
+        logging.info(f'Summarized {end - start} messages of {character.name}')
+        Database().store(character)
+        return True
+
+    def do_work(self):
+        while self.active:
+            task = self.queue.get()
+            if task is None:
+                self.shutdown()
+                break
+
+            if isinstance(task, str):
+                with self.pending_lock:
+                    self.pending.discard(task)
+                from worldgpt.server.subsystem.database import Database
+                character = Database().get_character(task)
+                if character is None:
+                    continue
+                try:
+                    self.compact(character)
+                except Exception as e:
+                    logging.error(f'Error summarizing {task}: {e}')
@@ -0,0 +1,149 @@
+
+
+"""
+    LLM Backends
+    ============
+
+    A backend is what actually talks to a Language model, `llm.py` builds the prompts and applies the responses.
+    Backends exchange requests and responses in the shape of OpenAI's chat completion API, which is what the rest of the
+    server already understands:
+        complete / acomplete return {"choices": [{"message": {"role": ..., "content": ...}}], "usage": {...}}
+        astream yields {"choices": [{"delta": {"role": ..., "content": ...}}]} as the response arrives.
+
+    The backend in use is set with the `llm_backend` configuration value. Backends included are:
+        openai  OpenAI's chat completion API.
+        fake    A local, deterministic stand-in for load testing without paying for real calls, see `fake_backend.py`.
+
+    To add your own, subclass LLMBackend and register it:
+
+        @register_backend('mine')
+        class MyBackend(LLMBackend):
+            ...
+"""
+
+
+import abc
+import importlib
+import logging
+
+
+class BackendError(Exception):
+    """ Raised by a backend when the LM fails to produce a response. """
+
+
+class LLMBackend(abc.ABC):
+
+    @abc.abstractmethod
+    def complete(self, model: str, messages: list, max_tokens: int) -> dict:
+        """ Blocking completion, for use outside of the event loop. """
+
+    @abc.abstractmethod
+    async def acomplete(self, model: str, messages: list, max_tokens: int) -> dict:
+        """ Completion that waits on the LM without holding a thread. """
+
+    @abc.abstractmethod
+    async def astream(self, model: str, messages: list, max_tokens: int):
+        """ Async iterator of response chunks, as they arrive. """
+
+    async def close(self):
+        """ Release anything held between requests, such as pooled connections. """
+        pass
+
+
+# name: backend class, or "module:class" to be imported when first used so unused backends cost nothing to import.
+_backends = {'openai': 'worldgpt.server.util.backend:OpenAIBackend',
+             'fake': 'worldgpt.server.util.fake_backend:FakeBackend'}
+_instances = {}
+
+
+def register_backend(name: str):
+    """ Class decorator adding a backend to the registry. """
+    def decorator(cls):
+        _backends[name] = cls
+        _instances.pop(name, None)
+        return cls
+    return decorator
+
+
+def get_backend_name() -> str:
+    """ The name of the configured backend. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    with Configuration().lock.r_locked():
+        return Configuration().llm_backend or 'openai'
+
+
+def get_backend(name: str | None = None) -> LLMBackend:
+    """ Returns the backend registered as name, or the configured backend. """
+    if name is None:
+        name = get_backend_name()
+    if name not in _instances:
+        if name not in _backends:
+            raise KeyError(f'No LLM backend registered as {name}, registered: {", ".join(_backends)}')
+        cls = _backends[name]
+        if isinstance(cls, str):
+            module, _, attribute = cls.partition(':')
+            cls = getattr(importlib.import_module(module), attribute)
+        logging.info(f'Using LLM backend {name}')
+        _instances[name] = cls()
+    return _instances[name]
+
+
+async def close_backends():
+    for backend in list(_instances.values()):
+        await backend.close()
+
+
+class OpenAIBackend(LLMBackend):
+    """ OpenAI's chat completion API, async requests share a pooled session so connections are kept alive. """
+
+    def __init__(self):
+        self.session = None
+
+    @staticmethod
+    def get_api_key():
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return Configuration().openai_api_key
+
+    def get_session(self):
+        """ Returns the pooled HTTP session, it must be called from within the running event loop. """
+        import aiohttp
+        if self.session is None or self.session.closed:
+            from worldgpt.server.subsystem.configuration import Configuration
+            with Configuration().lock.r_locked():
+                limit = Configuration().llm_max_concurrency or 64
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit))
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def complete(self, model: str, messages: list, max_tokens: int) -> dict:
+        import openai
+        try:
+            return openai.ChatCompletion.create(model=model, messages=messages, max_tokens=max_tokens,
+                                                api_key=self.get_api_key())
+        except openai.error.OpenAIError as e:
+            raise BackendError(str(e)) from e
+
+    async def acomplete(self, model: str, messages: list, max_tokens: int) -> dict:
+        import openai
+        openai.aiosession.set(self.get_session())
+        try:
+            return await openai.ChatCompletion.acreate(model=model, messages=messages, max_tokens=max_tokens,
+                                                       api_key=self.get_api_key())
+        except openai.error.OpenAIError as e:
+            raise BackendError(str(e)) from e
+
+    async def astream(self, model: str, messages: list, max_tokens: int):
+        import openai
+        openai.aiosession.set(self.get_session())
+        try:
+            stream = await openai.ChatCompletion.acreate(model=model, messages=messages, max_tokens=max_tokens,
+                                                         api_key=self.get_api_key(), stream=True)
+            async for chunk in stream:
+                yield chunk
+        except openai.error.OpenAIError as e:
+            raise BackendError(str(e)) from e
@@ -0,0 +1,155 @@
+
+
+"""
+    Bootstrapping and shutting down the server's subsystems.
+
+    With `api_workers` above 1 the API is served by that many processes, each bootstrapping its own subsystems when it
+    starts, see the startup event of the API. They share the datastore, which is the source of truth, and watch its
+    ChangeLog for characters the others have written, see `Database.watch`.
+
+    One of the processes sharing a datastore is the leader, whichever takes the leader lock first. Background work that
+    must only happen once runs in the leader: summarizing, trimming the ChangeLog and evicting from the audio cache.
+    If the leader exits the lock is released, but the other processes don't take over until they are restarted.
+
+    Each subsystem's workers and queue are configured from `subsystem_workers`, `subsystem_queue_sizes` and
+    `subsystem_overflow` before it's bootstrapped. When stopping, the subsystems that queue work for others stop first,
+    each finishing what's already queued.
+
+    The time each subsystem takes to bootstrap is logged once the server has started, and is served by
+    `/status/startup`. The tokenizer is warmed in the background meanwhile, its time is added to the report once done.
+"""
+
+
+import logging
+import time
+from contextlib import contextmanager
+from worldgpt.shared.util.file_lock import FileLock
+from worldgpt.shared.util.subsystem import Subsystem
+
+
+_leader_lock: FileLock | None = None  # held for the life of the process once it's the leader.
+startup_timings: dict = {}  # stage: seconds, in the order bootstrapped.
+background_timings: dict = {}  # stage: seconds, of the work left to finish in the background.
+
+
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[stage] = time.perf_counter() - started
+
+
+def get_startup_report():
+    """ Returns the seconds each stage of startup took, and their total. """
+    return {'stages': dict(startup_timings),
+            'background': dict(background_timings),
+            'total': sum(startup_timings.values())}
+
+
+def log_startup_report():
+    report = get_startup_report()
+    stages = ', '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in report['stages'].items())
+    logging.info(f'Started in {report["total"] * 1000:.1f}ms: {stages}')
+
+
+def become_leader(datastore: str):
+    """ Take the leader lock of the datastore if no other process holds it, returns whether this process is leader. """
+    global _leader_lock
+    if _leader_lock is None:
+        lock = FileLock(f'{datastore}.leader')
+        if lock.acquire(blocking=False):
+            _leader_lock = lock
+    return _leader_lock is not None
+
+
+def bootstrapped():
+    from worldgpt.server.subsystem.configuration import Configuration
+    return Configuration().active
+
+
+def bootstrap_configuration():
+    from worldgpt.server.subsystem.configuration import Configuration
+    if not Configuration().active:
+        with timed('configuration'):
+            Configuration().bootstrap()
+
+
+def warm_tokenizer():
+    """ Build the tokenizer of the models prompts are counted for in the background. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.server.util.tokens import warm_encoders
+    with Configuration().lock.r_locked():
+        models = {'gpt-3.5-turbo', Configuration().summarizer_model or 'gpt-3.5-turbo'}
+
+    def done(seconds: float):
+        background_timings['tokenizer'] = seconds
+        logging.info(f'Warmed the tokenizer in {seconds * 1000:.1f}ms')
+
+    warm_encoders(*sorted(models), done=done)
+
+
+def configure_subsystem(subsystem: Subsystem):
+    """ Apply the configured workers, queue size and overflow policy of a subsystem, before bootstrapping it. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    name = subsystem.__class__.__name__
+    with Configuration().lock.r_locked():
+        subsystem.configure((Configuration().subsystem_workers or {}).get(name),
+                            (Configuration().subsystem_queue_sizes or {}).get(name),
+                            (Configuration().subsystem_overflow or {}).get(name))
+
+
+def bootstrap_subsystems():
+    """ Instantiates and Bootstraps all subsystems."""
+    bootstrap_configuration()
+    from worldgpt.server.subsystem.audio_cache import AudioCache
+    from worldgpt.server.subsystem.completion_cache import CompletionCache
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.server.subsystem.database import Database
+    from worldgpt.server.subsystem.lore import LoreBook
+    from worldgpt.server.subsystem.summarizer import Summarizer
+    with Configuration().lock.r_locked():
+        workers = Configuration().api_workers or 1
+        datastore = Configuration().datastore
+    leader = become_leader(str(datastore))
+    logging.info(f'Bootstrapping as the {"leader" if leader else "follower"} of {workers} processes')
+
+    warm_tokenizer()
+    Database().leader = leader
+    with timed('database'):
+        configure_subsystem(Database())
+        Database().bootstrap()
+    with timed('lore'):
+        configure_subsystem(LoreBook())
+        LoreBook().bootstrap()
+    if leader:
+        with timed('summarizer'):
+            configure_subsystem(Summarizer())
+            Summarizer().bootstrap()
+    with timed('completion_cache'):
+        configure_subsystem(CompletionCache())
+        CompletionCache().bootstrap()
+    AudioCache().leader = leader
+    AudioCache().shared = workers > 1
+    with timed('audio_cache'):
+        configure_subsystem(AudioCache())
+        AudioCache().bootstrap()
+    log_startup_report()
+
+
+# those that queue work for others are stopped before them, any not named here are stopped before these.
+stop_order = ('Summarizer', 'LoreBook', 'CompletionCache', 'AudioCache', 'Database', 'Configuration')
+
+
+def shutdown_subsystems():
+    """ Shuts down all subsystems that were bootstrapped, each finishing the work already queued first."""
+    from worldgpt.server.subsystem.configuration import Configuration
+    from worldgpt.shared.util.singleton import Singleton
+    with Configuration().lock.r_locked():
+        timeout = Configuration().subsystem_stop_timeout or 30.0
+    subsystems = sorted((x for x in Singleton._instances.values() if isinstance(x, Subsystem) and x.active),
+                        key=lambda x: stop_order.index(type(x).__name__) if type(x).__name__ in stop_order else -1)
+    for subsystem in subsystems:
+        if not subsystem.stop(timeout):
+            logging.warning(f'{type(subsystem).__name__} did not finish its work within {timeout} seconds.')
@@ -0,0 +1,149 @@
+
+
+"""
+    Bulk import and export of characters as NDJSON, one character per line in the form `/characters/new` accepts.
+
+    An import is read as it arrives, each line validated on its own so a bad record is reported rather than failing the
+    rest. Valid characters are written in batches of `database_import_batch_size`, each batch by the Database worker in
+    a single transaction, while the next is validated. At most one batch is held waiting, beyond that an import only
+    keeps the name and line number of each character, to report duplicates, so it needs memory for the names it
+    imports but not their content.
+
+    An export pages through the characters by name, `database_export_page_size` at a time, and never holds more than a
+    page. Characters with changes that haven't been written yet are exported as they are in memory.
+"""
+
+
+import asyncio
+import json
+from typing import AsyncIterator
+from pydantic import ValidationError
+from worldgpt.shared.model.character import Character
+
+
+MAX_ERRORS = 1000  # errors reported in full by an import, the rest are only counted.
+MAX_LINE_BYTES = 16 * 1024 * 1024  # longer lines are reported as errors rather than read into memory.
+ALL_MESSAGES = 2 ** 62
+
+
+def get_settings():
+    from worldgpt.server.subsystem.configuration import Configuration
+    with Configuration().lock.r_locked():
+        return {'batch_size': Configuration().database_import_batch_size or 500,
+                'page_size': Configuration().database_export_page_size or 500}
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_bytes: int = MAX_LINE_BYTES):
+    """ Split a stream of bytes into lines as they arrive, yields (line number, line), or (line number, None) for a
+        line longer than max_bytes, which is skipped.
+    """
+    buffer = bytearray()
+    number = 1
+    skipping = False
+    async for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b'\n', start)) != -1:
+            if not skipping:
+                yield number, bytes(buffer[start:end])
+            skipping = False
+            number += 1
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > max_bytes:
+            if not skipping:
+                yield number, None
+            skipping = True
+            buffer.clear()
+    if buffer and not skipping:
+        yield number, bytes(buffer)
+
+
+def describe_error(error: Exception):
+    if isinstance(error, ValidationError):
+        return '; '.join(f'{".".join(str(x) for x in e["loc"])}: {e["msg"]}' for e in error.errors())
+    return str(error)
+
+
+async def import_characters(chunks: AsyncIterator[bytes], replace: bool = False):
+    """ Import characters from NDJSON, returns how many were imported, how many failed and why.
+        With replace, characters that exist are replaced, otherwise they're reported as errors.
+    """
+    from worldgpt.server.subsystem.database import Database
+    batch_size = get_settings()['batch_size']
+    summary = {'imported': 0, 'failed': 0, 'errors': []}
+    lines = {}  # name: line number, of every character seen, a name may only be imported once.
+    batch = []
+    writing = None  # the batch being written and the future of its errors.
+
+    def fail(number: int, name: str | None, error: str):
+        summary['failed'] += 1
+        if len(summary['errors']) < MAX_ERRORS:
+            summary['errors'].append({'line': number, 'name': name, 'error': error})
+
+    async def finish_writing():
+        written, queued = writing
+        future = await queued
+        errors = await asyncio.wrap_future(future)
+        summary['imported'] += len(written) - len(errors)
+        for character in written:
+            if character.name in errors:
+                fail(lines[character.name], character.name, errors[character.name])
+
+    async def write():
+        nonlocal writing, batch
+        if writing is not None:
+            await finish_writing()
+        # queueing may wait for room in the Database's queue, which mustn't hold up the event loop.
+        writing = (batch, asyncio.get_running_loop().run_in_executor(None, Database().write_characters, batch,
+                                                                     replace)) if batch else None
+        batch = []
+
+    async for number, line in read_lines(chunks):
+        if line is None:
+            fail(number, None, f'Line is longer than {MAX_LINE_BYTES} bytes.')
+            continue
+        if not line.strip():
+            continue
+        try:
+            character = Character.parse_raw(line)
+        except (ValidationError, ValueError) as e:
+            name = None
+            try:
+                name = json.loads(line).get('name')
+            except (ValueError, AttributeError):
+                pass
+            fail(number, name if isinstance(name, str) else None, describe_error(e))
+            continue
+        if character.name in lines:
+            fail(number, character.name, f'Duplicate of the character on line {lines[character.name]}.')
+            continue
+        lines[character.name] = number
+        batch.append(character)
+        if len(batch) >= batch_size:
+            await write()
+    await write()
+    if writing is not None:
+        await finish_writing()
+    return summary
+
+
+def export_characters(messages: bool = True):
+    """ Yields each character as a line of NDJSON, ordered by name. A character that can't be read is yielded as a line
+        of {"name": ..., "error": ...} in its place.
+    """
+    from worldgpt.server.subsystem.database import Database
+    page_size = get_settings()['page_size']
+    cursor = None
+    while True:
+        page, cursor = Database().list_characters(cursor, page_size, None, ALL_MESSAGES if messages else None)
+        lines = []
+        for entry in page:
+            try:
+                lines.append(Character.parse_obj(entry).json(exclude=None if messages else {'messages'}))
+            except (ValidationError, ValueError, TypeError) as e:
+                lines.append(json.dumps({'name': entry.get('name'), 'error': describe_error(e)}))
+        if lines:
+            yield '\n'.join(lines) + '\n'
+        if cursor is None:
+            return
@@ -0,0 +1,108 @@
+
+
+"""
+    A local stand-in for a Language model, so the whole server can be load tested offline.
+
+    The response to a prompt is always the same, generated from a hash of the prompt, while its timing and failures are
+    drawn from a seeded random generator:
+        fake_llm_latency            median seconds before the first token arrives.
+        fake_llm_latency_sigma      spread of the lognormal latency distribution, 0 for a fixed latency.
+        fake_llm_tokens_per_second  the rate tokens arrive at after the first, a completion waits for all of them.
+        fake_llm_failure_rate       the chance a request fails with a BackendError, from 0 to 1.
+        fake_llm_seed               seed for latency and failures, unset for a different sequence each run.
+"""
+
+
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from worldgpt.server.util.backend import BackendError, LLMBackend
+
+
+vocabulary = ('the', 'a', 'traveller', 'road', 'north', 'tavern', 'ale', 'coin', 'sword', 'king', 'village', 'night',
+              'is', 'was', 'will', 'be', 'dangerous', 'quiet', 'old', 'I', 'you', 'we', 'have', 'heard', 'seen',
+              'rumours', 'of', 'wolves', 'in', 'hills', 'and', 'my', 'friend', 'perhaps', 'not', 'today')
+
+
+class FakeBackend(LLMBackend):
+
+    def __init__(self):
+        settings = self.get_settings()
+        self.random = random.Random(settings['seed'])
+        self.random_lock = threading.Lock()
+
+    @staticmethod
+    def get_settings():
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return {'latency': Configuration().fake_llm_latency,
+                    'sigma': Configuration().fake_llm_latency_sigma,
+                    'rate': Configuration().fake_llm_tokens_per_second,
+                    'failure_rate': Configuration().fake_llm_failure_rate,
+                    'seed': Configuration().fake_llm_seed}
+
+    def plan(self, model: str, messages: list, max_tokens: int):
+        """ Decide the response to a prompt and how long each part of it takes.
+            Returns the tokens of the response, the delay before the first, the delay between each and usage.
+        """
+        settings = self.get_settings()
+        with self.random_lock:
+            latency = settings['latency'] * self.random.lognormvariate(0, settings['sigma']) \
+                if settings['sigma'] else settings['latency']
+            failed = self.random.random() < settings['failure_rate']
+        if failed:
+            raise BackendError('Injected failure from the fake LLM backend.')
+
+        digest = hashlib.sha256(json.dumps([model, messages], sort_keys=True).encode()).digest()
+        generator = random.Random(digest)
+        length = min(max_tokens, 8 + digest[0] % 56)
+        words = [generator.choice(vocabulary) for _ in range(length)]
+        # sentences of 4 to 12 words, so there is something to split for the voice pipeline.
+        tokens, sentence = [], 0
+        for index, word in enumerate(words):
+            sentence += 1
+            if sentence == 1:
+                word = word.capitalize()
+            if index == length - 1 or (sentence >= 4 and generator.random() < sentence / 12):
+                word, sentence = f'{word}.', 0
+            tokens.append(word if index == 0 else f' {word}')
+        prompt_tokens = sum(len(str(x.get('content', '')).split()) + 4 for x in messages)
+        usage = {'prompt_tokens': prompt_tokens,
+                 'completion_tokens': length,
+                 'total_tokens': prompt_tokens + length}
+        return tokens, latency, 1 / settings['rate'], usage
+
+    @staticmethod
+    def response(model: str, tokens: list, usage: dict):
+        return {'object': 'chat.completion',
+                'model': model,
+                'choices': [{'index': 0,
+                             'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                             'finish_reason': 'stop'}],
+                'usage': usage}
+
+    def complete(self, model: str, messages: list, max_tokens: int) -> dict:
+        tokens, latency, interval, usage = self.plan(model, messages, max_tokens)
+        time.sleep(latency + interval * (len(tokens) - 1))
+        return self.response(model, tokens, usage)
+
+    async def acomplete(self, model: str, messages: list, max_tokens: int) -> dict:
+        tokens, latency, interval, usage = self.plan(model, messages, max_tokens)
+        await asyncio.sleep(latency + interval * (len(tokens) - 1))
+        return self.response(model, tokens, usage)
+
+    async def astream(self, model: str, messages: list, max_tokens: int):
+        tokens, latency, interval, usage = self.plan(model, messages, max_tokens)
+        await asyncio.sleep(latency)
+        yield {'object': 'chat.completion.chunk', 'model': model,
+               'choices': [{'index': 0, 'delta': {'role': 'assistant'}, 'finish_reason': None}]}
+        for index, token in enumerate(tokens):
+            if index:
+                await asyncio.sleep(interval)
+            yield {'object': 'chat.completion.chunk', 'model': model,
+                   'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+        yield {'object': 'chat.completion.chunk', 'model': model,
+               'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
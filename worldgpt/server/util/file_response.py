@@ -0,0 +1,90 @@
+
+
+"""
+    Serving files from disk without reading them into memory.
+    Files are streamed in chunks from a handle opened before responding, so a file removed while it's being sent, such
+    as a clip the audio cache evicts, is still sent whole. A file removed before it's opened is answered with 404.
+    A request for a byte range, as players of audio make when seeking, is answered with just that range.
+"""
+
+
+import os
+import re
+from email.utils import formatdate
+import anyio
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+CHUNK_SIZE = 64 * 1024
+range_pattern = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: str, size: int):
+    """ Returns the (start, end) inclusive of a single byte range, None if it should be ignored and the whole file sent,
+        or raises ValueError if the range can't be satisfied.
+    """
+    match = range_pattern.match(header.strip())
+    if match is None:
+        return None  # multiple ranges, or a unit other than bytes.
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+    if start == '':
+        length = int(end)
+        if length == 0:
+            raise ValueError('Empty suffix range.')
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise ValueError('Range starts beyond the end of the file.')
+    return start, end
+
+
+async def read_range(file, start: int, end: int):
+    """ Yields the range of a file opened by `file_response`, which is closed once it has been read or the response is
+        abandoned. """
+    async with anyio.wrap_file(file) as file:
+        await file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request: Request, path: str, media_type: str | None = None, headers: dict | None = None):
+    """ Respond with a file, or the byte range of it the request asked for. """
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return JSONResponse({'error': 'File does not exist.'}, status_code=404)
+    stat = os.fstat(file.fileno())
+    size = stat.st_size
+    headers = dict(headers or {}, **{'Accept-Ranges': 'bytes',
+                                     'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+                                     'ETag': f'"{int(stat.st_mtime_ns):x}-{size:x}"'})
+    header = request.headers.get('range')
+    try:
+        byte_range = parse_range(header, size) if header else None
+    except ValueError:
+        file.close()
+        return Response(status_code=416, headers=dict(headers, **{'Content-Range': f'bytes */{size}'}))
+    if byte_range is None:
+        headers['Content-Length'] = str(size)
+        return StreamingResponse(read_range(file, 0, size - 1), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers.update({'Content-Range': f'bytes {start}-{end}/{size}', 'Content-Length': str(end - start + 1)})
+    return StreamingResponse(read_range(file, start, end), status_code=206, media_type=media_type, headers=headers)
+
+
+def resolve_within(directory: str, path: str):
+    """ Returns the real path of path within directory, or None if it would lead outside of it or isn't a file. """
+    root = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root or not os.path.isfile(resolved):
+        return None
+    return resolved
@@ -6,37 +6,210 @@ Included within the wordgpt server will be examples using OpenAI's GPT Models.
 I figured this will be the place people would most diverge from my implementation,
 so I'm going to try to make it easy to do that.
 
+The Language model itself is reached through a backend, see `backend.py` to add your own.
+
+The time each completion spends in each stage is recorded for `/metrics`:
+    turn_wait               waiting for the previous completion of the same character to finish.
+    prompt_assembly         building the prompt, including token_counting, recalling past messages and lore.
+    token_counting          encoding messages whose token counts weren't memoized.
+    cache_lookup            looking the prompt up in the completion cache.
+    slot_wait               waiting for a free slot within the concurrency limits.
+    upstream                the request to the LM, until the last of a streamed response.
+    upstream_first_token    until the first content of a streamed response.
+    enqueue                 applying the response to the character and queueing it to be stored.
+    total                   all of the above.
 """
+import asyncio
 import json
 import logging
+import time
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from typing import List
-import openai
-from openai import ChatCompletion
 from worldgpt.shared.model.character import Character
 from worldgpt.shared.model.message import Message
+from worldgpt.shared.util.keyed_lock import KeyedAsyncLock, KeyedLock
+from worldgpt.shared.util.metrics import Counter, Histogram
+from worldgpt.shared.util.task_queue import Overloaded
 from worldgpt.server.subsystem.database import Database
+from worldgpt.server.util.backend import get_backend, get_backend_name
+from worldgpt.server.util.prompt import llm_pretext_messages, assemble_prompt
+from worldgpt.server.util.tokens import TOKENS_MAX, counting_seconds
+
+
+# Semaphores limiting upstream requests in flight, keyed by model name, `None` holds the global limit.
+_semaphores: dict = {}
+# Completions for the same character take turns, so each is prompted with the history the previous one left.
+# Those within the event loop queue on _turns, in the order they were requested, then take _thread_turns, which
+# synchronous completions made from other threads take too.
+_turns = KeyedAsyncLock()
+_thread_turns = KeyedLock()
+# Player facing completions currently waiting on the LM, background work such as summarizing defers to these.
+_in_flight: int = 0
+# The most messages of a character's history indexed for recall within the event loop, see `prepare_recall`.
+INDEX_IN_LOOP = 64
+
+stage_seconds = Histogram('worldgpt_completion_stage_seconds', 'Seconds each completion spent in each stage.',
+                          ('mode', 'stage'))
+token_usage = Counter('worldgpt_llm_tokens_total', 'Tokens used as reported by the LM, streamed responses report none.',
+                      ('model', 'kind'))
+
+
+def get_semaphore(model: str | None):
+    """ Returns the semaphore for a model, or the global semaphore when model is None.
+        Models without a configured limit share only the global limit.
+    """
+    if model not in _semaphores:
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            limit = Configuration().llm_max_concurrency if model is None \
+                else (Configuration().llm_model_concurrency or {}).get(model)
+        _semaphores[model] = asyncio.Semaphore(limit) if limit else None
+    return _semaphores[model]
+
+
+@asynccontextmanager
+async def concurrency_limit(model: str, mode: str = 'async'):
+    """ Wait for a free slot for the model before taking a global slot, so that a saturated model does not hold global
+        slots that other models could be using.
+    """
+    global _in_flight
+    _in_flight += 1
+    try:
+        started = time.perf_counter()
+        async with get_semaphore(model) or nullcontext():
+            async with get_semaphore(None) or nullcontext():
+                stage_seconds.observe(time.perf_counter() - started, mode=mode, stage='slot_wait')
+                yield
+    finally:
+        _in_flight -= 1
+
+
+@asynccontextmanager
+async def take_turn(name: str, mode: str):
+    """ Wait for the completions of the character requested before this one. """
+    started = time.perf_counter()
+    async with _turns(name):
+        async with _thread_turns.acquire_async(name):
+            stage_seconds.observe(time.perf_counter() - started, mode=mode, stage='turn_wait')
+            yield
+
+
+@contextmanager
+def take_thread_turn(name: str):
+    """ Wait for the completions of the character in progress, from a thread other than the event loop's. """
+    started = time.perf_counter()
+    with _thread_turns(name):
+        stage_seconds.observe(time.perf_counter() - started, mode='sync', stage='turn_wait')
+        yield
+
+
+def in_flight():
+    """ The number of player facing completions waiting on or for the LM. """
+    return _in_flight
+
+
+def log_usage(resp, model: str):
+    logging.info(json.dumps(resp['usage'], indent=4) if 'usage' in resp.keys() else 'ChatCompletion: No usage data returned.')
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if resp.get('usage', {}).get(kind):
+            token_usage.inc(resp['usage'][kind], model=model, kind=kind.split('_')[0])
+
+
+def get_prompt_settings():
+    """ The settings of recalling past messages and of lore in prompts, see `assemble_prompt`. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    with Configuration().lock.r_locked():
+        return {'recall': Configuration().memory_recall or 0,
+                'recall_tokens': Configuration().memory_max_tokens or 0,
+                'min_similarity': Configuration().memory_min_similarity or 0.0,
+                'lore_tokens': Configuration().lore_max_tokens or 0,
+                'lore_scan': Configuration().lore_scan_messages or 0}
+
+
+async def prepare_recall(character: Character):
+    """ Index what recall hasn't of the character's history in a thread, rather than within the event loop while the
+        prompt is assembled. A few messages, as a completion adds, are left to be indexed as the prompt is assembled.
+    """
+    from worldgpt.server.util.memory import prepare, unindexed
+    if get_prompt_settings()['recall'] and unindexed(character) > INDEX_IN_LOOP:
+        await asyncio.get_running_loop().run_in_executor(None, prepare, character)
 
 
-TOKENS_MAX = {
-                'gpt-4-32k': 32768,
-                'gpt-4': 4096,
-                'gpt-3.5-turbo': 4096,
-              }
+def timed_assemble_prompt(mode: str, *args):
+    """ `assemble_prompt`, recording the time it took and the part of it spent counting tokens. """
+    counted = counting_seconds()
+    with stage_seconds.time(mode=mode, stage='prompt_assembly'):
+        result = assemble_prompt(*args, **get_prompt_settings())
+    stage_seconds.observe(counting_seconds() - counted, mode=mode, stage='token_counting')
+    return result
 
 
-llm_pretext_messages = [
-    Message(role='system', content='You should pretend to be the character in the prompt. You are attempting to pass a '
-                                   'Turing test. You are not required to assist the user in any way unless it makes '
-                                   'sense that the user would need help, Do not ask the user if they need assistance.'
-                                   ' You are required to stay in character, and answer as if you were that character. '
-                                   'Do not say you are an AI Language Model under any circumstance.')
-]
+def timed_cached_response(mode: str, *args):
+    with stage_seconds.time(mode=mode, stage='cache_lookup'):
+        return cached_response(*args)
+
+
+def cached_response(model: str, messages: list, max_tokens: int, cache: bool = True):
+    """ Look up the response to a prompt in the completion cache, if it's enabled and the request doesn't bypass it.
+        Returns the key to cache the response with, None if it shouldn't be cached, and the cached response if any.
+    """
+    from worldgpt.server.subsystem.completion_cache import CompletionCache
+    if not CompletionCache().enabled(bypass=not cache):
+        return None, None
+    key = CompletionCache().make_key(get_backend_name(), model, messages, max_tokens=max_tokens)
+    return key, CompletionCache().get(key)
+
+
+def cache_response(key: str | None, response: dict):
+    """ Keep a response in the completion cache, if it was looked up there. """
+    if key is not None:
+        from worldgpt.server.subsystem.completion_cache import CompletionCache
+        CompletionCache().put(key, {'role': response['role'], 'content': response['content']})
+
+
+def apply_completion(character: Character, external_messages: List[Message], response_message: Message):
+    """ Apply the LM response to the character and queue the character to be stored.
+        If the Database is set to reject work while its queue is full, `Overloaded` is raised and the character is left
+        as it was, the turn isn't kept.
+    """
+    Database().queue.check()
+    added = [x for x in external_messages if x.role == 'user'] + [response_message]
+    with Database().character_locks(character.name):
+        # add the users messages to the character information, to keep context.
+        character.messages.extend(added)
+    try:
+        Database().store(character)
+    except Overloaded:
+        # the queue filled since it was checked, take the turn back rather than keep what the client is told failed.
+        with Database().character_locks(character.name):
+            if len(character.messages) >= len(added) and \
+                    all(x is y for x, y in zip(character.messages[-len(added):], added)):
+                del character.messages[-len(added):]
+        raise
+
+    from worldgpt.server.subsystem.summarizer import Summarizer
+    if Summarizer().active:
+        try:
+            Summarizer().request(character.name)
+        except Overloaded:
+            pass  # background work, the character is queued again after their next completion.
+
+    return response_message
+
+
+async def aapply_completion(character: Character, external_messages: List[Message], response_message: Message):
+    """ `apply_completion` in the default executor, as storing the character waits while the Database's queue is full.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, apply_completion, character, external_messages,
+                                                            response_message)
 
 
 def generate_chat_completion(character: Character,
                              external_messages: List[Message],
                              model='gpt-3.5-turbo',
-                             max_tokens=128
+                             max_tokens=128,
+                             dynamic_max_tokens=False,
+                             cache=True
                              ):
     """
     Accepts a character object in order to process previous data.
@@ -44,37 +217,119 @@ def generate_chat_completion(character: Character,
         messages from other users, etc.
     max_tokens instructs the LM not to generate more than the set tokens, if this value is too short it may cause
         the LM to generate a response that is not complete.
+    dynamic_max_tokens allows the response to use whatever the prompt leaves of the model's token limit, with
+        max_tokens as the minimum. The character's history is trimmed to the most recent messages that fit, if the rest
+        of the prompt doesn't fit `PromptTooLarge` is raised.
+    cache allows the response to come from the completion cache, when it's enabled. False always asks the LM.
+    Completions for the same character are made one at a time, this waits for any in progress, async ones included.
+    Don't call it from the event loop, waiting would block it.
     """
+    with stage_seconds.time(mode='sync', stage='total'), take_thread_turn(character.name):
+        messages, max_tokens = timed_assemble_prompt('sync', character, external_messages, model, max_tokens,
+                                                     dynamic_max_tokens)
 
-    from worldgpt.server.subsystem.configuration import Configuration
-    with Configuration().lock.r_locked():
-        openai.api_key = Configuration().openai_api_key
+        key, response = timed_cached_response('sync', model, messages, max_tokens, cache)
+        if response is None:
+            # send the information to the LLM
+            with stage_seconds.time(mode='sync', stage='upstream'):
+                resp = get_backend().complete(model=model, messages=messages, max_tokens=max_tokens)
+            log_usage(resp, model)
+            # todo check for errors in the response.
+            response = resp['choices'][0]['message']
+            cache_response(key, response)
 
-    messages = []
+        # transform output to message and apply it to the character.
+        with stage_seconds.time(mode='sync', stage='enqueue'):
+            return apply_completion(character, external_messages, Message(**response))
 
-    messages += [x.to_openai() for x in character.to_prompt_messages()]
-    messages += [x.to_openai() for x in llm_pretext_messages]
-    messages += [x.to_openai() for x in external_messages]
 
-    # todo count prompt tokens and bail if exceed TOKENS_MAX[model]
-    from worldgpt.server.util.tokens import count_prompt_tokens
+async def agenerate_chat_completion(character: Character,
+                                    external_messages: List[Message],
+                                    model='gpt-3.5-turbo',
+                                    max_tokens=128,
+                                    dynamic_max_tokens=False,
+                                    cache=True
+                                    ):
+    """
+    Async version of `generate_chat_completion`, waiting on the LM does not hold a thread.
+    The request waits for a free slot within the configured concurrency limits.
+    Completions for the same character are made one at a time, in the order they were requested.
+    """
+    with stage_seconds.time(mode='async', stage='total'):
+        async with take_turn(character.name, 'async'):
+            await prepare_recall(character)
+            messages, max_tokens = timed_assemble_prompt('async', character, external_messages, model, max_tokens,
+                                                         dynamic_max_tokens)
 
-    # send the information to the LLM
-    resp = ChatCompletion.create(model=model, messages=messages, max_tokens=max_tokens)
-    logging.info(json.dumps(resp['usage'], indent=4) if 'usage' in resp.keys() else 'ChatCompletion: No usage data returned.')
-    # todo here we could include a token counter for the model.
-    # todo check for errors in the response.
+            key, response = timed_cached_response('async', model, messages, max_tokens, cache)
+            if response is None:
+                # send the information to the LLM
+                async with concurrency_limit(model):
+                    with stage_seconds.time(mode='async', stage='upstream'):
+                        resp = await get_backend().acomplete(model=model, messages=messages, max_tokens=max_tokens)
+                log_usage(resp, model)
+                response = resp['choices'][0]['message']
+                cache_response(key, response)
+            with stage_seconds.time(mode='async', stage='enqueue'):
+                return await aapply_completion(character, external_messages, Message(**response))
 
-    # transform output to message and apply it to the character.
-    response_message = Message(**resp['choices'][0]['message'])
 
-    # add the users messages to the character information, to keep context.
-    for message in external_messages:
-        if message.role == 'user':
-            character.messages.append(message)
+async def astream_chat_completion(character: Character,
+                                  external_messages: List[Message],
+                                  model='gpt-3.5-turbo',
+                                  max_tokens=128,
+                                  dynamic_max_tokens=False,
+                                  cache=True
+                                  ):
+    """
+    Streaming version of `agenerate_chat_completion`, yields the content of the response as it arrives from the LM.
+    Once the stream has finished the full message is applied to the character and stored, as with a regular
+    completion. If the stream is abandoned before it finishes nothing is applied to the character.
+    Completions for the same character are made one at a time, in the order they were requested.
+    A response from the completion cache is yielded whole.
+    """
+    started = time.perf_counter()
+    async with take_turn(character.name, 'stream'):
+        await prepare_recall(character)
+        messages, max_tokens = timed_assemble_prompt('stream', character, external_messages, model, max_tokens,
+                                                     dynamic_max_tokens)
 
-    character.messages.append(response_message)
-    Database().queue.put(character)
+        key, response = timed_cached_response('stream', model, messages, max_tokens, cache)
+        if response is None:
+            role = 'assistant'
+            content = []
+            async with concurrency_limit(model, 'stream'):
+                requested = time.perf_counter()
+                async for chunk in get_backend().astream(model=model, messages=messages, max_tokens=max_tokens):
+                    delta = chunk['choices'][0].get('delta', {})
+                    role = delta.get('role', role)
+                    if delta.get('content'):
+                        if not content:
+                            stage_seconds.observe(time.perf_counter() - requested, mode='stream',
+                                                  stage='upstream_first_token')
+                        content.append(delta['content'])
+                        yield delta['content']
+                stage_seconds.observe(time.perf_counter() - requested, mode='stream', stage='upstream')
+            response = {'role': role, 'content': ''.join(content)}
+            cache_response(key, response)
+        else:
+            yield response['content']
+
+        with stage_seconds.time(mode='stream', stage='enqueue'):
+            await aapply_completion(character, external_messages, Message(**response))
+    stage_seconds.observe(time.perf_counter() - started, mode='stream', stage='total')
+
+
+summarizer_pretext = ('Summarise the conversation so far between {name} (the assistant) and the user, from the '
+                      'perspective of {name}. Keep names, promises, facts learnt about the user and anything {name} '
+                      'would remember. Be concise, do not add anything that was not said.')
 
-    return response_message
 
+def summarize_messages(character: Character, messages: List[Message], model='gpt-3.5-turbo', max_tokens=256):
+    """ Ask the LM to summarise the messages of a character's history, returns the summary. """
+    prompt = [x.to_openai() for x in messages]
+    prompt.append(Message(role='system', content=summarizer_pretext.format(name=character.name)).to_openai())
+    with stage_seconds.time(mode='summarize', stage='upstream'):
+        resp = get_backend().complete(model=model, messages=prompt, max_tokens=max_tokens)
+    log_usage(resp, model)
+    return resp['choices'][0]['message']['content']
@@ -0,0 +1,64 @@
+
+
+"""
+    A local stand-in for a voice synthesizer, so the voice pipeline can be measured and tested offline.
+
+    Text is "spoken" as a WAV of short tones, one per character of the text, so the length of the audio follows the
+    length of the text as speech would and the same text always gives the same audio. How long synthesis takes is set by:
+        tts_local_latency           seconds before any audio is returned.
+        tts_local_seconds_per_char  seconds added for each character of the text.
+"""
+
+
+import asyncio
+import io
+import math
+import struct
+import wave
+from functools import lru_cache
+from worldgpt.server.util.tts import TTSBackend
+
+
+SAMPLE_RATE = 8000
+CHAR_SECONDS = 0.06  # about the rate of speech, 15 or so characters a second.
+
+
+@lru_cache(maxsize=64)
+def tone(pitch: int):
+    """ The 16 bit PCM samples of one character, pitch 0 being silence. """
+    count = int(SAMPLE_RATE * CHAR_SECONDS)
+    if pitch == 0:
+        return b'\x00\x00' * count
+    frequency = 180 + pitch * 12
+    return struct.pack(f'<{count}h', *(int(6000 * math.sin(2 * math.pi * frequency * x / SAMPLE_RATE))
+                                        for x in range(count)))
+
+
+def render(text: str):
+    """ The WAV audio of text. """
+    frames = b''.join(tone(0 if x.isspace() else 1 + ord(x) % 32) for x in text)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(SAMPLE_RATE)
+        audio.writeframes(frames)
+    return buffer.getvalue()
+
+
+class LocalSynthesizer(TTSBackend):
+
+    media_type = 'audio/wav'
+    extension = 'wav'
+
+    @staticmethod
+    def get_settings():
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return {'latency': Configuration().tts_local_latency,
+                    'per_char': Configuration().tts_local_seconds_per_char}
+
+    async def synthesize(self, text: str, voice: str, settings: dict) -> bytes:
+        timing = self.get_settings()
+        await asyncio.sleep(timing['latency'] + timing['per_char'] * len(text))
+        return render(text)
@@ -0,0 +1,192 @@
+
+
+"""
+    Long-term memory, recalling the past messages of a character most relevant to what the player just said.
+
+    Each message is represented by a hashed bag of words: its words, less the most common, are hashed into one of
+    DIMENSIONS buckets with a sign, and the vector of bucket weights normalized to a length of 1. The similarity of two
+    messages is the dot product of their vectors, from 0 for no words in common up to 1. Nothing is trained or
+    downloaded and it runs on the CPU, though it only knows words and not their meaning, so "wolf" recalls messages
+    mentioning wolves and not those mentioning hounds.
+
+    A character's index is kept on the character, like their rendered prompt, and lives as long as they're in memory.
+    The vectors are sparse, only the buckets of the words a message has are stored, so the index needs bytes per word
+    of history rather than per bucket. A message is indexed once, the first time recall is asked for after it's added,
+    and every message of the history is scored against the player's input at once with NumPy. Indexing a whole history,
+    as when a character is read again, takes a while, so async completions do it in a thread first, see `prepare`.
+
+    Enabled with `memory_recall`, see `assemble_prompt`.
+"""
+
+
+import functools
+import math
+import re
+import threading
+import zlib
+import numpy
+from typing import List
+from worldgpt.shared.model.character import Character
+from worldgpt.shared.model.message import Message
+
+
+DIMENSIONS = 1 << 18  # buckets words are hashed into, enough that different words rarely share one.
+WORDS = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset("""a about above after again all am an and any are as at be because been before being below
+    between both but by can could did do does doing down during each few for from further had has have having he her here hers
+    him his how i if in into is it its just me more most my no nor not now of off on once only or other our ours out
+    over own same she should so some such than that the their theirs them then there these they this those through to
+    too under until up very was we were what when where which while who whom why will with would you your yours
+    i'm you're it's don't i'll i've""".split())
+
+
+@functools.lru_cache(maxsize=65536)
+def hash_word(word: str):
+    """ Returns the bucket of a word and its sign, so words sharing a bucket more often cancel than add up. """
+    digest = zlib.crc32(word.encode())
+    return digest & (DIMENSIONS - 1), 1.0 if digest & 0x80000000 else -1.0
+
+
+def vectorize(texts: List[str]):
+    """ Returns the sparse vectors of texts, each of length 1 or empty if the text has no words, as three arrays: the
+        text each weight belongs to, in order, the bucket and the weight. Repeating a word adds less each time, the
+        weight of a word is 1 + log(count).
+    """
+    rows, buckets, values = [], [], []
+    for row, text in enumerate(texts):
+        counts = {}
+        for word in WORDS.findall(text.lower()):
+            if word not in STOPWORDS:
+                counts[word] = counts.get(word, 0) + 1
+        weights = {}
+        for word, count in counts.items():
+            bucket, sign = hash_word(word)
+            weights[bucket] = weights.get(bucket, 0.0) + sign * (1.0 + math.log(count))
+        rows.extend([row] * len(weights))
+        buckets.extend(weights.keys())
+        values.extend(weights.values())
+    rows = numpy.array(rows, dtype=numpy.int32)
+    values = numpy.array(values, dtype=numpy.float32)
+    norms = numpy.sqrt(numpy.bincount(rows, weights=values * values, minlength=len(texts))).astype(numpy.float32)
+    return rows, numpy.array(buckets, dtype=numpy.int32), values / numpy.maximum(norms[rows], 1e-12)
+
+
+class MemoryIndex:
+    """ The vectors of every message of a character's history, in the order of the history.
+        Each weight stored is kept with its bucket and the message it belongs to, in flat arrays that grow by doubling.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # held while messages are indexed or scored, a completion may run in any thread.
+        self.messages: list = []  # the messages indexed, to notice if the history is replaced rather than added to.
+        self.rows = numpy.empty(0, dtype=numpy.int32)  # the message of each stored weight.
+        self.buckets = numpy.empty(0, dtype=numpy.int32)
+        self.values = numpy.empty(0, dtype=numpy.float32)
+        self.size = 0  # weights stored, the arrays beyond are spare capacity.
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.buckets.nbytes + self.values.nbytes + len(self.messages) * 8
+
+    def update(self, history: List[Message]):
+        """ Index the messages added to the history since the last update. The history is expected to grow by adding
+            messages at the end, if it's changed otherwise everything is indexed again.
+        """
+        indexed = len(self.messages)
+        if len(history) < indexed or (indexed and history[indexed - 1] is not self.messages[-1]):
+            self.clear()
+            indexed = 0
+        if len(history) == indexed:
+            return
+        rows, buckets, values = vectorize([x.content for x in history[indexed:]])
+        end = self.size + len(rows)
+        self.reserve(end)
+        self.rows[self.size:end] = rows + indexed
+        self.buckets[self.size:end] = buckets
+        self.values[self.size:end] = values
+        self.size = end
+        self.messages.extend(history[indexed:])
+
+    def reserve(self, capacity: int):
+        if capacity <= len(self.rows):
+            return
+        capacity = max(capacity, len(self.rows) * 2, 1024)
+        for name in ('rows', 'buckets', 'values'):
+            current = getattr(self, name)
+            grown = numpy.empty(capacity, dtype=current.dtype)
+            grown[:self.size] = current[:self.size]
+            setattr(self, name, grown)
+
+    def clear(self):
+        self.messages = []
+        self.size = 0
+
+    def score(self, query: str, end: int):
+        """ Returns the similarity of each of the first `end` messages to the query. """
+        _, buckets, values = vectorize([query])
+        scores = numpy.zeros(end, dtype=numpy.float32)
+        if not len(buckets) or not end:
+            return scores
+        dense = numpy.zeros(DIMENSIONS, dtype=numpy.float32)
+        dense[buckets] = values
+        stored = numpy.searchsorted(self.rows[:self.size], end)  # rows are ascending, the weights of the first `end`.
+        contributions = dense[self.buckets[:stored]] * self.values[:stored]
+        return numpy.bincount(self.rows[:stored], weights=contributions, minlength=end)[:end].astype(numpy.float32)
+
+    def nearest(self, query: str, end: int, count: int, min_similarity: float):
+        """ Returns the indices of the most similar of the first `end` messages to the query and their similarity, most
+            similar first, at most `count` and none below min_similarity.
+        """
+        scores = self.score(query, end)
+        count = min(count, end)
+        if not count:
+            return []
+        best = numpy.argpartition(-scores, count - 1)[:count]
+        best = best[numpy.argsort(-scores[best], kind='stable')]
+        return [(int(x), float(scores[x])) for x in best if scores[x] >= min_similarity and scores[x] > 0]
+
+
+def get_index(character: Character):
+    """ Returns the memory index of a character, made the first time it's wanted. """
+    index = character._memory
+    if index is None:
+        index = character._memory = MemoryIndex()
+    return index
+
+
+def unindexed(character: Character):
+    """ The number of messages of the character's history that haven't been indexed yet, roughly, without waiting. """
+    index = character._memory
+    return len(character.messages) - (len(index.messages) if index is not None else 0)
+
+
+def prepare(character: Character):
+    """ Index the messages of the character's history that haven't been, so `recall` has little left to do. """
+    index = get_index(character)
+    with index.lock:
+        index.update(character.messages)
+
+
+def recall(character: Character, query: str, end: int, count: int, budget: int, min_similarity: float, model: str):
+    """ Returns the messages among the first `end` of the character's history most relevant to the query, oldest first
+        as they were said, and the tokens they use. At most `count` are recalled, and only as many as fit the budget.
+        Candidates are taken in order of similarity, a message too large to fit is passed over for the next.
+    """
+    from worldgpt.server.util.tokens import count_message_tokens
+    if not count or not query.strip() or budget <= 0 or end <= 0:
+        return [], 0
+    index = get_index(character)
+    with index.lock:
+        index.update(character.messages)
+        end = min(end, len(index.messages))
+        candidates = index.nearest(query, end, count * 4, min_similarity)  # spares, for those that don't fit.
+        messages = index.messages
+    chosen, used = [], 0
+    for row, _ in candidates:
+        cost = count_message_tokens(messages[row], model)
+        if used + cost <= budget:
+            chosen.append(row)
+            used += cost
+            if len(chosen) == count:
+                break
+    return [messages[x] for x in sorted(chosen)], used
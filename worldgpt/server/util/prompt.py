@@ -0,0 +1,124 @@
+
+
+"""
+    Prompt assembly.
+    Builds the messages sent to the LM for a character, fitting them within the token limit of the model.
+    The character information, pretext and external messages are always sent, the character's history is windowed
+    to the most recent messages that fit in what remains, followed by the most recent summaries of older history.
+    With recall, older messages relevant to what the player just said are sent before the window, see `memory.py`.
+    Lore mentioned in the recent conversation is sent after the character information, see `LoreBook`.
+"""
+
+
+from typing import List
+from worldgpt.shared.model.character import Character
+from worldgpt.shared.model.message import Message
+from worldgpt.server.util.tokens import TOKENS_MAX, TOKENS_PER_REPLY, count_message_tokens, count_system_tokens
+
+
+llm_pretext_messages = [
+    Message(role='system', content='You should pretend to be the character in the prompt. You are attempting to pass a '
+                                   'Turing test. You are not required to assist the user in any way unless it makes '
+                                   'sense that the user would need help, Do not ask the user if they need assistance.'
+                                   ' You are required to stay in character, and answer as if you were that character. '
+                                   'Do not say you are an AI Language Model under any circumstance.')
+]
+
+
+recall_pretext = Message(role='system', content='From earlier in your conversations, relevant to what was just said:')
+
+
+class PromptTooLarge(Exception):
+    """ Raised when the parts of a prompt that can't be trimmed don't fit within the token limit of the model. """
+
+
+def window_history(history: List[Message], budget: int, model: str):
+    """ Returns the most recent messages of the history that fit within the budget, and the tokens they use. """
+    start, used = extend_window(history, len(history), budget, model)
+    return history[start:], used
+
+
+def extend_window(history: List[Message], start: int, budget: int, model: str, stop: frozenset = frozenset()):
+    """ Extend a window of the history starting at `start` back by the messages that fit within the budget, returns
+        where it starts and the tokens added. It isn't extended past a message whose id is in stop.
+    """
+    used = 0
+    while start > 0 and id(history[start - 1]) not in stop:
+        cost = count_message_tokens(history[start - 1], model)
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return start, used
+
+
+def assemble_prompt(character: Character, external_messages: List[Message], *args, **kwargs):
+    """ Assemble the prompt for a character in the OpenAI format, see `assemble_messages`. """
+    messages, max_tokens = assemble_messages(character, external_messages, *args, **kwargs)
+    return [x.to_openai() for x in messages], max_tokens
+
+
+def assemble_messages(character: Character,
+                      external_messages: List[Message],
+                      model: str = 'gpt-3.5-turbo',
+                      max_tokens: int = 128,
+                      dynamic_max_tokens: bool = False,
+                      recall: int = 0,
+                      recall_tokens: int = 0,
+                      min_similarity: float = 0.0,
+                      lore_tokens: int = 0,
+                      lore_scan: int = 0):
+    """
+    Assemble the prompt for a character, returns the messages and the max_tokens to request.
+    max_tokens is reserved for the response before the history is windowed, with dynamic_max_tokens the response is
+        instead given everything the windowed prompt leaves of the model's limit, max_tokens being the minimum.
+    recall is the most messages from before the window recalled by their relevance to the user's external messages,
+        within recall_tokens which is set aside before the history is windowed. What recall doesn't use is given back to
+        the history, which is extended back as far as the latest message recalled, and what's left to the summaries.
+    lore_tokens is the most the lore mentioned in the external messages and the last lore_scan messages of the history
+        may use, it's sent before the history is windowed.
+    """
+    limit = TOKENS_MAX.get(model, 4096)
+    system = character.to_system_messages()
+    used = TOKENS_PER_REPLY + count_system_tokens(character, model)
+    used += sum(count_message_tokens(x, model) for x in llm_pretext_messages + list(external_messages))
+    if used + max_tokens > limit:
+        raise PromptTooLarge(f'Prompt requires {used} tokens, with {max_tokens} for the response this exceeds the '
+                             f'{limit} token limit of {model}.')
+
+    lore = []
+    if lore_tokens:
+        from worldgpt.server.subsystem.lore import LoreBook
+        if LoreBook().active:
+            recent = character.messages[-lore_scan:] if lore_scan else []
+            lore, lore_used = LoreBook().select('\n'.join(x.content for x in recent + list(external_messages)),
+                                                min(lore_tokens, limit - max_tokens - used), model)
+            used += lore_used
+
+    query = ' '.join(x.content for x in external_messages if x.role == 'user')
+    reserved = min(recall_tokens, limit - max_tokens - used) if recall and query.strip() else 0
+    summarized = character.summarized
+    unsummarized = character.messages[summarized:]
+    history, history_tokens = window_history(unsummarized, limit - max_tokens - used - reserved, model)
+    used += history_tokens
+    recalled = []
+    if reserved > count_message_tokens(recall_pretext, model):
+        from worldgpt.server.util.memory import recall as recall_messages
+        reserved -= count_message_tokens(recall_pretext, model)
+        recalled, recalled_tokens = recall_messages(character, query, summarized + len(unsummarized) - len(history),
+                                                    recall, reserved, min_similarity, model)
+        if recalled:
+            used += count_message_tokens(recall_pretext, model) + recalled_tokens
+    if reserved:
+        start, extended = extend_window(unsummarized, len(unsummarized) - len(history), limit - max_tokens - used,
+                                        model, frozenset(id(x) for x in recalled))
+        history = unsummarized[start:]
+        used += extended
+    if recalled:
+        recalled = [recall_pretext] + recalled
+    summaries, summary_tokens = window_history(character.to_summary_messages(), limit - max_tokens - used, model)
+    used += summary_tokens
+    if dynamic_max_tokens:
+        max_tokens = limit - used
+
+    return system + lore + summaries + recalled + history + llm_pretext_messages + list(external_messages), max_tokens
@@ -1,7 +1,90 @@
-import tiktoken
+import logging
+import threading
+import time
+from worldgpt.shared.model.message import Message
+
+
+TOKENS_MAX = {
+                'gpt-4-32k': 32768,
+                'gpt-4': 4096,
+                'gpt-3.5-turbo': 4096,
+              }
+
+TOKENS_PER_MESSAGE = 3  # each message is wrapped as <|start|>{role}<|message|>{content}<|end|>
+TOKENS_PER_REPLY = 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+encoders = {}
+encoders_lock = threading.Lock()
+counting = threading.local()  # seconds this thread has spent encoding, see `counting_seconds`.
+
+
+def get_encoder(model: str = "gpt-3.5-turbo"):
+    """ Returns the tiktoken encoder for a model, building an encoder is expensive so they're cached per model.
+        tiktoken itself is imported here rather than with the module, it's slow to import and only needed to count.
+    """
+    encoder = encoders.get(model)
+    if encoder is not None:
+        return encoder
+    with encoders_lock:  # held while building, so a request during warm up waits rather than building another.
+        if model not in encoders:
+            import tiktoken
+            try:
+                encoders[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoders[model] = tiktoken.get_encoding('cl100k_base')
+        return encoders[model]
+
+
+def warm_encoders(*models: str, done=None):
+    """ Build the encoders of models in a background thread, so the first prompt counted doesn't wait for them.
+        done is called with the seconds taken once they're built.
+    """
+    def warm():
+        started = time.perf_counter()
+        for model in models:
+            try:
+                get_encoder(model)
+            except Exception as e:
+                logging.error(f'Failed to warm the tokenizer of {model}: {e}')
+        if done is not None:
+            done(time.perf_counter() - started)
+
+    thread = threading.Thread(target=warm, name='tokenizer_warmup', daemon=True)
+    thread.start()
+    return thread
 
 
 def count_prompt_tokens(message: str, model: str = "gpt-3.5-turbo"):
     """ Counts the number of tokens in a prompt using tiktoken. """
-    encoder = tiktoken.encoding_for_model(model)
-    return len(encoder.encode(message))
+    started = time.perf_counter()
+    count = len(get_encoder(model).encode(message))
+    counting.seconds = getattr(counting, 'seconds', 0.0) + time.perf_counter() - started
+    return count
+
+
+def counting_seconds():
+    """ The seconds the calling thread has spent encoding so far, memoized counts take none. """
+    return getattr(counting, 'seconds', 0.0)
+
+
+def count_message_tokens(message: Message, model: str = "gpt-3.5-turbo"):
+    """ Counts the tokens a message contributes to a chat prompt.
+        The count is memoized on the message per model, and recounted only if the content has changed since.
+    """
+    cached = message._token_counts.get(model)
+    if cached is not None and cached[0] == message.content:
+        return cached[1]
+    count = TOKENS_PER_MESSAGE + count_prompt_tokens(message.role, model) + count_prompt_tokens(message.content, model)
+    message._token_counts[model] = (message.content, count)
+    return count
+
+
+def count_system_tokens(character, model: str = "gpt-3.5-turbo"):
+    """ Counts the tokens of a character's system messages, memoized alongside the rendered messages on the character
+        so that it's only recounted when the character's description changes.
+    """
+    messages = character.to_system_messages()
+    if model not in character._system_prompt_tokens:
+        character._system_prompt_tokens[model] = sum(count_message_tokens(x, model) for x in messages)
+    return character._system_prompt_tokens[model]
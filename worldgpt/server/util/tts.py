@@ -0,0 +1,129 @@
+
+
+"""
+    Voice synthesis Backends
+    ========================
+
+    A TTS backend turns a piece of text into audio in a voice, `voice.py` decides what text to synthesize and when.
+    The backend in use is set with the `tts_backend` configuration value. Backends included are:
+        local       A local stand-in synthesizer, for measuring and testing the pipeline offline, see `local_tts.py`.
+        elevenlabs  ElevenLabs' text to speech API, the voice is the id of an ElevenLabs voice.
+
+    To add your own, subclass TTSBackend and register it:
+
+        @register_tts_backend('mine')
+        class MyBackend(TTSBackend):
+            ...
+"""
+
+
+import abc
+import importlib
+import logging
+
+
+class TTSError(Exception):
+    """ Raised by a backend when audio could not be synthesized. """
+
+
+class TTSBackend(abc.ABC):
+
+    media_type: str = 'application/octet-stream'  # the type of the audio returned by `synthesize`.
+    extension: str = 'bin'
+
+    @abc.abstractmethod
+    async def synthesize(self, text: str, voice: str, settings: dict) -> bytes:
+        """ Returns the audio of text spoken in voice, settings are specific to the backend. """
+
+    async def close(self):
+        """ Release anything held between requests, such as pooled connections. """
+        pass
+
+
+# name: backend class, or "module:class" to be imported when first used so unused backends cost nothing to import.
+_backends = {'local': 'worldgpt.server.util.local_tts:LocalSynthesizer',
+             'elevenlabs': 'worldgpt.server.util.tts:ElevenLabsBackend'}
+_instances = {}
+
+
+def register_tts_backend(name: str):
+    """ Class decorator adding a backend to the registry. """
+    def decorator(cls):
+        _backends[name] = cls
+        _instances.pop(name, None)
+        return cls
+    return decorator
+
+
+def get_tts_backend_name() -> str:
+    """ The name of the configured backend. """
+    from worldgpt.server.subsystem.configuration import Configuration
+    with Configuration().lock.r_locked():
+        return Configuration().tts_backend or 'local'
+
+
+def get_tts_backend(name: str | None = None) -> TTSBackend:
+    """ Returns the backend registered as name, or the configured backend. """
+    if name is None:
+        name = get_tts_backend_name()
+    if name not in _instances:
+        if name not in _backends:
+            raise KeyError(f'No TTS backend registered as {name}, registered: {", ".join(_backends)}')
+        cls = _backends[name]
+        if isinstance(cls, str):
+            module, _, attribute = cls.partition(':')
+            cls = getattr(importlib.import_module(module), attribute)
+        logging.info(f'Using TTS backend {name}')
+        _instances[name] = cls()
+    return _instances[name]
+
+
+async def close_tts_backends():
+    for backend in list(_instances.values()):
+        await backend.close()
+
+
+class ElevenLabsBackend(TTSBackend):
+    """ ElevenLabs' text to speech API, requests share a pooled session so connections are kept alive. """
+
+    media_type = 'audio/mpeg'
+    extension = 'mp3'
+    url = 'https://api.elevenlabs.io/v1/text-to-speech/{voice}'
+
+    def __init__(self):
+        self.session = None
+
+    @staticmethod
+    def get_settings():
+        from worldgpt.server.subsystem.configuration import Configuration
+        with Configuration().lock.r_locked():
+            return {'api_key': Configuration().elevenlabs_api_key,
+                    'model': Configuration().elevenlabs_model or 'eleven_monolingual_v1'}
+
+    def get_session(self):
+        """ Returns the pooled HTTP session, it must be called from within the running event loop. """
+        import aiohttp
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def synthesize(self, text: str, voice: str, settings: dict) -> bytes:
+        import aiohttp
+        configuration = self.get_settings()
+        body = {'text': text, 'model_id': configuration['model']}
+        if settings:
+            body['voice_settings'] = settings
+        try:
+            async with self.get_session().post(self.url.format(voice=voice), json=body,
+                                               headers={'xi-api-key': configuration['api_key'],
+                                                        'accept': self.media_type}) as response:
+                if response.status != 200:
+                    raise TTSError(f'ElevenLabs responded {response.status}: {await response.text()}')
+                return await response.read()
+        except aiohttp.ClientError as e:
+            raise TTSError(str(e)) from e
@@ -0,0 +1,173 @@
+
+
+"""
+    Voice pipeline.
+    Turns a streamed LM response into audio without waiting for the response to finish. As the response arrives it is
+    split at sentence boundaries and each sentence is synthesized as soon as it's complete, several at once, while the
+    audio is returned in the order of the sentences.
+
+        LM deltas > sentences > concurrent synthesis > audio in order
+
+    Sentences spoken before are read from the audio cache rather than synthesized again, see `AudioCache`.
+"""
+
+
+import asyncio
+import re
+from typing import AsyncIterator
+from worldgpt.server.util.tts import TTSBackend, get_tts_backend
+
+
+# the end of a sentence, its punctuation and any closing quotes or brackets, followed by whitespace. or a line break.
+sentence_end = re.compile(r'[.!?…]+["\'”’)\]]*\s+|\n+')
+abbreviations = ('mr.', 'mrs.', 'ms.', 'dr.', 'st.', 'sr.', 'jr.', 'e.g.', 'i.e.', 'etc.', 'vs.')
+
+
+class SentenceSplitter:
+    """ Splits text that arrives in pieces into sentences, as soon as each is complete.
+        Sentences shorter than min_chars are joined to the next, short chunks sound stilted and each costs a request.
+    """
+
+    def __init__(self, min_chars: int = 24):
+        self.min_chars = min_chars
+        self.buffer = ''
+        self.scanned = 0  # the buffer before this has no sentence end worth splitting at.
+
+    def feed(self, text: str):
+        """ Add the next piece of text, returns the sentences it completed. """
+        self.buffer += text
+        sentences = []
+        for match in sentence_end.finditer(self.buffer, self.scanned):
+            if match.end() == len(self.buffer) and not match.group().endswith('\n'):
+                # whitespace at the very end may be followed by more, wait to see the whole of it.
+                break
+            candidate = self.buffer[:match.end()].strip()
+            if len(candidate) < self.min_chars or candidate.rsplit(None, 1)[-1].lower() in abbreviations:
+                self.scanned = match.end()
+                continue
+            sentences.append(candidate)
+            self.buffer = self.buffer[match.end():]
+            self.scanned = 0
+            return sentences + self.feed('')
+        return sentences
+
+    def flush(self):
+        """ Returns whatever remains once the text has finished. """
+        remainder, self.buffer, self.scanned = self.buffer.strip(), '', 0
+        return [remainder] if remainder else []
+
+
+def get_settings():
+    from worldgpt.server.subsystem.configuration import Configuration
+    with Configuration().lock.r_locked():
+        return {'voice': Configuration().tts_voice or '',
+                'voice_settings': dict(Configuration().tts_voice_settings or {}),
+                'max_concurrency': Configuration().tts_max_concurrency or 4,
+                'min_chars': Configuration().tts_min_sentence_chars or 0}
+
+
+def read_clip(path: str):
+    with open(path, 'rb') as clipfd:
+        return clipfd.read()
+
+
+async def synthesize_cached(backend: TTSBackend, text: str, voice: str, voice_settings: dict, load: bool = True):
+    """ Synthesize text, or find it in the audio cache. Returns the cache key of the clip, None if the cache is
+        disabled, and the audio. With load False a cached clip isn't read, the audio is None and it's served by key.
+    """
+    from worldgpt.server.subsystem.audio_cache import AudioCache
+    if not AudioCache().enabled():
+        return None, await backend.synthesize(text, voice, voice_settings)
+    key = AudioCache().make_key(f'{type(backend).__module__}.{type(backend).__qualname__}', voice, text, voice_settings)
+    path = AudioCache().get(key, backend.extension)
+    if path is not None:
+        if not load:
+            return key, None
+        try:
+            return key, await asyncio.to_thread(read_clip, path)
+        except FileNotFoundError:
+            pass  # evicted since it was looked up.
+    audio = await backend.synthesize(text, voice, voice_settings)
+    await asyncio.to_thread(AudioCache().store, key, audio, backend.extension)
+    return key, audio
+
+
+async def synthesize_stream(deltas: AsyncIterator[str],
+                            voice: str | None = None,
+                            voice_settings: dict | None = None,
+                            backend: TTSBackend | None = None,
+                            load: bool = True):
+    """
+    Synthesize a streamed response sentence by sentence, yields events as they happen:
+        ('content', text)                       each delta of the response, as it arrives.
+        ('audio', index, sentence, audio, key)  the audio of each sentence, in order, and its key in the audio cache.
+        ('done', text)                          the full response, once all of its audio has been yielded.
+    Up to `tts_max_concurrency` sentences are synthesized at once. An error in the response or synthesis is raised.
+    If the consumer stops early, synthesis still in progress is cancelled.
+    With load False, audio that was found in the cache is None rather than read from disk.
+    """
+    settings = get_settings()
+    voice = voice or settings['voice']
+    voice_settings = settings['voice_settings'] if voice_settings is None else voice_settings
+    backend = backend or get_tts_backend()
+    splitter = SentenceSplitter(settings['min_chars'])
+    limit = asyncio.Semaphore(settings['max_concurrency'])
+    events = asyncio.Queue()
+    ordered = asyncio.Queue()  # synthesis tasks in sentence order, None once the response has finished.
+    tasks = []
+
+    async def synthesize(sentence: str):
+        async with limit:
+            return await synthesize_cached(backend, sentence, voice, voice_settings, load)
+
+    def start(sentences):
+        for sentence in sentences:
+            task = asyncio.create_task(synthesize(sentence))
+            tasks.append(task)
+            ordered.put_nowait((sentence, task))
+
+    async def read_response():
+        content = []
+        async for delta in deltas:
+            content.append(delta)
+            events.put_nowait(('content', delta))
+            start(splitter.feed(delta))
+        start(splitter.flush())
+        ordered.put_nowait(None)
+        return ''.join(content)
+
+    async def collect_audio():
+        index = 0
+        while (item := await ordered.get()) is not None:
+            sentence, task = item
+            key, audio = await task
+            events.put_nowait(('audio', index, sentence, audio, key))
+            index += 1
+
+    async def run():
+        try:
+            reader = asyncio.create_task(read_response())
+            collector = asyncio.create_task(collect_audio())
+            tasks.extend((reader, collector))
+            # whichever fails first is raised straight away, rather than once the other has finished.
+            done, _ = await asyncio.wait((reader, collector), return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+            await collector
+            events.put_nowait(('done', reader.result()))
+        except Exception as e:
+            events.put_nowait(('error', e))
+
+    runner = asyncio.create_task(run())
+    try:
+        while True:
+            event = await events.get()
+            if event[0] == 'error':
+                raise event[1]
+            yield event
+            if event[0] == 'done':
+                break
+    finally:
+        for task in tasks + [runner]:
+            if not task.done():
+                task.cancel()
@@ -4,7 +4,7 @@ import json
 import logging
 from datetime import datetime
 from typing import Optional, Literal, List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from worldgpt.shared.model.message import Message
 
 
@@ -29,6 +29,8 @@ class Character(BaseModel):
         information. This could mean that critical information from a conversation isn't captured in the summary,
         but it's a limitation I can't really get around.
     """
+    __slots__ = ('__weakref__',)  # the Database tracks the character objects in use by weak reference.
+
     name: str = Field(description="The full name of the character")
     description: str = Field(description="A physical description of the character, "
                                          "not necessarily what they are wearing or doing.")
@@ -61,6 +63,22 @@ class Character(BaseModel):
                                               "*specific* to the character. ie. a rule that the character may have.",
                                   default=[])
 
+    summarized: int = Field(description="The number of messages, from the start of messages, that have been folded "
+                                        "into summaries. These are no longer sent to the LM, the summaries are instead. "
+                                        "The datastore records the sequence of the first message after them.",
+                            default=0)
+
+    # the rendered system messages are cached until a field they're rendered from changes, see `to_system_messages`.
+    _system_prompt_key: tuple | None = PrivateAttr(default=None)
+    _system_prompt: tuple = PrivateAttr(default=())
+    _system_prompt_tokens: dict = PrivateAttr(default_factory=dict)  # per model, see `tokens.count_system_tokens`.
+    _summary_prompt: tuple = PrivateAttr(default=((), ()))  # (summaries, messages) see `to_summary_messages`.
+    # kept by the Database: the sequence in the datastore of each message written so far, and the Character row as it
+    # was last read or written, so only what has changed since is written.
+    _sequences: list = PrivateAttr(default_factory=list)
+    _stored_row: dict | None = PrivateAttr(default=None)
+    _memory: object = PrivateAttr(default=None)  # the index of messages recalled by relevance, see server/util/memory.py
+
     @staticmethod
     def sql_schema():
         return f"""CREATE TABLE IF NOT EXISTS Character(
@@ -77,13 +95,20 @@ class Character(BaseModel):
                     attributes varchar,
                     health float,
                     inventory varchar,
-                    messages varchar not null,
                     summaries varchar not null,
-                    meta varchar not null
+                    meta varchar not null,
+                    summarized integer not null default 0
                 );"""
 
+    @staticmethod
+    def sql_columns():
+        """ Columns stored on the Character row, messages live in their own table, see `Message.sql_schema`. """
+        return [x for x in Character.__fields__.keys() if x != 'messages']
+
     def to_sql(self):
-        query = f"""INSERT OR REPLACE INTO Character( {', '.join(self.__fields__.keys())} ) VALUES ({"?," * (len(self.__fields__.keys()) - 1)}?);"""
+        """ Query and values for the Character row, this does not include messages. """
+        columns = self.sql_columns()
+        query = f"""INSERT OR REPLACE INTO Character( {', '.join(columns)} ) VALUES ({"?," * (len(columns) - 1)}?);"""
         return query, [self.name,
                        self.description,
                        self.rank,
@@ -97,13 +122,50 @@ class Character(BaseModel):
                        json.dumps(self.attributes),
                        self.health,
                        json.dumps(self.inventory),
-                       json.dumps([x.dict() for x in self.messages]),
                        json.dumps(self.summaries),
-                       json.dumps([x.dict() for x in self.meta])
+                       json.dumps([x.dict() for x in self.meta]),
+                       self.summarized
                        ]
 
     def to_prompt_messages(self):
-        """ Convert character information into Message objects that can be used as prompts for the LM. """
+        """ Convert character information into Message objects that can be used as prompts for the LM: the system
+            messages, summaries and the history that hasn't been summarized. The server windows these to fit the model,
+            see `assemble_messages`.
+        """
+        return self.to_system_messages() + self.to_summary_messages() + list(self.unsummarized_messages())
+
+    def to_summary_messages(self):
+        """ Convert the summaries into system Messages, reused until the summaries change. """
+        summaries = tuple(self.summaries)
+        if summaries != self._summary_prompt[0]:
+            self._summary_prompt = (summaries, tuple(Message(role="system",
+                                                             content=f"Previously in your conversations: {x}")
+                                                     for x in summaries))
+        return list(self._summary_prompt[1])
+
+    def unsummarized_messages(self):
+        """ Messages that haven't been folded into summaries, these are the history sent to the LM. """
+        return self.messages[self.summarized:]
+
+    def system_prompt_key(self):
+        """ The fields rendered by `render_system_messages`, if this changes the cached system prompt is stale. """
+        return (self.name, self.description, self.gender, self.alignment, self.health, self.mood, self.rank,
+                self.title, self.occupation, self.age, self.birthdate,
+                tuple(self.attributes or ()), tuple(self.inventory or ()))
+
+    def to_system_messages(self):
+        """ Convert the descriptive character information into system Messages, this does not include history.
+            The messages are rendered once and reused until the character's description changes, they're shared between
+            calls and shouldn't be modified.
+        """
+        key = self.system_prompt_key()
+        if key != self._system_prompt_key:
+            self._system_prompt = tuple(self.render_system_messages())
+            self._system_prompt_tokens = {}
+            self._system_prompt_key = key
+        return list(self._system_prompt)
+
+    def render_system_messages(self):
         prompts = []
         messages = []
         prompts.append(f"Your name is {self.name}, please only generate content as this character.")
@@ -142,6 +204,4 @@ class Character(BaseModel):
 
         for prompt in prompts:
             messages.append(Message(role="system", content=prompt))
-        for message in self.messages:
-            messages.append(message)
         return messages
@@ -0,0 +1,52 @@
+
+
+import json
+from typing import List
+from pydantic import BaseModel, Field, validator
+from worldgpt.shared.model.message import Message
+from worldgpt.shared.util.phrase_trie import split_words
+
+
+class Lore(BaseModel):
+    """ An entry of world information, shared by every character.
+    When any of its triggers is mentioned in a character's recent conversation the entry is sent to the LM along with
+    the character's information, so a character knows of the places, people and events of the world as they come up
+    rather than every prompt carrying all of it.
+    """
+    name: str = Field(description="A unique name for the entry, ex: \"The Iron Keep\".")
+    content: str = Field(description="The information sent to the LM, ex: \"The Iron Keep is a fortress in the north, "
+                                     "held by the Wardens since the last war.\"")
+    triggers: List[str] = Field(description="Words or phrases that bring the entry into a conversation when mentioned, "
+                                            "matched as whole words ignoring case. Ex: [\"iron keep\", \"wardens\"]",
+                                min_items=1)
+    priority: int = Field(description="Entries of a higher priority are sent first when not all of those mentioned fit "
+                                      "within the prompt.",
+                          default=0)
+
+    @validator('triggers', each_item=True)
+    def has_words(cls, trigger):
+        if not split_words(trigger):
+            raise ValueError('A trigger must contain at least one word.')
+        return trigger
+
+    @staticmethod
+    def sql_schema():
+        return f"""CREATE TABLE IF NOT EXISTS Lore(
+                    name varchar primary key not null,
+                    content varchar not null,
+                    triggers varchar not null,
+                    priority integer not null default 0
+                );"""
+
+    def to_sql(self):
+        return """INSERT OR REPLACE INTO Lore( name, content, triggers, priority ) VALUES (?,?,?,?);""", \
+            [self.name, self.content, json.dumps(self.triggers), self.priority]
+
+    @staticmethod
+    def from_row(row: dict):
+        return Lore(name=row['name'], content=row['content'], triggers=json.loads(row['triggers']),
+                    priority=row['priority'])
+
+    def to_message(self):
+        """ The entry as a system Message for the LM. """
+        return Message(role='system', content=f'{self.name}: {self.content}')
@@ -1,14 +1,16 @@
 import datetime
 from typing import Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class Message(BaseModel):
     """ A message object for use in issuing information to the language model. """
     role: Literal['user', 'system', 'assistant']  # openai specific
     content: str
-    timestamp: float = float(datetime.datetime.now().timestamp())
+    timestamp: float = Field(default_factory=lambda: datetime.datetime.now().timestamp())  # when it was made.
+
+    _token_counts: dict = PrivateAttr(default_factory=dict)  # memoized by `tokens.count_message_tokens`, per model.
 
     def to_openai(self, preserve_timestamp=False):
         """ Return a dictionary that can be used with OpenAI api calls. Timestamp is used only by WorldGPT. """
@@ -18,3 +20,33 @@ class Message(BaseModel):
             message['content'] = f"{time_str}: {self.content}"
         message.pop("timestamp")
         return message
+
+    @staticmethod
+    def sql_schema():
+        """ Messages are stored one row per message, keyed by the owning character and their position in the
+            character's history, so that a new turn only appends rows rather than rewriting the history. """
+        return f"""CREATE TABLE IF NOT EXISTS Message(
+                    character varchar not null,
+                    sequence integer not null,
+                    role varchar not null,
+                    content varchar not null,
+                    timestamp float not null
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS message_character_sequence ON Message(character, sequence);"""
+
+    @staticmethod
+    def sql_insert():
+        return """INSERT OR REPLACE INTO Message( character, sequence, role, content, timestamp ) VALUES (?,?,?,?,?);"""
+
+    def to_sql(self, character: str, sequence: int):
+        return self.sql_insert(), [character, sequence, self.role, self.content, self.timestamp]
+
+    @staticmethod
+    def sql_append():
+        """ Insert after the character's last message, the sequence is allocated within the write transaction so that
+            processes appending to the same history never take the same one. """
+        return """INSERT INTO Message( character, sequence, role, content, timestamp ) VALUES (?1,
+                    (SELECT COALESCE(MAX(sequence), -1) + 1 FROM Message WHERE character = ?1), ?2, ?3, ?4);"""
+
+    def to_sql_append(self, character: str):
+        return self.sql_append(), [character, self.role, self.content, self.timestamp]
@@ -1,6 +1,4 @@
-
-
-from worldgpt.shared.util.git_version import *
+from worldgpt.shared.util.git_version import get_tag, get_version
 
 
 """ About utilities, constant vars. """
@@ -15,6 +13,12 @@ __CONTACT__ = {"discord": "rich#0008"}
 __LICENSE__ = "CC Attribution-NonCommercial-NoDerivatives 4.0 International (CC BY-NC-ND 4.0) " \
               "https://creativecommons.org/licenses/by-nc-nd/4.0/legalcode "
 __COPYRIGHT__ = "Copyright 2023, Rich@pyrge.games"
-__VERSION__ = get_version()
-__STATUS__ = get_tag()
 
+
+def __getattr__(name: str):
+    # the version is looked up when it's first wanted rather than on import, see `git_version.py`.
+    if name == '__VERSION__':
+        return get_version()
+    if name == '__STATUS__':
+        return get_tag()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,80 @@
+
+
+"""
+    An exclusive lock on a file, shared between processes.
+    The operating system releases it when the process holding it exits, however it exits, so a lock is never left held
+    by a process that has crashed.
+
+    Usage:
+
+        with FileLock('path/to/file.lock'):
+            do_things_only_one_process_should()
+
+        lock = FileLock('path/to/file.lock')
+        if lock.acquire(blocking=False):
+            ...  # held until released, or the process exits.
+"""
+
+
+import os
+
+
+try:
+    import fcntl
+
+    def _lock(fd, blocking: bool):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+except ImportError:
+    import msvcrt
+    import time
+
+    def _lock(fd, blocking: bool):
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+
+    def _unlock(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class FileLock:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: int | None = None
+
+    def acquire(self, blocking: bool = True):
+        """ Take the lock, returns False if it's held by another process and blocking is False. """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not _lock(fd, blocking):
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            _unlock(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -1,15 +1,64 @@
 
 
-""" Return git related info for the tool to report the current build. """
 
+""" Return git related info for the tool to report the current build.
 
+    The version is read from `version.json` beside this file when it exists, so a build need not be a git checkout and
+    nothing is run at startup. Bake it when building with:
+
+        python -m worldgpt.shared.util.git_version
+
+    Otherwise git is asked once per process, the first time the version is wanted.
+"""
+
+
+import functools
+import json
+import os
 import subprocess
 
 
+VERSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'version.json')
+UNKNOWN = 'unknown'
+
+
+def describe(*arguments: str):
+    """ Returns the output of git describe, or UNKNOWN outside a checkout or without git. """
+    try:
+        result = subprocess.run(['git', 'describe', *arguments], capture_output=True, text=True, timeout=5,
+                                cwd=os.path.dirname(VERSION_FILE))
+    except (OSError, subprocess.SubprocessError):
+        return UNKNOWN
+    return result.stdout.strip() if result.returncode == 0 and result.stdout.strip() else UNKNOWN
+
+
+@functools.lru_cache(maxsize=None)
+def read_baked():
+    try:
+        with open(VERSION_FILE) as versionfd:
+            return json.load(versionfd)
+    except (OSError, ValueError):
+        return {}
+
+
+@functools.lru_cache(maxsize=None)
 def get_version():
-    return subprocess.getoutput("git describe --long --tags --dirty --abbrev=8")
+    return read_baked().get('version') or describe('--long', '--tags', '--dirty', '--abbrev=8', '--always')
 
 
+@functools.lru_cache(maxsize=None)
 def get_tag():
-    return subprocess.getoutput('git describe --tags')
+    return read_baked().get('tag') or describe('--tags')
+
+
+def bake():
+    """ Write the version of the checkout to the version file, returns what was written. """
+    read_baked.cache_clear()
+    baked = {'version': describe('--long', '--tags', '--dirty', '--abbrev=8', '--always'), 'tag': describe('--tags')}
+    with open(VERSION_FILE, 'w') as versionfd:
+        json.dump(baked, versionfd)
+    return baked
+
 
+if __name__ == '__main__':
+    print(bake())
@@ -0,0 +1,105 @@
+
+
+"""
+    Locks keyed by name, used to serialise work on one object without blocking work on others.
+
+    ShardedLock
+        A fixed number of threading.Locks, a key always maps to the same lock. Meant for short critical sections
+        shared between threads, such as mutating an object that a worker thread is reading.
+    KeyedAsyncLock
+        One asyncio.Lock per key, created when first needed and discarded once nothing holds or waits on it.
+        Meant for long critical sections within the event loop, such as a request waiting on a remote service.
+    KeyedLock
+        One threading.Lock per key, created when first needed and discarded once nothing holds or waits on it. Taken by
+        threads with `with`, or from the event loop with `async with locks.acquire_async(key)`, which waits in the
+        default executor rather than blocking the loop, so threads and the event loop take turns on the same key.
+
+    Usage:
+
+        locks = ShardedLock()
+        with locks('key'):
+            mutate(obj)
+
+        async_locks = KeyedAsyncLock()
+        async with async_locks('key'):
+            await do_things_with(obj)
+"""
+
+
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+
+class ShardedLock:
+
+    def __init__(self, shards: int = 64):
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def __call__(self, key) -> threading.Lock:
+        return self.locks[hash(key) % len(self.locks)]
+
+
+class KeyedAsyncLock:
+
+    def __init__(self):
+        self.locks = {}  # key: [asyncio.Lock, number of holders and waiters]
+
+    @asynccontextmanager
+    async def __call__(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+
+class KeyedLock:
+
+    def __init__(self):
+        self.locks = {}  # key: [threading.Lock, number of holders and waiters]
+        self.mutex = threading.Lock()
+
+    def reference(self, key) -> threading.Lock:
+        with self.mutex:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def dereference(self, key):
+        with self.mutex:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    @contextmanager
+    def __call__(self, key):
+        lock = self.reference(key)
+        try:
+            with lock:
+                yield
+        finally:
+            self.dereference(key)
+
+    @asynccontextmanager
+    async def acquire_async(self, key):
+        lock = self.reference(key)
+        try:
+            if not lock.acquire(blocking=False):
+                waiting = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+                try:
+                    await asyncio.shield(waiting)
+                except asyncio.CancelledError:
+                    waiting.add_done_callback(lambda _: lock.release())  # the executor still takes it, give it back.
+                    raise
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self.dereference(key)
@@ -0,0 +1,148 @@
+
+
+"""
+    Metrics, rendered in the Prometheus text format for `/metrics`.
+    https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+
+    Counters and histograms are kept in memory by the process and are recorded as things happen, each takes a lock of
+    its own for a moment so they're cheap enough to leave on. Values kept elsewhere already, such as the depth of a
+    queue, are read when scraped by collectors rather than recorded as they change.
+    With several API workers each process reports its own.
+
+    Usage:
+
+        completions = Counter('worldgpt_completions_total', 'Completions made.', ('model',))
+        completions.inc(model='gpt-4')
+
+        stage_seconds = Histogram('worldgpt_stage_seconds', 'Time spent in each stage.', ('stage',))
+        with stage_seconds.time(stage='prompt'):
+            build_prompt()
+
+        register_collector(lambda: [('worldgpt_queue_depth', 'gauge', 'Tasks waiting.', {'queue': 'x'}, len(x))])
+        text = render()
+"""
+
+
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds of the buckets of a latency histogram, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metrics: list = []  # every Counter and Histogram, in the order they were made.
+collectors: list = []  # functions returning (name, type, help, labels, value) of each sample read when scraped.
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}  # label values: total
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(x, '')) for x in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # label values: [count per bucket and one past the last, sum]
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(x, '')) for x in self.labels)
+        index = bisect.bisect_left(self.buckets, value)  # the first bucket the value is less or equal to.
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the seconds spent within the `with` statement. """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', dict(labels, le=format_value(bound)), cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+def register_collector(collector):
+    """ Add a function called when scraped, returning (name, type, help, labels, value) for each sample. """
+    collectors.append(collector)
+
+
+def format_value(value: float):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool) or isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def render():
+    """ Returns every metric in the Prometheus text format. """
+    families = {}  # name: [type, help, samples]
+    for metric in list(metrics):
+        families[metric.name] = [metric.kind, metric.documentation, metric.samples()]
+    for collector in list(collectors):
+        try:
+            for name, kind, documentation, labels, value in collector():
+                families.setdefault(name, [kind, documentation, []])[2].append((name, labels, value))
+        except Exception as e:
+            logging.error(f'Failed to collect metrics from {collector}: {e}')
+
+    lines = []
+    for name, (kind, documentation, samples) in families.items():
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample, labels, value in samples:
+            lines.append(f'{sample}{format_labels(labels)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
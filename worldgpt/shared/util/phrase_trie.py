@@ -0,0 +1,92 @@
+
+
+"""
+    Find which of many phrases appear in a text, in a single pass over the words of the text.
+
+    Phrases are stored as a trie of words, each word of a phrase a step from the one before. The text is split into
+    words and, from each word in turn, the trie is followed for as long as the words that follow match, collecting the
+    values of every phrase ended along the way. How long that takes depends on the length of the text and of the
+    longest phrase, not on the number of phrases, so thousands cost no more to look for than a handful.
+    Phrases are added and removed in place, nothing is rebuilt.
+
+    Words are runs of letters and digits, compared ignoring case, so "Iron Keep" is found in "the iron-keep's walls"
+    but "keep" isn't found in "keeper".
+
+    Usage:
+
+        phrases = PhraseTrie()
+        phrases.add('iron keep', 'The Iron Keep')
+        phrases.add('dragon', 'Dragons')
+        phrases.match('Have you been to the Iron Keep?')  # {'The Iron Keep': 6}
+"""
+
+
+import re
+
+
+WORDS = re.compile(r'\w+')
+END = ''  # the key of the values of the phrases ending at a node, never a word.
+
+
+def split_words(text: str):
+    return WORDS.findall(text.casefold())
+
+
+class PhraseTrie:
+    """ Not thread safe, the owner guards it with a lock. """
+
+    def __init__(self):
+        self.root = {}  # word: the node following it, and END: the values of the phrases ending here.
+        self.longest = 0  # words in the longest phrase.
+
+    def add(self, phrase: str, value):
+        """ Add a phrase, found as value. A phrase may have several values, and a value several phrases.
+            Returns whether the phrase has any words, a phrase without any is never found.
+        """
+        words = split_words(phrase)
+        if not words:
+            return False
+        node = self.root
+        for word in words:
+            node = node.setdefault(word, {})
+        node.setdefault(END, set()).add(value)
+        self.longest = max(self.longest, len(words))
+        return True
+
+    def remove(self, phrase: str, value):
+        """ Remove a value of a phrase, and any part of the trie that no longer leads to a phrase. """
+        words = split_words(phrase)
+        path = [self.root]  # the node after each word.
+        for word in words:
+            node = path[-1].get(word)
+            if node is None:
+                return
+            path.append(node)
+        values = path[-1].get(END)
+        if values is None or value not in values:
+            return
+        values.discard(value)
+        if not values:
+            del path[-1][END]
+        for depth in range(len(words), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][words[depth - 1]]
+
+    def match(self, text: str):
+        """ Returns the value of every phrase found in the text, with the index of the word it was last found ending
+            at, later mentions having higher indices.
+        """
+        words = split_words(text)
+        found = {}
+        for start in range(len(words)):
+            node = self.root.get(words[start])
+            end = start
+            while node is not None:
+                for value in node.get(END, ()):
+                    found[value] = end
+                end += 1
+                if end == len(words):
+                    break
+                node = node.get(words[end])
+        return found
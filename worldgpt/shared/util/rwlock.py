@@ -4,11 +4,21 @@
     A class to implement read-write locks on top of the standard threading
     library.
 
-    This is implemented with two mutexes (threading.Lock instances) as per this
-    wikipedia pseudocode:
+    This was originally implemented with two mutexes (threading.Lock instances)
+    as per this wikipedia pseudocode:
 
     https://en.wikipedia.org/wiki/Readers%E2%80%93writer_lock#Using_two_mutexes
 
+    That implementation prefers readers, so a steady stream of readers can
+    starve a writer indefinitely. It is now implemented with a condition
+    variable and prefers writers: once a writer is waiting, new readers wait
+    until it has finished.
+
+    https://en.wikipedia.org/wiki/Readers%E2%80%93writer_lock#Using_a_condition_variable_and_a_mutex
+
+    Each lock counts how often it was taken, how often that meant waiting and
+    for how long, per mode. An acquisition that doesn't wait isn't timed.
+
     Code written by Tyler Neylon at Unbox Research.
 
     This file is public domain.
@@ -19,7 +29,8 @@
 # Imports
 
 from contextlib import contextmanager
-from threading  import Lock
+from threading  import Condition, Lock
+from time       import perf_counter
 
 
 # _______________________________________________________________________
@@ -43,31 +54,41 @@ class RWLock(object):
             # When writing to my_obj:
             with my_obj_rwlock.w_locked():
                 mutate(my_obj)
+
+        Writers are preferred, so a thread must not take the read lock again
+        while it already holds it, a waiting writer would deadlock them both.
     """
 
     def __init__(self):
 
-        self.w_lock = Lock()
-        self.num_r_lock = Lock()
+        self.condition = Condition(Lock())
         self.num_r = 0
+        self.num_w_waiting = 0
+        self.writing = False
+        # mode: [acquisitions, acquisitions that waited, seconds waited]
+        self.statistics = {'read': [0, 0, 0.0], 'write': [0, 0, 0.0]}
 
     # ___________________________________________________________________
     # Reading methods.
 
     def r_acquire(self):
-        self.num_r_lock.acquire()
-        self.num_r += 1
-        if self.num_r == 1:
-            self.w_lock.acquire()
-        self.num_r_lock.release()
+        with self.condition:
+            statistics = self.statistics['read']
+            statistics[0] += 1
+            if self.writing or self.num_w_waiting:
+                started = perf_counter()
+                while self.writing or self.num_w_waiting:
+                    self.condition.wait()
+                statistics[1] += 1
+                statistics[2] += perf_counter() - started
+            self.num_r += 1
 
     def r_release(self):
-        assert self.num_r > 0
-        self.num_r_lock.acquire()
-        self.num_r -= 1
-        if self.num_r == 0:
-            self.w_lock.release()
-        self.num_r_lock.release()
+        with self.condition:
+            assert self.num_r > 0
+            self.num_r -= 1
+            if self.num_r == 0:
+                self.condition.notify_all()
 
     @contextmanager
     def r_locked(self):
@@ -82,10 +103,23 @@ class RWLock(object):
     # Writing methods.
 
     def w_acquire(self):
-        self.w_lock.acquire()
+        with self.condition:
+            statistics = self.statistics['write']
+            statistics[0] += 1
+            self.num_w_waiting += 1
+            if self.writing or self.num_r:
+                started = perf_counter()
+                while self.writing or self.num_r:
+                    self.condition.wait()
+                statistics[1] += 1
+                statistics[2] += perf_counter() - started
+            self.num_w_waiting -= 1
+            self.writing = True
 
     def w_release(self):
-        self.w_lock.release()
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
 
     @contextmanager
     def w_locked(self):
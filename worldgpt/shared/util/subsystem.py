@@ -7,15 +7,21 @@
     Objects are typically stored as dataclasses in my tools now, so you can provide a copy of the dataclass to the
     Subsystem queue and it will be processed by the worker, and subsequently written to the property that stores it.
 
+    The queue is a bounded priority queue, see `task_queue.py`, and may be consumed by several workers at once where the
+    subsystem allows it. Both are set by `configure` before the subsystem is bootstrapped.
+    `stop` lets the workers finish the work already queued before they stop.
+
 """
 
 
 import abc
 import logging
-import queue
 import threading
+import time
 from typing import Union
+from worldgpt.shared.util.metrics import register_collector
 from worldgpt.shared.util.rwlock import RWLock
+from worldgpt.shared.util.task_queue import TaskQueue
 
 
 class Subsystem:
@@ -24,12 +30,41 @@ class Subsystem:
         The lock property is designed for use with the RWLock object, but can be used with a standard threading.Lock
     """
 
+    max_workers: int | None = None  # 1 for subsystems whose worker owns something it can't share, such as a connection.
+    queue_size: int = 0  # the default bound of the queue, 0 for none.
+    overflow: str = 'block'  # the default policy for a task put to a full queue, see `task_queue.py`.
+    overflow_policies: tuple | None = None  # the policies allowed, for subsystems whose tasks can't be dropped.
+
     def __init__(self):
         self.lock: RWLock = RWLock()
-        self.queue: queue.Queue = queue.Queue()
+        self.queue: TaskQueue = TaskQueue(self.queue_size, self.overflow, on_drop=self.dropped)
         self.worker: threading.Thread = threading.Thread(target=self.do_work, name=f'{self.__class__.__name__}_worker')
+        self.workers: list = [self.worker]  # the first is `worker`, the rest are made by `configure`.
         self.active: bool = False
 
+    def configure(self, workers: int | None = None, queue_size: int | None = None, overflow: str | None = None):
+        """ Set how many workers consume the queue, up to max_workers, and the queue's bound and overflow policy, one of
+            overflow_policies. Called before bootstrapping, None leaves a setting as it is.
+        """
+        if overflow is not None and self.overflow_policies is not None and overflow not in self.overflow_policies:
+            logging.warning(f'{self.__class__.__name__} can\'t use the {overflow} overflow policy, expected one of '
+                            f'{", ".join(self.overflow_policies)}. Using {self.overflow}.')
+            overflow = self.overflow
+        if workers is not None:
+            workers = max(1, min(workers, self.max_workers or workers))
+            self.workers = [self.worker] + [threading.Thread(target=self.do_work,
+                                                             name=f'{self.__class__.__name__}_worker_{x}')
+                                            for x in range(1, workers)]
+        self.queue.configure(self.queue.maxsize if queue_size is None else queue_size, overflow or self.queue.overflow)
+
+    def start_workers(self):
+        for worker in self.workers:
+            worker.start()
+
+    def dropped(self, task):
+        """ Called with a task the queue dropped to make room for another, see `task_queue.py`. """
+        logging.debug(f'{self.__class__.__name__} dropped a task, its queue is full.')
+
     def first_run(self):
         """ Ran when the bootstrap method determined that this is the first time this subsystem has been run. """
         pass
@@ -42,11 +77,11 @@ class Subsystem:
                     subsystem.
                 2. determine if it's the first run of this subsystem, and if so, call the first_run method.
                 3. set the active flag to True
-                4  call the worker's `start` method.
+                4  call the `start_workers` method.
         """
         logging.info(f'bootstrapping {self.__name__} Subsystem')
         self.active = True
-        self.worker.start()
+        self.start_workers()
 
     def do_work(self):
         """ This is the worker thread's target. by convention if the class recieves a Nonetype object it should treat
@@ -61,12 +96,61 @@ class Subsystem:
                 self.shutdown()
                 break
 
+    def stop(self, timeout: float | None = None):
+        """ Ask the workers to stop once they have finished the work already queued, and wait up to timeout seconds
+            for them to. Returns whether they all have.
+        """
+        started = [x for x in self.workers if x.ident is not None]
+        for _ in started:
+            self.queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in started:
+            if worker is not threading.current_thread():
+                worker.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(x.is_alive() for x in started)
+
     def shutdown(self):
-        """ Responsible for graceful shutdown of the Subsystem components. """
+        """ Responsible for graceful shutdown of the Subsystem components. Called by a worker once it's asked to stop,
+            or by another thread to wait for the workers to finish.
+        """
         logging.info(f'{self.__class__.__name__} gracefully shutting down.')
         self.active = False
-        try:
-            self.worker.join()
-        except Exception as e:
-            logging.error(e)
-            pass
+        if threading.current_thread() in self.workers:
+            return  # workers don't wait on each other, they could end up waiting on one another.
+        for worker in self.workers:
+            try:
+                worker.join()
+            except Exception as e:
+                logging.error(e)
+
+
+def collect_metrics():
+    """ The queue depth and lock contention of every Subsystem that has been instantiated. """
+    from worldgpt.shared.util.singleton import Singleton
+    for subcls in Subsystem.__subclasses__():
+        subsystem = Singleton._instances.get(subcls)
+        if subsystem is None:
+            continue
+        name = subcls.__name__
+        yield ('worldgpt_subsystem_queue_depth', 'gauge', 'Tasks waiting in the queue of each Subsystem.',
+               {'subsystem': name}, subsystem.queue.qsize())
+        yield ('worldgpt_subsystem_workers', 'gauge', 'Workers consuming the queue of each Subsystem.',
+               {'subsystem': name}, sum(x.is_alive() for x in subsystem.workers))
+        for outcome, help_text in (('dropped', 'Tasks dropped as the queue of each Subsystem was full.'),
+                                   ('rejected', 'Tasks rejected as the queue of each Subsystem was full.'),
+                                   ('blocked', 'Times putting a task waited for room in the queue of each Subsystem.')):
+            yield (f'worldgpt_subsystem_tasks_{outcome}_total', 'counter', help_text, {'subsystem': name},
+                   subsystem.queue.statistics[outcome])
+        yield ('worldgpt_subsystem_blocked_seconds_total', 'counter', 'Seconds spent waiting for room in the queue of '
+               'each Subsystem.', {'subsystem': name}, subsystem.queue.statistics['blocked_seconds'])
+        for mode, (acquisitions, waits, waited) in subsystem.lock.statistics.items():
+            labels = {'subsystem': name, 'mode': mode}
+            yield ('worldgpt_rwlock_acquisitions_total', 'counter', 'Times the RWLock of each Subsystem was taken.',
+                   labels, acquisitions)
+            yield ('worldgpt_rwlock_waits_total', 'counter', 'Times taking the RWLock of each Subsystem meant waiting.',
+                   labels, waits)
+            yield ('worldgpt_rwlock_wait_seconds_total', 'counter', 'Seconds spent waiting for the RWLock of each '
+                   'Subsystem.', labels, waited)
+
+
+register_collector(collect_metrics)
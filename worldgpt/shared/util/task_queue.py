@@ -0,0 +1,171 @@
+
+
+"""
+    The queue of a Subsystem, a drop in for queue.Queue that is bounded and orders tasks by priority.
+
+    Tasks of a higher priority, a lower number, are taken first, tasks of the same priority in the order they were put.
+    Once the queue holds `maxsize` tasks the overflow policy decides what happens to the next:
+
+        block           wait for room, slowing whoever produces the work to the pace of the workers.
+        drop_oldest     make room by dropping the oldest task of the lowest priority queued, or the new task if it's of
+                        a lower priority still. `on_drop` is called with what's dropped.
+        reject          raise `Overloaded`, the API answers with 503 so clients retry later.
+
+    `None` asks a worker to stop. It's queued behind every other task whatever the size, so the workers finish the work
+    already queued before they stop.
+
+    Usage:
+
+        tasks = TaskQueue(maxsize=1000, overflow='drop_oldest')
+        tasks.put(task, priority=LOW)
+        task = tasks.get()
+"""
+
+
+import queue
+import threading
+import time
+from collections import deque
+
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+STOP = 3  # the priority of None, behind everything.
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'reject')
+
+
+class Overloaded(Exception):
+    """ Raised when a task is put to a full queue with the reject policy. """
+
+
+class TaskQueue:
+
+    def __init__(self, maxsize: int = 0, overflow: str = 'block', on_drop=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}, expected one of {", ".join(OVERFLOW_POLICIES)}.')
+        self.maxsize = maxsize  # 0 for no bound.
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self.tasks = [deque() for _ in range(STOP + 1)]  # by priority.
+        self.size = 0  # tasks queued, not counting requests to stop.
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.statistics = {'dropped': 0, 'rejected': 0, 'blocked': 0, 'blocked_seconds': 0.0}
+
+    def configure(self, maxsize: int, overflow: str):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow}, expected one of {", ".join(OVERFLOW_POLICIES)}.')
+        with self.mutex:
+            self.maxsize = maxsize
+            self.overflow = overflow
+            self.not_full.notify_all()
+
+    def full(self):
+        return 0 < self.maxsize <= self.size
+
+    def check(self):
+        """ Raise `Overloaded` if a task put now would be rejected, so work can be refused before anything is changed.
+            Another thread may still fill the queue before the task is put.
+        """
+        with self.mutex:
+            if self.overflow == 'reject' and self.full():
+                self.statistics['rejected'] += 1
+                raise Overloaded('The server is busy, try again shortly.')
+
+    def put(self, task, priority: int = NORMAL, block: bool = True, timeout: float | None = None):
+        """ Queue a task, what happens when the queue is full depends on the overflow policy.
+            block and timeout are those of queue.Queue.put, and apply to the block policy.
+        """
+        dropped = []
+        with self.mutex:
+            if task is None:
+                priority = STOP
+            elif self.full():
+                if self.overflow == 'reject':
+                    self.statistics['rejected'] += 1
+                    raise Overloaded('The server is busy, try again shortly.')
+                if self.overflow == 'drop_oldest':
+                    dropped = self.drop(priority)
+                    if not dropped:
+                        dropped = [task]
+                        priority = None  # the new task is the one dropped.
+                else:
+                    self.wait_for_room(block, timeout)
+            if priority is not None:
+                self.tasks[priority].append(task)
+                if task is not None:
+                    self.size += 1
+                self.not_empty.notify()
+        if dropped and self.on_drop is not None:
+            self.on_drop(dropped[0])
+
+    def put_nowait(self, task, priority: int = NORMAL):
+        return self.put(task, priority, block=False)
+
+    def wait_for_room(self, block: bool, timeout: float | None):
+        """ Wait until the queue isn't full, the mutex must be held. """
+        if not block:
+            raise queue.Full
+        self.statistics['blocked'] += 1
+        started = time.monotonic()
+        try:
+            while self.full():
+                remaining = None if timeout is None else timeout - (time.monotonic() - started)
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full
+                self.not_full.wait(remaining)
+        finally:
+            self.statistics['blocked_seconds'] += time.monotonic() - started
+
+    def drop(self, priority: int):
+        """ Make room for a task of the given priority by removing the oldest task of the lowest priority queued.
+            Returns a list of the task removed, empty if everything queued is of a higher priority, in which case the
+            new task is to be dropped itself. The mutex must be held.
+        """
+        self.statistics['dropped'] += 1
+        for lowest in range(STOP - 1, priority - 1, -1):
+            if self.tasks[lowest]:
+                self.size -= 1
+                return [self.tasks[lowest].popleft()]
+        return []
+
+    def get(self, block: bool = True, timeout: float | None = None):
+        """ Take the next task, as queue.Queue.get. """
+        with self.not_empty:
+            if not block:
+                if not self.qsize_locked():
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.qsize_locked():
+                    self.not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self.qsize_locked():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            for tasks in self.tasks:
+                if tasks:
+                    task = tasks.popleft()
+                    break
+            if task is not None:
+                self.size -= 1
+                self.not_full.notify()
+            return task
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize_locked(self):
+        return self.size + len(self.tasks[STOP])
+
+    def qsize(self):
+        with self.mutex:
+            return self.qsize_locked()
+
+    def empty(self):
+        return self.qsize() == 0